@@ -12,12 +12,48 @@ PyVISSIM for PTV VISSIM v8+
 #    All rights reserved.
 #
 #
+import importlib
 import sys
+import types
+
 if sys.version_info[:2] < (2, 7):
     m = "Python 2.7 or later is required for PyVISSIM (%d.%d detected)."
     raise ImportError(m % sys.version_info[:2])
-del sys
 
 from vissim_objs import *
-from osm_to_vissim import *
-from vissim_to_geojson import *
+from progress import configureLogging, getLogger, startProgress
+
+# The OSM and GeoJSON tooling pulls in networkx, scipy and geojson, so it is
+# only imported the first time one of these attributes is used
+_lazy = {'OSM': 'osm_to_vissim', 'convertMany': 'osm_to_vissim',
+         'ROAD_TYPES': 'osm_to_vissim', 'TURN_ANGLES': 'osm_to_vissim',
+         'BUS_STOP_DISTANCE': 'osm_to_vissim',
+         'read_osm': 'osm_to_graph', 'read_osc': 'osm_to_graph',
+         'update_osm': 'osm_to_graph', 'download_osm': 'osm_to_graph',
+         'GeoJSON': 'vissim_to_geojson',
+         'importGeoJSON': 'vissim_to_geojson'}
+
+
+class _LazyModule(types.ModuleType):
+    def __getattr__(self, name):
+        """ Import the module of a lazy attribute on first use.
+            Input: attribute name
+            Output: attribute value, cached on the package
+        """
+        if name not in _lazy:
+            raise AttributeError("'module' object has no attribute '%s'" %
+                                 (name))
+        module = importlib.import_module(__name__ + '.' + _lazy[name])
+        value = getattr(module, name)
+        setattr(self, name, value)
+        return value
+
+    def __dir__(self):
+        return sorted(set(self.__dict__) | set(_lazy))
+
+
+# Replace the package module by a lazy one sharing its attributes. The
+# original module is kept referenced so Python 2 doesn't clear its globals.
+_module = sys.modules[__name__]
+sys.modules[__name__] = _LazyModule(__name__, __doc__)
+sys.modules[__name__].__dict__.update(_module.__dict__)
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+""" Checkpoints
+    On-disk checkpoints for staged conversions. Each checkpoint is keyed by a
+    hash of the input file contents, the stages that ran before it and the
+    settings the stage depends on, so changing a setting only invalidates the
+    stage that uses it and the stages downstream of it.
+"""
+import hashlib
+import os
+import pickle
+
+
+class Checkpoints(object):
+    def __init__(self, cacheDir=None):
+        self.cacheDir = cacheDir
+        if cacheDir is not None and not os.path.isdir(cacheDir):
+            os.makedirs(cacheDir)
+
+    def fileKey(self, filename):
+        """ Hash the contents of an input file.
+            Input: filename or stream
+            Output: hex digest, None if the input is not a file on disk
+        """
+        if (not isinstance(filename, basestring) or
+                not os.path.isfile(filename)):
+            return None
+        h = hashlib.sha1()
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+        return h.hexdigest()
+
+    def key(self, prevKey, stage, settings):
+        """ Chain the key of the previous stage with a stage's name and
+            settings.
+            Input: previous key, stage name, list of setting values
+            Output: hex digest, None if the previous key is None
+        """
+        if prevKey is None:
+            return None
+        settings = [sorted(v.items()) if isinstance(v, dict) else v for v in
+                    settings]
+        return hashlib.sha1(repr((prevKey, stage, settings))).hexdigest()
+
+    def _path(self, stage, key):
+        return os.path.join(self.cacheDir, stage + '-' + key + '.pickle')
+
+    def load(self, stage, key):
+        """ Load the state saved by a stage.
+            Input: stage name, stage key
+            Output: dict of attributes, None if there is no checkpoint
+        """
+        if self.cacheDir is None or key is None:
+            return None
+        filename = self._path(stage, key)
+        if not os.path.isfile(filename):
+            return None
+        with open(filename, 'rb') as f:
+            return pickle.load(f)
+
+    def save(self, stage, key, state):
+        """ Save the state produced by a stage.
+            Input: stage name, stage key, dict of attributes
+            Output: written checkpoint file
+        """
+        if self.cacheDir is None or key is None:
+            return
+        filename = self._path(stage, key)
+        # Write to a temporary file first so an interrupted run never leaves
+        # a truncated checkpoint behind
+        with open(filename + '.tmp', 'wb') as f:
+            pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+        if os.path.exists(filename):
+            os.remove(filename)
+        os.rename(filename + '.tmp', filename)
@@ -2,31 +2,62 @@ import numpy as np
 import math
 
 
+# Smallest cosine of the half angle at a miter join, limiting the miter
+# length to 4 times the offset distance at sharp corners
+MITER_LIMIT = 0.25
+
+
 def offsetParallel(points, distance, clockwise=True):
     """ Create a parallel offset of xy points a certain distance and
         direction from the original.
         Input: list of xy points, distance in meters, direction
-        Output: transformed list of xy points
-    """
-    def perp(a, dist, clockwise=True):
-        norm = a/np.linalg.norm(a, axis=1, keepdims=True)*dist
-        b = np.zeros_like(norm)
-        if clockwise:
-            b[:, 0] = norm[:, 1]
-            b[:, 1] = -norm[:, 0]
-        elif not clockwise:
-            b[:, 0] = -norm[:, 1]
-            b[:, 1] = norm[:, 0]
-        return b
-
-    tmp = np.array(points)
-    A=tmp.astype(np.float)
-    #print points	
-    #print "A is",A	
-    B = np.vstack([-A[1], A[0], A[1:-1]])
-    #print "B is",B
-    #print "A-B is", A-B 	
-    return np.array(perp(A-B, distance) + A, dtype='str')
+        Output: transformed array of xy points
+    """
+    points = np.asarray(points, dtype=float)
+    distance = distance if clockwise else -distance
+    return offsetParallelBatch(points, [0, len(points)], [distance])
+
+
+def offsetParallelBatch(points, offsets, distances):
+    """ Create parallel offsets of many polylines at once. Each point moves
+        along the normal of its segment, interior points along the miter
+        of the two segments meeting there.
+        Input: flat array of x,y,z points of all polylines, start index of
+               each polyline followed by the total number of points, signed
+               distance per polyline (positive is clockwise, i.e. to the
+               right of the direction of travel)
+        Output: flat array of offset x,y,z points
+    """
+    points = np.array(points, dtype=float)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    counts = np.diff(offsets)
+    n = len(points)
+    first = np.zeros(n, dtype=bool)
+    last = np.zeros(n, dtype=bool)
+    first[offsets[:-1][counts > 0]] = True
+    last[offsets[1:][counts > 0] - 1] = True
+    # Right hand normal of the segment starting at each point
+    seg = np.zeros((n, 2))
+    seg[:-1] = points[1:, :2] - points[:-1, :2]
+    length = np.hypot(seg[:, 0], seg[:, 1])
+    seg /= np.where(length == 0, 1, length)[:, None]
+    normal = np.column_stack([seg[:, 1], -seg[:, 0]])
+    # Segments don't continue across polylines
+    nextNormal = np.where(last[:, None], 0, normal)
+    prevNormal = np.zeros_like(normal)
+    prevNormal[1:] = normal[:-1]
+    prevNormal = np.where(first[:, None], 0, prevNormal)
+    miter = prevNormal + nextNormal
+    miterLength = np.hypot(miter[:, 0], miter[:, 1])
+    miter /= np.where(miterLength == 0, 1, miterLength)[:, None]
+    # Lengthen interior offsets so offset segments stay parallel
+    cos = np.where(first | last, 1.0,
+                   (miter * np.where(last[:, None], prevNormal,
+                                     nextNormal)).sum(axis=1))
+    cos = np.maximum(cos, MITER_LIMIT)
+    dist = np.repeat(np.asarray(distances, dtype=float), counts)
+    points[:, :2] += miter * (dist / cos)[:, None]
+    return points
 
 
 def offsetEndpoint(points, distance, beginning=True):
@@ -35,17 +66,399 @@ def offsetEndpoint(points, distance, beginning=True):
         Output: transformed list of nodes
     """
     if beginning:
-        a = np.array(points[1], dtype='float')
-        b = np.array(points[0], dtype='float')
+        a = np.asarray(points[1], dtype=float)
+        b = np.asarray(points[0], dtype=float)
     if not beginning:
-        a = np.array(points[-2], dtype='float')
-        b = np.array(points[-1], dtype='float')
+        a = np.asarray(points[-2], dtype=float)
+        b = np.asarray(points[-1], dtype=float)
     if np.sqrt(sum((b-a)**2)) < distance:
         distance = np.sqrt(sum((b-a)**2)) * 0.99
     db = (b-a) / np.linalg.norm(b-a) * distance
     return b - db
 
 
+def laneOffset(widths, lane, lanes):
+    """ Calculate the offset of a set of lanes from the link centerline.
+        Input: list of lane widths, lane number, total number of lanes
+               being connected
+        Output: clockwise direction and offset
+    """
+    width = [float(v) for v in widths]
+    centerline = sum(width) / 2.0
+    laneIdx = len(width) - lane
+    # beginning from the left, sum all lanes not being connected
+    left = sum(width[:laneIdx+1-lanes])
+    # median width of the lanes being connected
+    midpoint = sum(width[laneIdx+1-lanes:laneIdx+1]) / 2.0
+    if left + midpoint < centerline:
+        return False, centerline - left - midpoint
+    elif left + midpoint > centerline:
+        return True, left + midpoint - centerline
+    else:
+        return True, 0
+
+
+def connectorGeometry(fromPoints, fromWidths, fromLane, toPoints, toWidths,
+                      toLane, lanes, n=2):
+    """ Calculate connector end points from the geometry and lane widths of
+        the links being connected.
+        Input: from link's last two points, from link lane widths, from lane,
+               to link's first two points, to link lane widths, to lane,
+               number of lanes being connected, number of curve points
+        Output: list of x,y,z points
+    """
+    clockwise, fromDist = laneOffset(fromWidths, fromLane, lanes)
+    fromDist = fromDist if clockwise else -fromDist
+    clockwise, toDist = laneOffset(toWidths, toLane, lanes)
+    toDist = toDist if clockwise else -toDist
+    return list(connectorGeometryBatch([fromPoints], [fromDist], [toPoints],
+                                       [toDist], n)[0])
+
+
+def connectorGeometryBatch(fromPoints, fromDist, toPoints, toDist, n=2):
+    """ Calculate the geometry of many connectors at once. With more than
+        two points the connectors are drawn as quadratic bezier curves.
+        Input: array of from links' last two points, signed offset of the
+               connected from lanes, array of to links' first two points,
+               signed offset of the connected to lanes, number of points
+        Output: array of x,y,z points, one row per connector
+    """
+    fromPoints = np.asarray(fromPoints, dtype=float).reshape(-1, 2, 3)
+    toPoints = np.asarray(toPoints, dtype=float).reshape(-1, 2, 3)
+    m = len(fromPoints)
+    offsets = np.arange(0, 2 * m + 1, 2)
+    fromPoints = offsetParallelBatch(fromPoints.reshape(-1, 3), offsets,
+                                     fromDist).reshape(-1, 2, 3)
+    toPoints = offsetParallelBatch(toPoints.reshape(-1, 3), offsets,
+                                   toDist).reshape(-1, 2, 3)
+    return bezierBatch(fromPoints[:, 1], fromPoints[:, 1] - fromPoints[:, 0],
+                       toPoints[:, 0], toPoints[:, 1] - toPoints[:, 0], n)
+
+
+def bezierBatch(start, startDir, end, endDir, n):
+    """ Quadratic bezier curves from start to end points, tangent to the
+        direction of travel at both ends. The control point is where the
+        two tangents meet; when they are parallel or don't meet ahead of
+        the start and behind the end the curve is a straight line.
+        Input: arrays of start points, start directions, end points, end
+               directions, number of points per curve
+        Output: array of x,y,z points, one row per curve
+    """
+    start = np.asarray(start, dtype=float).reshape(-1, 3)
+    end = np.asarray(end, dtype=float).reshape(-1, 3)
+    startDir = np.asarray(startDir, dtype=float).reshape(-1, 3)
+    endDir = np.asarray(endDir, dtype=float).reshape(-1, 3)
+    gap = end - start
+
+    def cross(a, b):
+        return a[:, 0] * b[:, 1] - a[:, 1] * b[:, 0]
+
+    # Solve start + s * startDir = end - u * endDir
+    denom = cross(startDir, endDir)
+    safe = np.where(denom == 0, 1, denom)
+    s = cross(gap, endDir) / safe
+    u = cross(startDir, gap) / safe
+    # Distances to the control point as a fraction of the gap, so a control
+    # point further away than the gap (nearly parallel tangents) is rejected
+    dist = np.hypot(gap[:, 0], gap[:, 1])
+    dist = np.where(dist == 0, 1, dist)
+    reach = s * np.hypot(startDir[:, 0], startDir[:, 1]) / dist
+    back = u * np.hypot(endDir[:, 0], endDir[:, 1]) / dist
+    valid = (denom != 0) & (reach > 0) & (back > 0) & (reach <= 1) & \
+        (back <= 1)
+    control = np.where(valid[:, None], start + s[:, None] * startDir,
+                       (start + end) / 2.0)
+    control[:, 2] = (start[:, 2] + end[:, 2]) / 2.0
+    t = np.linspace(0, 1, num=n)[None, :, None]
+    return ((1 - t) ** 2 * start[:, None] + 2 * (1 - t) * t *
+            control[:, None] + t ** 2 * end[:, None])
+
+
+def offsetEndpointBatch(points, offsets, startDist, endDist):
+    """ Pull back the first and last points of many polylines at once in
+        order to create VISSIM intersections. A point is never pulled back
+        past its neighbor.
+        Input: flat array of x,y,z points of all polylines (at least two
+               points each), start index of each polyline followed by the
+               total number of points, pull back distance at the start and
+               end of each polyline
+        Output: flat array of x,y,z points
+    """
+    def pullBack(b, a, distance):
+        vec = b - a
+        length = np.sqrt((vec ** 2).sum(axis=1))
+        distance = np.where(length < distance, length * 0.99, distance)
+        return b - vec / np.where(length == 0, 1, length)[:, None] * \
+            distance[:, None]
+
+    points = np.array(points, dtype=float)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    starts, ends = offsets[:-1], offsets[1:] - 1
+    points[starts] = pullBack(points[starts], points[starts + 1],
+                              np.asarray(startDist, dtype=float))
+    points[ends] = pullBack(points[ends], points[ends - 1],
+                            np.asarray(endDist, dtype=float))
+    return points
+
+
+def repeatPolylines(offsets, polylines):
+    """ Select polylines from a flat array, possibly more than once.
+        Input: start index of each polyline followed by the total number of
+               points, index of the polyline to take for each output
+               polyline
+        Output: index of the points to take, offsets of the output polylines
+    """
+    offsets = np.asarray(offsets, dtype=np.int64)
+    polylines = np.asarray(polylines, dtype=np.int64)
+    counts = np.diff(offsets)[polylines]
+    newOffsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+    idx = (np.arange(newOffsets[-1]) - np.repeat(newOffsets[:-1], counts) +
+           np.repeat(offsets[polylines], counts))
+    return idx, newOffsets
+
+
+def laneGeometryBatch(points, offsets, widths):
+    """ Calculate the lane centerlines and lane boundaries of many links at
+        once, in a single parallel offset.
+        Input: flat array of x,y,z points of all link centerlines, start
+               index of each link followed by the total number of points,
+               list of lane widths per link beginning with lane 1 (the
+               rightmost lane)
+        Output: flat points and offsets of the lane centerlines (one
+                polyline per lane, links in order, lane 1 first), flat
+                points and offsets of the lane boundaries (lanes + 1
+                polylines per link, beginning with the right edge)
+    """
+    points = np.asarray(points, dtype=float)
+    lanes = np.array([len(w) for w in widths], dtype=np.int64)
+    width = np.array([float(v) for w in widths for v in w], dtype=float)
+    owner = np.repeat(np.arange(len(lanes)), lanes)
+    total = np.bincount(owner, weights=width, minlength=len(lanes))
+    # Distance from the right edge of its link to the left side of each lane
+    cum = np.cumsum(width)
+    start = np.concatenate([[0], np.cumsum(lanes)[:-1]]).astype(np.int64)
+    before = np.concatenate([[0.0], cum])[start]
+    left = cum - before[owner]
+    center = total[owner] / 2.0 - (left - width / 2.0)
+    edgeOwner = np.repeat(np.arange(len(lanes)), lanes + 1)
+    edgeLeft = np.zeros(len(edgeOwner))
+    edgeLeft[np.arange(len(width)) + owner + 1] = left
+    edge = total[edgeOwner] / 2.0 - edgeLeft
+    idx, newOffsets = repeatPolylines(offsets, np.concatenate([owner,
+                                                               edgeOwner]))
+    out = offsetParallelBatch(points[idx], newOffsets,
+                              np.concatenate([center, edge]))
+    split = newOffsets[len(owner)]
+    return (out[:split], newOffsets[:len(owner) + 1], out[split:],
+            newOffsets[len(owner):] - split)
+
+
+def cumulativeLengths(points, offsets):
+    """ Running length over many polylines, where the segments joining two
+        polylines have no length.
+        Input: flat array of x,y,z points of all polylines, start index of
+               each polyline followed by the total number of points
+        Output: array of the length up to each point
+    """
+    points = np.asarray(points, dtype=float)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    if len(points) == 0:
+        return np.zeros(0)
+    seg = np.sqrt(((points[1:] - points[:-1]) ** 2).sum(axis=1))
+    seg[offsets[1:-1][offsets[1:-1] > 0] - 1] = 0
+    return np.concatenate([[0.0], np.cumsum(seg)])
+
+
+def interpolateBatch(points, offsets, polylines, measures, cum=None):
+    """ Locate points at distances along many polylines. Distances are
+        clamped to the length of their polyline.
+        Input: flat array of x,y,z points of all polylines, start index of
+               each polyline followed by the total number of points, index
+               of the polyline of each point to locate, distance along it,
+               optional cumulative lengths (see cumulativeLengths)
+        Output: array of x,y,z points
+    """
+    points = np.asarray(points, dtype=float)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    polylines = np.asarray(polylines, dtype=np.int64)
+    if cum is None:
+        cum = cumulativeLengths(points, offsets)
+    first, last = offsets[polylines], offsets[polylines + 1] - 1
+    value = cum[first] + np.clip(measures, 0, cum[last] - cum[first])
+    j = np.searchsorted(cum, value, side='right') - 1
+    j = np.clip(j, first, np.maximum(last - 1, first))
+    nxt = np.minimum(j + 1, last)
+    length = cum[nxt] - cum[j]
+    t = (value - cum[j]) / np.where(length == 0, 1, length)
+    return points[j] + t[:, None] * (points[nxt] - points[j])
+
+
+def projectBatch(points, offsets, polylines, queries, cum=None):
+    """ Find the nearest point on many polylines, each query point against
+        the segments of its own polyline only.
+        Input: flat array of x,y,z points of all polylines, start index of
+               each polyline followed by the total number of points, index
+               of the polyline of each query point, array of x,y(,z) query
+               points, optional cumulative lengths (see cumulativeLengths)
+        Output: array of distances along the polylines to the nearest
+                points, array of x,y distances to them
+    """
+    points = np.asarray(points, dtype=float)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    polylines = np.asarray(polylines, dtype=np.int64)
+    queries = np.asarray(queries, dtype=float).reshape(len(polylines), -1)
+    if cum is None:
+        cum = cumulativeLengths(points, offsets)
+    if len(polylines) == 0:
+        return np.zeros(0), np.zeros(0)
+    first, last = offsets[polylines], offsets[polylines + 1] - 1
+    # Candidate (query, segment) pairs; a single point is its own segment
+    count = np.maximum(last - first, 1)
+    q = np.repeat(np.arange(len(polylines)), count)
+    j = (np.arange(count.sum()) - np.repeat(np.cumsum(count) - count, count) +
+         np.repeat(first, count))
+    nxt = np.minimum(j + 1, last[q])
+    a = points[j, :2]
+    vec = points[nxt, :2] - a
+    rel = queries[q, :2] - a
+    sq = (vec ** 2).sum(axis=1)
+    t = np.clip((rel * vec).sum(axis=1) / np.where(sq == 0, 1, sq), 0, 1)
+    dist = np.hypot(*(rel - t[:, None] * vec).T)
+    # Nearest segment of each query point
+    order = np.lexsort((dist, q))
+    best = order[np.concatenate([[True], q[order][1:] != q[order][:-1]])]
+    measure = cum[j[best]] + t[best] * (cum[nxt[best]] - cum[j[best]])
+    return measure - cum[first], dist[best]
+
+
+def simplifyBatch(points, offsets, tolerance):
+    """ Douglas-Peucker simplification of many polylines at once. Each
+        pass splits every open range of every polyline at its point furthest
+        from the range's chord, so the number of passes is the depth of the
+        recursion rather than the number of polylines.
+        Input: flat array of x,y(,z) points of all polylines, start index of
+               each polyline followed by the total number of points,
+               tolerance (x,y distance)
+        Output: boolean array, True for the points to keep (end points are
+                always kept)
+    """
+    points = np.asarray(points, dtype=float)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    counts = np.diff(offsets)
+    keep = np.zeros(len(points), dtype=bool)
+    keep[offsets[:-1][counts > 0]] = True
+    keep[offsets[1:][counts > 0] - 1] = True
+    starts = offsets[:-1][counts > 2]
+    ends = offsets[1:][counts > 2] - 1
+    while len(starts):
+        inner = ends - starts - 1
+        rng = np.repeat(np.arange(len(starts)), inner)
+        idx = (np.arange(inner.sum()) -
+               np.repeat(np.cumsum(inner) - inner, inner) +
+               np.repeat(starts + 1, inner))
+        a = points[starts[rng], :2]
+        vec = points[ends[rng], :2] - a
+        rel = points[idx, :2] - a
+        sq = (vec ** 2).sum(axis=1)
+        t = np.clip((rel * vec).sum(axis=1) / np.where(sq == 0, 1, sq), 0, 1)
+        dist = np.hypot(*(rel - t[:, None] * vec).T)
+        # Furthest point of each range
+        order = np.lexsort((-dist, rng))
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = rng[order][1:] != rng[order][:-1]
+        best = order[first]
+        split = dist[best] > tolerance
+        mid = idx[best][split]
+        keep[mid] = True
+        starts = np.concatenate([starts[split], mid])
+        ends = np.concatenate([mid, ends[split]])
+        wide = ends - starts > 1
+        starts, ends = starts[wide], ends[wide]
+    return keep
+
+
+def remapMeasures(points, offsets, keep, polylines, measures):
+    """ Map distances along polylines to distances along the polylines of
+        their kept points (see simplifyBatch). A distance between two kept
+        points keeps its fraction of that stretch, so positions at kept
+        points do not move relative to them.
+        Input: flat array of x,y,z points of all polylines, start index of
+               each polyline followed by the total number of points, boolean
+               array of kept points (including all end points), index of the
+               polyline of each distance, distance along it
+        Output: array of distances along the simplified polylines
+    """
+    points = np.asarray(points, dtype=float)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    polylines = np.asarray(polylines, dtype=np.int64)
+    cum = cumulativeLengths(points, offsets)
+    kept = np.flatnonzero(keep)
+    # Cumulative length over the kept points, again without the segments
+    # joining two polylines
+    owner = np.searchsorted(offsets, kept, side='right') - 1
+    newSeg = np.sqrt(((points[kept[1:]] - points[kept[:-1]]) ** 2).sum(axis=1))
+    newSeg[owner[1:] != owner[:-1]] = 0
+    newCum = np.concatenate([[0.0], np.cumsum(newSeg)])
+    first, last = offsets[polylines], offsets[polylines + 1] - 1
+    value = cum[first] + np.clip(measures, 0, cum[last] - cum[first])
+    keptFirst = np.searchsorted(kept, first)
+    keptLast = np.searchsorted(kept, last)
+    j = np.searchsorted(cum[kept], value, side='right') - 1
+    j = np.clip(j, keptFirst, np.maximum(keptLast - 1, keptFirst))
+    nxt = np.minimum(j + 1, keptLast)
+    span = cum[kept[nxt]] - cum[kept[j]]
+    t = (value - cum[kept[j]]) / np.where(span == 0, 1, span)
+    return newCum[j] + t * (newCum[nxt] - newCum[j]) - newCum[keptFirst]
+
+
+def clipPolylines(points, offsets, bounds):
+    """ Clip many polylines to a rectangle at once (Liang-Barsky on every
+        segment). A polyline leaving and re-entering the rectangle becomes
+        several parts.
+        Input: flat array of x,y(,z) points of all polylines, start index of
+               each polyline followed by the total number of points, min x,
+               min y, max x, max y
+        Output: flat array of points of the parts, start index of each part
+                followed by the total number of points, index of the source
+                polyline of each part
+    """
+    points = np.asarray(points, dtype=float)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    counts = np.diff(offsets)
+    owner = np.repeat(np.arange(len(counts)), counts)
+    # Segments start at every point except the last of each polyline
+    start = np.ones(len(points), dtype=bool)
+    start[offsets[1:][counts > 0] - 1] = False
+    seg = np.flatnonzero(start)
+    p0, p1 = points[seg], points[seg + 1]
+    d = p1 - p0
+    xmin, ymin, xmax, ymax = bounds
+    t0, t1 = np.zeros(len(seg)), np.ones(len(seg))
+    inside = np.ones(len(seg), dtype=bool)
+    for p, q in ((-d[:, 0], p0[:, 0] - xmin), (d[:, 0], xmax - p0[:, 0]),
+                 (-d[:, 1], p0[:, 1] - ymin), (d[:, 1], ymax - p0[:, 1])):
+        parallel = p == 0
+        inside &= ~(parallel & (q < 0))
+        r = q / np.where(parallel, 1, p)
+        t0 = np.where(~parallel & (p < 0), np.maximum(t0, r), t0)
+        t1 = np.where(~parallel & (p > 0), np.minimum(t1, r), t1)
+    inside &= t0 <= t1
+    seg, p0, d, t0, t1 = seg[inside], p0[inside], d[inside], t0[inside], \
+        t1[inside]
+    a = p0 + t0[:, None] * d
+    b = p0 + t1[:, None] * d
+    # A part starts where the previous segment isn't kept or was cut
+    newPart = np.ones(len(seg), dtype=bool)
+    newPart[1:] = ((seg[1:] != seg[:-1] + 1) | (t1[:-1] < 1) | (t0[1:] > 0) |
+                   (owner[seg[1:]] != owner[seg[:-1]]))
+    posB = np.cumsum(1 + newPart) - 1
+    out = np.zeros((len(seg) + newPart.sum(), points.shape[1]))
+    out[posB] = b
+    out[posB[newPart] - 1] = a[newPart]
+    partOffsets = np.append(posB[newPart] - 1, len(out)).astype(np.int64)
+    return out, partOffsets, owner[seg[newPart]]
+
+
 def bezier(origin, destination, n):
     """ Bezier spline interpolation """
     if origin == destination:
@@ -79,6 +492,26 @@ def bezier(origin, destination, n):
         return zip(Bx, By, Bz)
 
 
+def compassBearing(lat1, lng1, lat2, lng2):
+    """ Calculate the initial compass bearing from point A to point B for
+        arrays of lat/lng pairs. Source:
+        https://gist.github.com/jeromer/2005586
+        Input: lat/lng arrays of points A and B in degrees
+        Output: array of bearings in degrees
+    """
+    lat1 = np.radians(np.asarray(lat1, dtype=float))
+    lat2 = np.radians(np.asarray(lat2, dtype=float))
+    diffLng = np.radians(np.asarray(lng2, dtype=float) -
+                         np.asarray(lng1, dtype=float))
+    x = np.sin(diffLng) * np.cos(lat2)
+    y = (np.cos(lat1) * np.sin(lat2) - (np.sin(lat1) * np.cos(lat2) *
+         np.cos(diffLng)))
+    # np.arctan2 returns values from -180 to +180, normalize them to a
+    # compass bearing
+    initial = np.degrees(np.arctan2(x, y))
+    return np.round((initial + 360) % 360, 1)
+
+
 def inRange(p,q,r):
     """
 	return true iff q is between p and r
@@ -91,15 +524,22 @@ def getDistance(point1, point2):
 	point1 and point2 to be x,y,z coordinates
 	Returns the length of the segment between the two points
     """
-    tmp1= np.array(point1)
-    x1,y1,z1 = tmp1.astype(np.float)
-    tmp2= np.array(point2)
-    x2,y2,z2 = tmp2.astype(np.float)
+    x1, y1, z1 = point1
+    x2, y2, z2 = point2
     d = (x2-x1) **2 + (y2-y1)** 2 + (z2-z1)**2
     dist = math.sqrt(d)
     return dist
 
 
+def getLength(points):
+    """ Calculate the length of a polyline.
+        Input: list of x,y,z points
+        Output: length in meters
+    """
+    points = np.asarray(points, dtype=float)
+    return np.sqrt(((points[1:] - points[:-1]) ** 2).sum(axis=1)).sum()
+
+
 def getNearestPointOnLine(point1, line):
     """
 	point1 is a given point
@@ -107,13 +547,13 @@ def getNearestPointOnLine(point1, line):
 	find the point on line where perp drawn from point1 meets the line
     """
     # first convert line to normalized unit vector
-    ptA = (np.array(line[0])).astype(np.float)
-    ptB = (np.array(line[1])).astype(np.float)
+    ptA = np.asarray(line[0], dtype=float)
+    ptB = np.asarray(line[1], dtype=float)
     x1,y1,z1 = ptA
     x2,y2,z2 = ptB
     #
     sepVec = ptA - ptB
-    x3,y3,z3 = (np.array(point1).astype(np.float))
+    x3,y3,z3 = point1
     mag = np.sqrt(sepVec.dot(sepVec))
     dx=sepVec[0]
     dy=sepVec[1]
@@ -138,8 +578,8 @@ def getNearestPointOnSegment(point1, segment):
 	find the point on segment where perp drawn from point1 meets the segment
 	if the nearest point lies outside the segment, return nan
     """
-    ptA = (np.array(segment[0])).astype(np.float)
-    ptB = (np.array(segment[1])).astype(np.float)
+    ptA = np.asarray(segment[0], dtype=float)
+    ptB = np.asarray(segment[1], dtype=float)
     x1,y1,z1 = ptA
     x2,y2,z2 = ptB
     x3,y3,z3 =  getNearestPointOnLine(point1, segment)
@@ -12,6 +12,9 @@ import copy
 import networkx
 
 import sys
+from progress import getLogger
+
+log = getLogger(__name__)
 
 highway_cat = 'motorway|trunk|primary|secondary|tertiary|road|residential|service|motorway_link|trunk_link|primary_link|secondary_link|teriary_link'
 
@@ -38,24 +41,26 @@ def download_osm(left,bottom,right,top,highway_cat):
     from urllib import urlopen
     # fp = urlopen( "http://api.openstreetmap.org/api/0.6/map?bbox=%f,%f,%f,%f"%(left,bottom,right,top) )
     # fp = urlopen( "http://www.overpass-api.de/api/xapi?way[highway=*][bbox=%f,%f,%f,%f]"%(left,bottom,right,top) )
-    print "trying to download osm data from "+str(left),str(bottom),str(right),str(top)+" with highways of categories"+highway_cat
+    log.info("trying to download osm data from %s %s %s %s with highways of categories%s", left, bottom, right, top, highway_cat)
     try:
-        print "downloading osm data from "+str(left),str(bottom),str(right),str(top)+" with highways of categories"+highway_cat
+        log.info("downloading osm data from %s %s %s %s with highways of categories%s", left, bottom, right, top, highway_cat)
         fp = urlopen( "http://www.overpass-api.de/api/xapi?way[highway=%s][bbox=%f,%f,%f,%f]"%(highway_cat,left,bottom,right,top) )
         # slooww only ways,and in ways only "highways" (i.e. roads)
         # fp = urlopen( "http://open.mapquestapi.com/xapi/api/0.6/way
         # [highway=*][bbox=%f,%f,%f,%f]"%(left,bottom,right,top) )
         return fp
     except:
-        print "osm data download unsuccessful"
+        log.error("osm data download unsuccessful")
 
 
-def read_osm(filename_or_stream, only_roads=True):
+def read_osm(filename_or_stream, only_roads=True, includeBusStops=None):
     """Read graph in OSM format from file specified by name or by stream object.
 
     Parameters
     ----------
     filename_or_stream : filename or stream object
+    includeBusStops : keep bus stop nodes, defaults to the
+    --include-bus-stops command line flag
 
     Returns
     -------
@@ -68,29 +73,14 @@ def read_osm(filename_or_stream, only_roads=True):
     >>> plot([G.node[n]['data'].lat for n in G], [G.node[n]['data'].lon for n
         in G], ',')
     """
-    osm = OSM(filename_or_stream)
+    osm = OSM(filename_or_stream, includeBusStops)
     G = networkx.DiGraph()
 
-    def addEdges(w):
-        attr = w.tags
-        attr['id'] = w.id
-        if w.tags.get('highway') != 'footway':
-            if w.tags.get('oneway') == '-1':
-                G.add_path(reversed(w.nds), **attr)
-            else:
-                G.add_path(w.nds, **attr)
-            """
-            if 'oneway' not in w.tags and w.tags['highway'] != 'motorway':
-                G.add_path(reversed(w.nds), **attr)
-            elif (w.tags['oneway'] != 'yes' and w.tags['oneway'] != '-1' and
-                  w.tags['highway'] != 'motorway'):
-                G.add_path(reversed(w.nds), **attr)"""
-
     for w in osm.ways.itervalues():
         # Skip w if no highway tag
         if only_roads and 'highway' not in w.tags:
             continue
-        addEdges(w)
+        add_way_edges(G, w)
 
     #RV
     #print '>> Num of nodes in G is %d' %(len(G.nodes()))
@@ -102,7 +92,7 @@ def read_osm(filename_or_stream, only_roads=True):
 		c += 1
 	pass
     pass
-    print "Number of busstop nodes is %d" %(c)
+    log.info('Number of busstop nodes is %d', c)
     
     for n_id in G.nodes_iter():
         n = osm.nodes[n_id]
@@ -110,6 +100,163 @@ def read_osm(filename_or_stream, only_roads=True):
     return G, osm
 
 
+def add_way_edges(G, w):
+    """Add the edges of a (split) way to the graph, in the direction of
+    travel for oneway=-1 ways."""
+    attr = w.tags
+    attr['id'] = w.id
+    if w.tags.get('highway') != 'footway':
+        if w.tags.get('oneway') == '-1':
+            G.add_path(reversed(w.nds), **attr)
+        else:
+            G.add_path(w.nds, **attr)
+        """
+        if 'oneway' not in w.tags and w.tags['highway'] != 'motorway':
+            G.add_path(reversed(w.nds), **attr)
+        elif (w.tags['oneway'] != 'yes' and w.tags['oneway'] != '-1' and
+              w.tags['highway'] != 'motorway'):
+            G.add_path(reversed(w.nds), **attr)"""
+
+
+def way_edges(w):
+    """Edges a (split) way adds to the graph."""
+    nds = list(reversed(w.nds)) if w.tags.get('oneway') == '-1' else w.nds
+    return zip(nds[:-1], nds[1:])
+
+
+def read_osc(filename_or_stream, includeBusStops=None):
+    """Read an OSM change file.
+
+    Parameters
+    ----------
+    filename_or_stream : filename or stream object of an .osc file
+    includeBusStops : keep bus stop nodes, defaults to the
+    --include-bus-stops command line flag
+
+    Returns
+    -------
+    change : dict with the created or modified 'nodes' and 'ways' keyed by
+    id and the ids of 'deleted' nodes and ways
+    """
+    if includeBusStops is None:
+        includeBusStops = gIncBusStop
+    change = {'nodes': {}, 'ways': {}, 'deleted': {'node': set(),
+                                                   'way': set()}}
+    root = etree.parse(filename_or_stream).getroot()
+    for action in root:
+        for elem in action:
+            if elem.tag not in ('node', 'way'):
+                continue
+            if action.tag == 'delete':
+                change['deleted'][elem.tag].add(elem.get('id'))
+                continue
+            tags = {t.get('k'): t.get('v') for t in elem.iterfind('tag')}
+            if elem.tag == 'node':
+                if (includeBusStops and tags.get('highway') == 'bus_stop' and
+                        'asset_ref' in tags):
+                    node = BusStopNode(elem.get('id'), float(elem.get('lon')),
+                                       float(elem.get('lat')))
+                else:
+                    node = Node(elem.get('id'), float(elem.get('lon')),
+                                float(elem.get('lat')))
+                node.tags.update(tags)
+                change['nodes'][node.id] = node
+            else:
+                way = Way(elem.get('id'), None)
+                way.nds = [nd.get('ref') for nd in elem.iterfind('nd')]
+                way.tags.update(tags)
+                change['ways'][way.id] = way
+    return change
+
+
+def update_osm(G, osm, change, only_roads=True):
+    """Apply an OSM change to a graph and its OSM struct in place. Only the
+    changed ways and the ways they split or stop splitting are re-split.
+
+    Parameters
+    ----------
+    G : Graph from read_osm
+    osm : struct from read_osm
+    change : dict from read_osc
+
+    Returns
+    -------
+    oldWays : list of split ways that were removed
+    newWays : list of split ways that were added
+    moved : set of graph nodes whose location changed
+    """
+    histogram = osm.node_histogram
+    # Original (unsplit) ways changed by the edit
+    changed = set(change['ways']) | change['deleted']['way']
+    old = {}
+    for wayID in changed:
+        way = osm.base_way(wayID)
+        if way is not None:
+            old[wayID] = way
+    for node in change['nodes'].itervalues():
+        osm.nodes[node.id] = node
+        histogram.setdefault(node.id, 0)
+    moved = set()
+    for nodeID in change['nodes']:
+        if nodeID in G.node:
+            G.node[nodeID] = dict(lon=osm.nodes[nodeID].lon,
+                                  lat=osm.nodes[nodeID].lat)
+            moved.add(nodeID)
+    counts = {}
+    for wayID in changed:
+        before = old[wayID].nds if wayID in old else []
+        way = change['ways'].get(wayID)
+        after = way.nds if way is not None and len(way.nds) > 1 else []
+        for nd, step in [(n, -1) for n in before] + [(n, 1) for n in after]:
+            counts.setdefault(nd, histogram.get(nd, 0))
+            histogram[nd] = histogram.get(nd, 0) + step
+    # Nodes that only divide ways before or after the change
+    dividers = {nd for nd, count in counts.items() if
+                (count > 1) != (histogram[nd] > 1)}
+    # Unchanged ways that are split differently now
+    for nd in dividers:
+        if nd not in G.node:
+            continue
+        for u, v in G.out_edges(nd) + G.in_edges(nd):
+            wayID = G.edge[u][v]['id'].rsplit('-', 1)[0]
+            if wayID not in changed:
+                changed.add(wayID)
+                old[wayID] = osm.base_way(wayID)
+    oldWays, newWays = [], []
+    for wayID in changed:
+        if wayID in old:
+            for splitWay in osm.split_ways(wayID):
+                del osm.ways[splitWay.id]
+                oldWays.append(splitWay)
+                for u, v in way_edges(splitWay):
+                    if (G.has_edge(u, v) and
+                            G.edge[u][v].get('id') == splitWay.id):
+                        G.remove_edge(u, v)
+        if wayID in change['deleted']['way']:
+            continue
+        way = change['ways'].get(wayID, old.get(wayID))
+        if way is None or len(way.nds) < 2:
+            continue
+        way.osm = osm
+        for splitWay in way.split(histogram):
+            osm.ways[splitWay.id] = splitWay
+            if only_roads and 'highway' not in splitWay.tags:
+                continue
+            add_way_edges(G, splitWay)
+            newWays.append(splitWay)
+            for n in splitWay.nds:
+                if 'lat' not in G.node[n]:
+                    G.node[n] = dict(lon=osm.nodes[n].lon,
+                                     lat=osm.nodes[n].lat)
+    for splitWay in oldWays:
+        for n in splitWay.nds:
+            if n in G.node and G.degree(n) == 0:
+                G.remove_node(n)
+    for nodeID in change['deleted']['node']:
+        osm.nodes.pop(nodeID, None)
+    return oldWays, newWays, moved
+
+
 class Node(object):
     def __init__(self, id, lon, lat ):
         self.id = id
@@ -160,8 +307,11 @@ class Way:
 
 
 class OSM:
-    def __init__(self, filename_or_stream):
+    def __init__(self, filename_or_stream, includeBusStops=None):
         """ File can be either a filename or stream/file object."""
+        if includeBusStops is None:
+            includeBusStops = gIncBusStop
+        self.includeBusStops = includeBusStops
         nodes = {}
         ways = {}
 	busStops = {} # these are from NonWayNodes
@@ -177,7 +327,7 @@ class OSM:
             def start(self, name, attrs):
     	    	try:
                 	if attrs['action'].startswith("delete"):
-                    		print "Deleting %s" %(attrs['id'])
+                    		log.debug("Deleting %s", attrs['id'])
 				return  # ignore this element 
 			pass
     	    	except:
@@ -189,11 +339,11 @@ class OSM:
 				self.saveFirstNode = True
                     		self.currElem.tags.update({'addBusstop': False})
                 	elif name == 'tag':
-				if ((gIncBusStop == True) and ( (type(self.currElem) == Node) and attrs['v'] == 'bus_stop')):
-					print 'Add bus stop node %s ' %(self.currElem.id)
+				if ((superself.includeBusStops == True) and ( (type(self.currElem) == Node) and attrs['v'] == 'bus_stop')):
+					log.debug('Add bus stop node %s', self.currElem.id)
                     			self.currElem.tags.update({'addBusstop': True})
-				elif ((gIncBusStop == True) and ( isinstance(self.currElem, Way) and attrs['v'] == 'bus_stop')): # sometimes, busstops were found marked on a nd referred to by a way 
-					print 'Found Way/busstop'
+				elif ((superself.includeBusStops == True) and ( isinstance(self.currElem, Way) and attrs['v'] == 'bus_stop')): # sometimes, busstops were found marked on a nd referred to by a way 
+					log.debug('Found Way/busstop')
                     			lastitm = self.currElem.nds[-1]
                     			self.currElem.nds.remove(lastitm)
                     			self.currElem.tags.update({'addBusstop': True})
@@ -215,7 +365,7 @@ class OSM:
 					newNode.tags.update(tmpNode.tags)
 					#print 'In end(): node %s %s at %f %f' % (newNode.id, newNode.tags['asset_ref'], newNode.lat, newNode.lon)
 				else:
-					print 'Bus stop without bus stop id -- skip'
+					log.debug('Bus stop without bus stop id -- skip')
 				pass
 		    pass
                     nodes[self.currElem.id] = newNode
@@ -248,6 +398,27 @@ class OSM:
             for split_way in split_ways:
                 new_ways[split_way.id] = split_way
         self.ways = new_ways
+        self.node_histogram = node_histogram
+
+    def split_ways(self, wayID):
+        """ Split ways of an original way, in order. """
+        ways = []
+        while '%s-%d' % (wayID, len(ways)) in self.ways:
+            ways.append(self.ways['%s-%d' % (wayID, len(ways))])
+        return ways
+
+    def base_way(self, wayID):
+        """ Rebuild an original way from its split ways, None if there is no
+        such way. """
+        ways = self.split_ways(wayID)
+        if not ways:
+            return None
+        way = copy.copy(ways[0])
+        way.id = wayID
+        way.nds = list(ways[0].nds)
+        for splitWay in ways[1:]:
+            way.nds.extend(splitWay.nds[1:])
+        return way
 
         #print '--Num of nodes is %d' %(len(self.nodes))
         #print '--Num of bus stops is %d' %(self.BsCount)
@@ -1,17 +1,28 @@
 #!/usr/bin/env python
 # OSM to VISSIM converter
 from vissim_objs import Vissim
+from vissim_to_geojson import GeoJSON
 import networkx as nx
-from osm_to_graph import read_osm
+from osm_to_graph import read_osm, read_osc, update_osm, way_edges
 from osm_to_graph import BusStopNode
 from collections import OrderedDict
 import geo_math as geo
+import projection as proj
+import spatial
+import argparse
+import glob
 import math
-import vissim_v8 as vissim
-import matplotlib.pyplot as plt
+import multiprocessing
+import os
 import numpy as np
 import sys
-import pickle
+import time
+import traceback
+from checkpoint import Checkpoints
+from progress import configureLogging, getLogger, startProgress, \
+    NULL_PROGRESS
+
+log = getLogger(__name__)
 
 
 #my added
@@ -19,65 +30,153 @@ osmFile = "map.osm"
 
 highway_cat = 'motorway|trunk|primary|secondary|tertiary|road|residential|service|motorway_link|trunk_link|primary_link|secondary_link|teriary_ilnk'
 
+# Node roles assigned by OSM.classifyNodes
+INTERIOR, EXTERIOR, INTERSECTION = 0, 1, 2
 
+ROAD_TYPES = ['motorway', 'motorway_link', 'primary', 'secondary', 'tertiary',
+              'traffic_signals', 'bus_stop']
+
+# Bearing difference ranges (degrees) used to classify turning movements
+TURN_ANGLES = {'thruMin': 135, 'thruMax': -135, 'leftMin': -135,
+               'leftMax': -45, 'rightMin': 45, 'rightMax': 135}
+
+# Maximum distance (meters) from a bus stop to the way it is snapped to
+BUS_STOP_DISTANCE = 25.0
 
 
-def stringify(iterable):
-    """ Convert tuple containing numbers to string
-        Input: iterable with numbers as values
-        Output: tuple with strings as values
-    """
-    return tuple([str(i) for i in iterable])
-                                                                                
-                                                                                
- 
 class OSM(Vissim):
-    def __init__(self, osmFile ):
-
-        self.includeBusStops = '--include-bus-stops' in sys.argv  #RV
-        self.G, self.osm = read_osm(osmFile)
-	#RV
-	c = 0
-    	for n in self.osm.nodes:
-		if (type(self.osm.nodes[n]) is BusStopNode):
-			c += 1
-		pass
-	pass
-	print "Number of bs nodes is %d" %(c)
-        self.v = Vissim()
-        self.roadTypes = ['motorway', 'motorway_link', 'primary', 'secondary',
-                          'tertiary', 'traffic_signals', 'bus_stop']
+    # Conversion stages in order: (name, method, attributes saved in the
+    # stage's checkpoint, settings the stage depends on). A stage method
+    # either sets its attributes or returns the value of the first one. The
+    # export stage is never checkpointed.
+    stages = [('parse', 'parse', ('G', 'osm'), ('includeBusStops',)),
+              ('graph', 'prepareGraph', ('G', 'shapeNodes', 'refLat',
+                                         'refLng', 'refX', 'refY', 'ref',
+                                         'nodeList', 'nodeIndex',
+                                         'nodeRoles', 'intersectionNodes',
+                                         'nodeXY'), ('contract',
+                                                     'clusterRadius')),
+              ('intersections', 'createIntersectionDict', ('intersections',),
+               ('roadTypes',)),
+              ('ways', 'createWaysDict', ('ways',), ('roadTypes',)),
+              ('xy', 'createXYDict', ('xy', 'ways'), ('laneWidth',
+                                                      'turnAngles')),
+              ('links', 'importLinks', ('linkRecords',), ('laneWidth',)),
+              ('connectors', 'importConnectors', ('connectorRecords',),
+               ('curvePoints',)),
+              ('ptstops', 'importPTStops', ('ptStopRecords',),
+               ('includeBusStops',)),
+              ('export', 'exportModel', None, ('outFile',))]
+    # Progress of the running stage, see runStages
+    stageProgress = NULL_PROGRESS
+
+    def __init__(self, osmFile, outFile='testxml.inpx', cacheDir=None,
+                 laneWidth=3.6, roadTypes=None, turnAngles=None,
+                 includeBusStops=False, curvePoints=2, workers=1,
+                 tileSize=None, contract=False, clusterRadius=0,
+                 progress=True):
+        self.osmFile = osmFile
+        self.outFile = outFile
+        self.includeBusStops = includeBusStops
+        self.laneWidth = laneWidth
+        self.curvePoints = curvePoints
+        self.workers = workers
+        self.tileSize = tileSize
+        self.contract = contract
+        self.clusterRadius = clusterRadius
+        self.progress = progress
+        self.metrics = OrderedDict()
+        self.shapeNodes = {}
+        self.roadTypes = list(roadTypes or ROAD_TYPES)
+        self.turnAngles = dict(TURN_ANGLES, **(turnAngles or {}))
+        self.turnCache = {}
+        self.crossStreetCache = {}
+        self.checkpoints = Checkpoints(cacheDir)
+        self.runStages()
+
+    def runStages(self):
+        """ Run the conversion stages in order. A stage is loaded from its
+            checkpoint when the input file, the upstream stages and the
+            settings it depends on are unchanged.
+            Input: None
+            Output: converted model written to outFile, metrics of the stages
+                    that ran
+        """
+        key = self.checkpoints.fileKey(self.osmFile)
+        for name, method, attrs, settings in self.stages:
+            key = self.checkpoints.key(key, name, [getattr(self, s) for s in
+                                                   settings])
+            state = None if attrs is None else self.checkpoints.load(name, key)
+            if state is not None:
+                log.info('Loaded %s stage from checkpoint', name)
+                self.__dict__.update(state)
+                continue
+            self.stageProgress = startProgress(name, enabled=self.progress)
+            try:
+                result = getattr(self, method)()
+            finally:
+                metrics = self.stageProgress.close()
+                self.stageProgress = NULL_PROGRESS
+            if metrics is not None:
+                self.metrics[name] = metrics
+            if result is not None:
+                setattr(self, attrs[0], result)
+            if attrs is not None:
+                self.checkpoints.save(name, key, {a: getattr(self, a) for a
+                                                  in attrs})
+
+    def parse(self):
+        """ Read the OSM file in to a graph.
+        """
+        self.G, self.osm = read_osm(self.osmFile,
+                                    includeBusStops=self.includeBusStops)
+        self.stageProgress.update(len(self.osm.ways))
+        c = 0
+        for n in self.osm.nodes:
+            if (type(self.osm.nodes[n]) is BusStopNode):
+                c += 1
+        log.info('Number of bs nodes is %d', c)
+
+    def prepareGraph(self):
+        """ Set the coordinate reference point and classify graph nodes.
+        """
         self.refLat, self.refLng = self.getRefLatLng()
-        self.refX, self.refY = self.latLngToMeters(self.refLat, self.refLng)
-        self.intersections = self.createIntersectionDict()
-        self.ways = self.createWaysDict()
-	if ( "--loadXYDict" not in sys.argv):
-        	self.xy = self.createXYDict()
-		fh = open('xydict.pickle','wb')
-		pickle.dump(self.xy,open('xydict.pickle','wb'))
-		fh.close()
-	else:
-		self.xy = pickle.load(open('xydict.pickle','r'))
-
-	#RV 
-	self.importLinks()
-        if ( self.includeBusStops == True):
-		self.processBusStops()
-	self.importConnectors()
-        
-        
-        self.v.createReference(self.refX, self.refY)
-        self.v.export("testxml.inpx")
+        if self.contract:
+            self.contractGraph()
+        self.ref = proj.RefPoint(self.refLat, self.refLng)
+        self.refX, self.refY = self.ref.x, self.ref.y
+        self.classifyNodes()
+        self.nodeXY = self.projectNodes()
+        if self.clusterRadius and self.clusterIntersections():
+            self.classifyNodes()
+            self.nodeXY = self.projectNodes()
+        self.stageProgress.update(len(self.nodeList))
 
-        
-        
-        '''
-        plt.ylim(-1.0, 1.0);
-        x = np.linspace(0, 10, 1000)
-        plt.plot(x, 2*np.sin(x*5));
-        plt.show()        
-        '''
+    def importPTStops(self):
+        """ Create PT stop records from OSM bus stops when they are included.
+        """
+        if self.includeBusStops:
+            return self.processBusStops()
+        return []
 
+    def exportModel(self):
+        """ Build the model from the link, connector and PT stop records in
+            one pass, add the coordinate reference and write it to outFile.
+            Nothing is exported without an outFile, e.g. when the conversion
+            is only loaded to apply changes to an existing model.
+        """
+        if self.outFile is None:
+            return
+        self.v = Vissim()
+        self.v.defaultWidth = self.laneWidth
+        self.v.Links.createLinks(self.linkRecords.values())
+        self.v.Links.createConnectors(self.connectorRecords)
+        self.v.PTStop.createptStops(self.ptStopRecords)
+        self.v.createReference(self.refX, self.refY)
+        self.v.export(self.outFile)
+        self.stageProgress.update(len(self.linkRecords) +
+                                  len(self.connectorRecords) +
+                                  len(self.ptStopRecords))
 
     # Create reference point
     def getRefLatLng(self):
@@ -88,6 +187,87 @@ class OSM(Vissim):
         latlng = self.G.node.itervalues().next()
         return latlng['lat'], latlng['lon']
 
+    def contractGraph(self):
+        """ Contract chains of nodes with a single predecessor and successor
+            on the same way into single edges. The contracted nodes are kept
+            in order as the edge's 'shape' and their locations in shapeNodes,
+            so way geometry is unchanged.
+            Input: graph
+            Output: contracted graph, dict of shape node lat/lng
+        """
+        G = self.G
+        nodes, edges = G.number_of_nodes(), G.number_of_edges()
+        for n in G.nodes():
+            if G.in_degree(n) != 1 or G.out_degree(n) != 1:
+                continue
+            p, s = G.predecessors(n)[0], G.successors(n)[0]
+            if p == s or G.has_edge(p, s):
+                continue
+            inAttr, outAttr = G.edge[p][n], G.edge[n][s]
+            if ({k: v for k, v in inAttr.items() if k != 'shape'} !=
+                    {k: v for k, v in outAttr.items() if k != 'shape'}):
+                continue
+            attr = dict(inAttr, shape=inAttr.get('shape', []) + [n] +
+                        outAttr.get('shape', []))
+            self.shapeNodes[n] = self.getLatLng(n)
+            G.remove_node(n)
+            G.add_edge(p, s, attr)
+        log.info('Contracted graph from %d nodes/%d edges to %d nodes/%d '
+                 'edges', nodes, edges, G.number_of_nodes(),
+                 G.number_of_edges())
+
+    def clusterIntersections(self):
+        """ Merge intersection nodes within clusterRadius meters of each
+            other (e.g. where dual carriageways cross) into one junction at
+            their centroid. Edges between merged nodes are dropped, all other
+            edges are moved to the junction node.
+            Input: graph, classified and projected nodes
+            Output: updated graph, number of merged nodes
+        """
+        G = self.G
+        nodes = sorted(self.intersectionNodes)
+        xy = self.nodeXY[[self.nodeIndex[n] for n in nodes]]
+        labels = spatial.clusterPoints(xy, self.clusterRadius)
+        position = {n: i for i, n in enumerate(nodes)}
+        clusters = {}
+        for n, label in zip(nodes, labels):
+            clusters.setdefault(label, []).append(n)
+        merged = 0
+        for label in sorted(clusters):
+            members = clusters[label]
+            if len(members) < 2:
+                continue
+            junction = members[0]
+            members = set(members)
+            x, y = xy[[position[n] for n in members]].mean(axis=0)
+            lat, lng = self.ref.fromScaledMeters(x, y)
+            G.node[junction].update(lat=float(lat), lon=float(lng))
+            for n in members - {junction}:
+                for p in G.predecessors(n):
+                    if p not in members:
+                        self.moveEdge(p, junction, G.edge[p][n])
+                for q in G.successors(n):
+                    if q not in members:
+                        self.moveEdge(junction, q, G.edge[n][q])
+                G.remove_node(n)
+                merged += 1
+        log.info('Merged %d intersection nodes in to %d junctions', merged,
+                 sum(1 for m in clusters.values() if len(m) > 1))
+        return merged
+
+    def moveEdge(self, u, v, attr):
+        """ Add an edge moved to a junction node. The graph holds a single
+            edge per node pair, so if u and v are already connected the
+            moved edge is merged in to the existing one and logged.
+            Input: edge end nodes, edge attributes
+            Output: updated graph
+        """
+        if self.G.has_edge(u, v):
+            log.warning('Merged way %s in to way %s between nodes %s and %s',
+                        attr.get('id'), self.G.edge[u][v].get('id'), u, v)
+        else:
+            self.G.add_edge(u, v, attr)
+
     # Boolean helper functions
     def isOneway(self, attr):
         """ Determine if link is oneway based on OSM attributes.
@@ -121,110 +301,126 @@ class OSM(Vissim):
         else:
             return True
 
+    def classifyNodes(self):
+        """ Classify every node as an intersection, exterior or interior node
+            in a single pass over the edge list, so the traversals don't have
+            to enumerate neighbors for each visited edge.
+            Input: graph
+            Output: node index, role array and intersection node set
+        """
+        self.nodeList = self.G.nodes() + self.shapeNodes.keys()
+        self.nodeIndex = {n: i for i, n in enumerate(self.nodeList)}
+        count = len(self.nodeList)
+        self.nodeRoles = np.full(count, INTERIOR, dtype=np.int8)
+        edges = self.G.edges()
+        if edges:
+            idx = np.array([(self.nodeIndex[u], self.nodeIndex[v]) for u, v in
+                            edges], dtype=np.int64)
+            outDegree = np.bincount(idx[:, 0], minlength=count)
+            inDegree = np.bincount(idx[:, 1], minlength=count)
+            # Count distinct neighbors, i.e. a two-way street is one neighbor
+            pairs = np.unique(np.sort(idx, axis=1), axis=0)
+            neighbors = np.bincount(pairs.ravel(), minlength=count)
+            self.nodeRoles[(outDegree == 1) & (inDegree == 0)] = EXTERIOR
+            self.nodeRoles[neighbors > 2] = INTERSECTION
+        self.intersectionNodes = {self.nodeList[i] for i in
+                                  np.flatnonzero(self.nodeRoles ==
+                                                 INTERSECTION)}
+        return self.nodeRoles
+
     def isIntersection(self, n):
         """ If node has more than two connecting nodes, it's an intersection.
         """
-        if len(set(self.G.successors(n) + self.G.predecessors(n))) > 2:
-            return True
-        else:
-            return False
+        return n in self.intersectionNodes
 
     def isExterior(self, n):
         """ If a node has only one successor node and no predecessors, then
             it's at the exterior of the model and pointing in the correct
             direction.
         """
-        if len(self.G.successors(n)) == 1 and len(self.G.predecessors(n)) == 0:
-            # These are one-way start points, or bi-directional end points
-            return True
-        else:
-            return False
+        # These are one-way start points, or bi-directional end points
+        return self.nodeRoles[self.nodeIndex[n]] == EXTERIOR
 
     # Get start nodes and lane info for creating intersection and ways dicts
     def getExteriorNodes(self):
         """ Get a list of nodes that are on the exterior.
         """
-        nodes = []
-        for n in self.G.nodes():
-            if self.isExterior(n):
-                nodes.append(n)
-        return nodes
+        return [self.nodeList[i] for i in
+                np.flatnonzero(self.nodeRoles == EXTERIOR)]
 
-    def getStartNodes(self):
-        """ Get a list of nodes that do not overlap when traversed.
+    def getStartNodes(self, G=None):
+        """ Get the nodes to traverse the graph from, so that every way is
+            walked from its first node: the entry nodes (no predecessors) and
+            intersections of each weakly connected component, or one node of
+            a component that has neither, i.e. a loop.
+            Input: graph, defaults to the whole graph
+            Output: list of nodes
         """
-        edgeNodes = self.getExteriorNodes()
-        for node in edgeNodes:
-            for prev, n in nx.edge_dfs(self.G, source=node):
-                if n in edgeNodes:
-                    edgeNodes.remove(n)
-        return edgeNodes
+        if G is None:
+            G = self.G
+        startNodes = []
+        for component in sorted(nx.weakly_connected_components(G), key=min):
+            starts = sorted(n for n in component if not G.pred[n] or
+                            self.isIntersection(n))
+            startNodes.extend(starts or [min(component)])
+        return startNodes
 
     # Intersection dict
-    def compassBearing(self, pointA, pointB):
-        """ Calculates the bearing between two points. Source:
-            https://gist.github.com/jeromer/2005586
-            Input:
-            Output: The bearing in degrees
-        """
-        if (type(pointA) != tuple) or (type(pointB) != tuple):
-            raise TypeError("Only tuples are supported as arguments")
-        lat1 = math.radians(pointA[0])
-        lat2 = math.radians(pointB[0])
-        diffLong = math.radians(pointB[1] - pointA[1])
-        x = math.sin(diffLong) * math.cos(lat2)
-        y = (math.cos(lat1) * math.sin(lat2) - (math.sin(lat1) *
-             math.cos(lat2) * math.cos(diffLong)))
-        initial = math.atan2(x, y)
-        # Now we have the initial bearing but math.atan2 return values
-        # from -180 to + 180 which is not what we want for a compass bearing
-        # The solution is to normalize the initial bearing as shown below
-        initial = math.degrees(initial)
-        compass = round((initial + 360) % 360, 1)
-        return compass
-
-    def getIntersection(self, node):
-        """ Get direction, bearing and lane information for all intersection
-            edges. Bearing is calculated from the common intersection node.
+    def getApproaches(self, node):
+        """ Get direction and lane information for all intersection edges.
             Input: intersection node
-            Output: dictionary of intersection attributes
+            Output: list of (neighbor node, approach attributes) tuples
         """
-        intersection = {}
-        nodePoint = (self.G.node[node]['lat'], self.G.node[node]['lon'])
+        approaches = []
         for n in self.G.successors(node):
             attr = self.G.edge[node][n]
             if attr['highway'] not in self.roadTypes:
                 continue
-            nPoint = (self.G.node[n]['lat'], self.G.node[n]['lon'])
-            intersection[n] = {'beginning': True, 'lanes':
-                               attr.get('lanes', 1), 'bearing':
-                               self.compassBearing(nodePoint, nPoint),
-                               'oneway': self.isOneway(attr), 'forward':
-                               attr.get('lanes:forward', 1), 'backward':
-                               attr.get('lanes:backward', 1)}
+            approaches.append((n, {'beginning': True, 'lanes':
+                                   attr.get('lanes', 1), 'oneway':
+                                   self.isOneway(attr), 'forward':
+                                   attr.get('lanes:forward', 1), 'backward':
+                                   attr.get('lanes:backward', 1)}))
         for n in self.G.predecessors(node):
             attr = self.G.edge[n][node]
             if attr['highway'] not in self.roadTypes:
                 continue
-            nPoint = (self.G.node[n]['lat'], self.G.node[n]['lon'])
-            intersection[n] = {'beginning': False, 'lanes':
-                               attr.get('lanes', 1), 'bearing':
-                               self.compassBearing(nodePoint, nPoint),
-                               'oneway': self.isOneway(attr), 'forward':
-                               attr.get('lanes:forward', 1), 'backward':
-                               attr.get('lanes:backward', 1)}
-        return intersection
-
-    def createIntersectionDict(self):
-        """ Use depth-first search to map intersection nodes and lane widths.
-            Input: graph, startNode
+            approaches.append((n, {'beginning': False, 'lanes':
+                                   attr.get('lanes', 1), 'oneway':
+                                   self.isOneway(attr), 'forward':
+                                   attr.get('lanes:forward', 1), 'backward':
+                                   attr.get('lanes:backward', 1)}))
+        return approaches
+
+    def createIntersectionDict(self, nodes=None):
+        """ Map intersection nodes to their approaches, visiting each
+            intersection once and calculating all approach bearings in a
+            single batch.
+            Input: intersection nodes, defaults to all intersections that can
+                   be entered
             Output: dictionary mapping of intersection nodes
         """
+        if nodes is None:
+            nodes = [n for n in self.intersectionNodes if self.G.pred[n]]
         intersections = {}
-        for fromN, toN in nx.edge_dfs(self.G):
-            if self.isIntersection(toN):
-		print 'Processing intersection %d' %(int(toN))
-                intersections[toN] = self.getIntersection(toN)
+        approaches = []
+        self.stageProgress.setTotal(len(nodes))
+        for node in nodes:
+            log.debug('Processing intersection %s', node)
+            self.stageProgress.update()
+            intersections[node] = {}
+            approaches.extend((node, n, attr) for n, attr in
+                              self.getApproaches(node))
+        if approaches:
+            latLng = np.array([self.getLatLng(node) +
+                               self.getLatLng(self.adjacentNode(
+                                   node, n, attr['beginning'])) for
+                               node, n, attr in approaches])
+            bearings = geo.compassBearing(latLng[:, 0], latLng[:, 1],
+                                          latLng[:, 2], latLng[:, 3])
+            for (node, n, attr), bearing in zip(approaches, bearings):
+                attr['bearing'] = float(bearing)
+                intersections[node][n] = attr
         return intersections
 
     # Ways dict
@@ -331,7 +527,7 @@ class OSM(Vissim):
         for way in ways:
             way = list(OrderedDict.fromkeys([n for n in way]))
             fromN = way[0]
-            toN = way[1]
+            toN = self.approachNode(way, end=False)
             attr = self.G.edge[fromN][toN]
             fwdLanes, bkdLanes = self.getLanes({'attr': attr})
             if self.isOneway(attr):
@@ -361,26 +557,41 @@ class OSM(Vissim):
         elif waysDict.get('oneway'):
             return waysDict['oneway']
 
-    def createWaysDict(self):
+    def createWaysDict(self, edges=None):
         """ Begin with startNode and traverse the graph, collecting the nodes
             of each way. When a new way is encountered, start a new list of
             nodes. When a new intersection is encountered, pass the list of
             ways to the getWay function for processing.
-            Input: graph, startNode
+            Input: graph, edges in traversal order (defaults to a depth first
+                   traversal of the whole graph from its start nodes)
             Output: dictionary used for creating VISSIM links
         """
-        waysDict = {}
+        if edges is None and self.workers > 1:
+            return self.tiledWaysDict()
+        waysDict = OrderedDict()
         ways = []
         nodes = []
         prevAttr = None
         currAttr = None
+        if edges is None:
+            edges = nx.edge_dfs(self.G, self.getStartNodes())
+            self.stageProgress.setTotal(self.G.number_of_edges())
         
-        for fromN, toN in nx.edge_dfs(self.G):
+        for fromN, toN in edges:
             currAttr = self.G.edge[fromN][toN]
-            print 'createWaysDict : fromN %s toN %s ' %(fromN,toN)
+            log.debug('createWaysDict : fromN %s toN %s', fromN, toN)
+            self.stageProgress.update()
             #print currAttr['highway']
             if currAttr['highway'] not in self.roadTypes:
                 continue
+            # The traversal backtracked, so the ways collected so far end at
+            # a dead end or at a node that was already visited
+            if nodes and nodes[-1] != fromN:
+                ways.append(nodes)
+                waysDict.update(self.getWay(ways))
+                ways = []
+                nodes = []
+                prevAttr = None
             if self.isIntersection(fromN):
                 ways.append(nodes)
 #                print ways
@@ -391,11 +602,9 @@ class OSM(Vissim):
                 ways.append(nodes)
                 nodes = []
             nodes.append(fromN)
+            nodes.extend(currAttr.get('shape', ()))
             nodes.append(toN)
             prevAttr = currAttr
-            if self.isExterior(toN):
-                ways.append(nodes)
-                self.getWay(ways)
         ways.append(nodes)
         waysDict.update(self.getWay(ways))
         return waysDict
@@ -404,19 +613,19 @@ class OSM(Vissim):
     # offsets
 
     def getWayByNode(self, fromN, toN):
-        if (fromN, toN) in self.G.edges():
+        if self.G.has_edge(fromN, toN):
             # Forward way
             wayID = self.G.edge[fromN][toN]['id']
-            if wayID in self.ways.keys():
+            if wayID in self.ways:
                 return wayID
-            elif wayID + '-F' in self.ways.keys():
+            elif wayID + '-F' in self.ways:
                 return wayID + '-F'
             else:
                 raise KeyError
-        elif (toN, fromN) in self.G.edges():
+        elif self.G.has_edge(toN, fromN):
             # Backward way
             wayID = self.G.edge[toN][fromN]['id'] + '-B'
-            if wayID in self.ways.keys():
+            if wayID in self.ways:
                 return wayID
             else:
                 raise KeyError
@@ -444,115 +653,46 @@ class OSM(Vissim):
         pass
 
 
-    '''
-	RV Returns all the way ids with the specified name
-    '''
-    def getWayByName(self, name):
-	wByN = []
-	for w in self.ways:
-		#print self.ways[w]['attr']['name']
-		try:
-		   if( self.ways[w]['attr']['name'] == name):
-			wByN.append( w )
-		except:
-			#print 'Warning : way %s has no name' %(w)
-			wByN.append( w )
-			continue;
-		pass
-	pass
-	return wByN
-    pass
-
-    '''
-	RV Gets the way nearest to the given lat,lon
-    '''
-    def getNearestLinks(self, btNum, wayList, latlon):
-	p1 = latlon
-        BusStopPoint3D = self.latLngToScaledMeters(p1[0], p1[1])
-	p2 = latlon
-	offset = 0.0
-	nw = wayList[0]
-	validLinksDict = {}
-	curr = []
-	validLinksDict[btNum] = curr
-	for w in wayList:
-	    print 'processing way %s with %d nodes ' %(w, len(self.ways[w]['nodes']))
-	    linkAttr = {}
-	    linkAttr['wayID'] = w
-	    OriginOfWayPoint3D = self.ways[w]['point3D'][0]
-	    EndOfWayPoint3D = self.ways[w]['point3D'][-1]
-	    linkAttr['linkLength'] = geo.getDistance(OriginOfWayPoint3D,EndOfWayPoint3D)
-	    # len should be at least 2
-	    tmpSegList = []
-	    for i in range(len(self.ways[w]['nodes'])-1 ):
-	        node1Point3D = self.ways[w]['point3D'][i]
-	    	node2Point3D = self.ways[w]['point3D'][i+1]
-	        nwl = geo.getDistance(node1Point3D,node2Point3D)
-	    	#print 'processing segment of way %s with len  %f ' %(w, nwl)
-	    
-	    	BSPointOnWay = geo.getNearestPointOnSegment(BusStopPoint3D, (node1Point3D, node2Point3D))
-	    	if (BSPointOnWay == None ):
-			#print '+++ Nearest point not on segment ; Skipping way %s' %(w)
-			continue;
-	    	pass
-		# else valid perp to Bus stop found on segment
-		newpd = geo.getDistance(BusStopPoint3D,BSPointOnWay)
-	    	linkAttr['PerpDistance'] = newpd
-	        linkAttr['BusStopPoint'] = BSPointOnWay
-	    	linkAttr['DistanceToOrigin'] = geo.getDistance(BusStopPoint3D,OriginOfWayPoint3D)
-	        linkAttr['DistanceToEnd'] = geo.getDistance(BusStopPoint3D,EndOfWayPoint3D)
-	        linkAttr['Offset'] = geo.getDistance(BSPointOnWay, OriginOfWayPoint3D) 
-		tmpSegList.append(linkAttr)
-	    pass
-	    if (len(tmpSegList) == 0):
-		continue;	
-	    
-	    vls = sorted(tmpSegList,key=lambda k:k['PerpDistance'])
-	    curr = validLinksDict[btNum]
-	    try:
-	    	curr.append ( vls[0])
-	    	validLinksDict[btNum] = curr 
-	    except:
-	    	print '*** Failed to add item to valid links Dictionary'
-	pass
-	return validLinksDict
-
-
+    def turnDirections(self, diff):
+        """ Classify bearing differences as turning movements.
+            Input: array of bearing differences between -180 and 180
+            Output: array of 'left', 'right', 'through' or None
+        """
+        thruMin = self.turnAngles['thruMin']
+        thruMax = self.turnAngles['thruMax']
+        leftMin = self.turnAngles['leftMin']
+        leftMax = self.turnAngles['leftMax']
+        rightMin = self.turnAngles['rightMin']
+        rightMax = self.turnAngles['rightMax']
+        diff = np.asarray(diff)
+        conditions = [(diff >= thruMin) | (diff <= thruMax),
+                      (diff > leftMin) & (diff < leftMax),
+                      (diff > rightMin) & (diff < rightMax)]
+        choices = [np.array('through', dtype=object),
+                   np.array('left', dtype=object),
+                   np.array('right', dtype=object)]
+        return np.select(conditions, choices, default=None)
 
-    '''
-	RV Gets the nearest link 
-	todo : add checks - link segment which can fit the bus stop in it
-    '''
-    def selectNearest(self, validLinks ):
-	#print 'Processing %d links ' %(len(validLinks))
-	if (len(validLinks) <=0 ):
-		print 'Empty list of links'
-		return None
-	pass
-	vls = sorted(validLinks,key=lambda k:k['PerpDistance'])
-	# add check here - perpDistance should not be more than 10m >
-
-	linkAttr = vls[0]
-	newd1 = linkAttr['DistanceToOrigin'] 
-	if ( (newd1 + 20.0) > linkAttr['linkLength']): # since cannot accomodate start of busstop ?
-		print '+++Warning : may need to skip  link %s ; since too short?' %(linkAttr['wayID'])
-    	return linkAttr
-    pass
-
-    def calcTurn(self, startBearing, endBearing):
-        thruMin, thruMax = 135, -135
-        leftMin, leftMax = -135, -45
-        rightMin, rightMax = 45, 135
-        left, right, through = None, None, None
-        diff = ((((startBearing-endBearing) % 360)+540) % 360) - 180
-        if diff >= thruMin or diff <= thruMax:
-            return 'through'
-        elif diff > leftMin and diff < leftMax:
-            return 'left'
-        elif diff > rightMin and diff < rightMax:
-            return 'right'
-        else:
-            return None
+    def getTurnMatrix(self, intN):
+        """ Classify the turns between every pair of approaches of an
+            intersection. Results are cached per intersection node.
+            Input: intersection node
+            Output: dict of {from node: [(to node, turn, bearing diff)]}
+        """
+        if intN in self.turnCache:
+            return self.turnCache[intN]
+        intersection = self.intersections[intN]
+        nodes = intersection.keys()
+        bearings = np.array([intersection[n]['bearing'] for n in nodes])
+        diff = ((((bearings[:, None] - bearings[None, :]) % 360) + 540) %
+                360) - 180
+        turns = self.turnDirections(diff)
+        matrix = {}
+        for i, fromN in enumerate(nodes):
+            matrix[fromN] = [(n, turns[i, j], diff[i, j]) for j, n in
+                             enumerate(nodes)]
+        self.turnCache[intN] = matrix
+        return matrix
 
     def calcTurns(self, intN, fromN):
         """ For a given approach to an intersection, find the wayIDs
@@ -569,16 +709,12 @@ class OSM(Vissim):
 	except:
 		way1Turns = {}
         if intN in self.intersections:
-            intersection = self.intersections[intN]
-            startBearing = intersection[fromN]['bearing']
-            for n, attr in intersection.items():
-                endBearing = attr['bearing']
+            for n, turn, diff in self.getTurnMatrix(intN)[fromN]:
                 try:
                     wayID = self.getWayByNode(intN, n)
         	    wayIDAttr = self.ways[wayID]
                     wayIDTurnLanes = self.getTurnLanes(wayIDAttr)
 
-                    turn = self.calcTurn(startBearing, endBearing)
                     turns[turn].append(wayID)
 		    #RV 
 		    # handle case where wayID is a little piece of the same
@@ -651,17 +787,15 @@ class OSM(Vissim):
             Input: node pairs approaching intersection
             Output: cross section information
         """
-        intersection = self.intersections[intN]
-        startBearing = intersection[fromN]['bearing']
+        if (intN, fromN) in self.crossStreetCache:
+            return self.crossStreetCache[(intN, fromN)]
         minBearing, maxBearing = None, None
         left, right = None, None
-        for n, attr in intersection.items():
-            endBearing = attr['bearing']
-            diff = ((((startBearing-endBearing) % 360)+540) % 360) - 180
-            if self.calcTurn(startBearing, endBearing) == 'left':
+        for n, turn, diff in self.getTurnMatrix(intN)[fromN]:
+            if turn == 'left':
                 left = n
                 maxBearing = diff
-            elif self.calcTurn(startBearing, endBearing) == 'right':
+            elif turn == 'right':
                 right = n
                 minBearing = diff
         if left:
@@ -673,117 +807,320 @@ class OSM(Vissim):
             rightLane = self.calcCrossSection(intN, right, minBearing)
         else:
             rightLane = 0
-        return max([leftLane, rightLane])
+        self.crossStreetCache[(intN, fromN)] = max([leftLane, rightLane])
+        return self.crossStreetCache[(intN, fromN)]
 
     def latLngToMeters(self, lat, lng):
         """ Convert lat/lng to meters from 0,0 point on WGS84 map.
             Input: WGS84 lat/lng
             Output: x,y in meters
         """
-        assert abs(lng) <= 180, '%s exceeds longitudinal domain' % (lng)
-        extent = 20015085  # height/width in meters of the VISSIM map
-        x = lng * extent / 180.0
-        y = (math.log(math.tan((90 + lat) * math.pi / 360.0)) /
-             (math.pi / 180.0))
-        y = y * extent / 180.0
-        return x, y
+        x, y = proj.latLngToMeters(lat, lng)
+        return float(x), float(y)
 
     def latLngToScaledMeters(self, lat, lng):
-        x, y = self.latLngToMeters(lat, lng)
-        scale = 1 / math.cos(math.radians(self.refLat))
-        scaleX = (x - self.refX) / scale
-        scaleY = (y - self.refY) / scale
-        return (scaleX, scaleY, 0)
+        x, y = self.ref.toScaledMeters(lat, lng)
+        return (float(x), float(y), 0)
 
     def getLatLng(self, n):
         """ Return lat/lng tuple for a given node.
         """
+        if n in self.shapeNodes:
+            return self.shapeNodes[n]
         return self.G.node[n]['lat'], self.G.node[n]['lon']
 
+    def adjacentNode(self, node, n, beginning=True):
+        """ The node next to a node along the edge to (or from) a neighbor,
+            which is a shape node of the edge in a contracted graph.
+            Input: node, neighbor node, edge points away from the node
+            Output: node
+        """
+        if beginning:
+            shape = self.G.edge[node][n].get('shape')
+            return shape[0] if shape else n
+        shape = self.G.edge[n][node].get('shape')
+        return shape[-1] if shape else n
+
+    def approachNode(self, nodes, end=True):
+        """ The graph neighbor of the last (or first) node of a way, skipping
+            shape nodes of a contracted graph.
+            Input: list of way nodes, end or beginning of the way
+            Output: node
+        """
+        for n in (reversed(nodes[:-1]) if end else nodes[1:]):
+            if n not in self.shapeNodes:
+                return n
+
+    def projectNodes(self):
+        """ Apply Mercator scaling factor based on latitude to all graph
+            nodes in a single transform.
+            Input: graph, reference point
+            Output: array of xy points aligned with nodeList
+        """
+        latLng = np.array([self.getLatLng(n) for n in self.nodeList],
+                          dtype=np.float64).reshape(-1, 2)
+        x, y = self.ref.toScaledMeters(latLng[:, 0], latLng[:, 1])
+        return np.column_stack([x, y])
+
     def nodeToScaledMeters(self, n):
         """ Apply Mercator scaling factor based on latitude to xy points.
             Input: node
             Output: correctly scaled xy
         """
-        lat, lng = self.getLatLng(n)
-        x, y = self.latLngToMeters(lat, lng)
-        scale = 1 / math.cos(math.radians(self.refLat))
-        scaleX = (x - self.refX) / scale
-        scaleY = (y - self.refY) / scale
-        return (scaleX, scaleY, 0)
+        return self.nodesToScaledMeters([n])[0]
+
+    def nodesToScaledMeters(self, nodes):
+        """ Look up the scaled xy points of a list of nodes.
+            Input: list of nodes
+            Output: list of x,y,z tuples
+        """
+        xy = self.nodeXY[[self.nodeIndex[n] for n in nodes]]
+        return zip(xy[:, 0].tolist(), xy[:, 1].tolist(), [0] * len(nodes))
 
     def nodesToXY(self, attr):
         """ Process links dictionary to calculate proper XY coordinates.
             Input: links dictionary
             Output: updated links dictionary with xy dictionary
         """
-        width = self.v.defaultWidth
-        nodes = attr['nodes']
-        #print "#######", nodes		
-        point3D = attr['point3D'] = [self.nodeToScaledMeters(n) for n in nodes]
-        #print point3D  		
-        		
-        # Parallel
-        if not self.isOneway(attr):
-            dist = attr['offset'] * width
-            #print "###", point3D			
-            #print nodes
-            #tt = geo.offsetEndpoint(point3D, 1.0)
-            #print tt
-            #print "@@@", point3D
-            '''tt = [[468.514244231,48.6922583583,0],
-                  [468.069585906,89.8343879775,0],
-                  [476.929403034,136.402838403,0]]
-			'''	  
-            point3D = geo.offsetParallel(point3D, dist)			
-            #point3D = geo.offsetParallel(point3D, dist)
-        # Endpoints / Turns
-        if nodes[0] in self.intersections:
-            dist = self.getCrossStreets(nodes[0], nodes[1]) * width
-            point3D[0] = geo.offsetEndpoint(point3D, dist)
-        if nodes[-1] in self.intersections:
-            dist = self.getCrossStreets(nodes[-1], nodes[-2]) * width
-            point3D[-1] = geo.offsetEndpoint(point3D, dist, beginning=False)
-        # Turn dictionary only for ways pointing toward the intersection
-        attr['turns'] = self.calcTurns(nodes[-1], nodes[-2])
-        attr['point3D'] = [stringify(i) for i in point3D]
-        return attr
+        return self.waysToXY([attr])[0]
+
+    def waysToXY(self, attrs):
+        """ Calculate XY coordinates for many ways at once. Parallel offsets
+            and endpoint pull backs are applied to the points of all ways in
+            a single batch.
+            Input: list of way dictionaries
+            Output: updated way dictionaries with point3D and turns
+        """
+        width = self.laneWidth
+        nodeIdx, offsets, parallel, startDist, endDist = [], [0], [], [], []
+        for attr in attrs:
+            nodes = attr['nodes']
+            nodeIdx.extend(self.nodeIndex[n] for n in nodes)
+            offsets.append(len(nodeIdx))
+            # Parallel
+            parallel.append(attr.get('offset', 0) * width)
+            # Endpoints / Turns
+            if nodes[0] in self.intersections:
+                startDist.append(self.getCrossStreets(
+                    nodes[0], self.approachNode(nodes, end=False)) * width)
+            else:
+                startDist.append(0)
+            if nodes[-1] in self.intersections:
+                endDist.append(self.getCrossStreets(
+                    nodes[-1], self.approachNode(nodes)) * width)
+            else:
+                endDist.append(0)
+            # Turn dictionary only for ways pointing toward the intersection
+            attr['turns'] = self.calcTurns(nodes[-1],
+                                           self.approachNode(nodes))
+        points = np.zeros((len(nodeIdx), 3))
+        points[:, :2] = self.nodeXY[nodeIdx]
+        points = geo.offsetParallelBatch(points, offsets, parallel)
+        points = geo.offsetEndpointBatch(points, offsets, startDist, endDist)
+        for i, attr in enumerate(attrs):
+            attr['point3D'] = points[offsets[i]:offsets[i+1]]
+        return attrs
 
     def createXYDict(self):
         """ Create a dictionary for each way calculating node locations in
             XY space, compass bearing and intersection offsets.
         """
-        xy = {}
-        for k, attr in self.ways.items():
-            #print self.ways		
+        self.turnCache = {}
+        self.crossStreetCache = {}
+        # Forward and backward ways of the same OSM way share an xy key and
+        # the last one wins, so iterate in key order rather than in the
+        # (pickle dependent) order of the ways dict
+        self.ways = OrderedDict(sorted(self.ways.items()))
+        keys = []
+        for k in self.ways:
 	    #RV extract the relevant parts of the way id without the -B/-F encoding
 	    tmp = k
 	    if (k.endswith('-B') or k.endswith('-F')):
 	    	tmp3 = tmp.split('-')
 	    	tmp = tmp3[0] + '-' + tmp3[1]
-            print 'XY>>  Way being processed %s ' %(tmp)
-            xy[tmp] = self.nodesToXY(attr)
-        return xy
+            log.debug('XY>>  Way being processed %s', tmp)
+            keys.append(tmp)
+        if self.workers > 1:
+            self.tiledWaysToXY()
+            attrs = self.ways.values()
+        else:
+            attrs = self.waysToXY(self.ways.values())
+        self.stageProgress.update(len(attrs))
+        return OrderedDict(zip(keys, attrs))
+
+    # Tiled conversion
+    def getTiles(self, nodes):
+        """ Assign nodes to square tiles of tileSize meters. Without a tile
+            size the network is split in about four tiles per worker.
+            Input: list of nodes
+            Output: list of (column, row) tile keys
+        """
+        xy = self.nodeXY[[self.nodeIndex[n] for n in nodes]]
+        low = self.nodeXY.min(axis=0)
+        size = self.tileSize
+        if not size:
+            side = int(math.ceil(math.sqrt(4 * self.workers)))
+            size = max((self.nodeXY.max(axis=0) - low).max() / side, 1.0)
+        cells = np.floor((xy - low) / size).astype(int)
+        return [tuple(c) for c in cells.tolist()]
+
+    def tilePool(self):
+        """ Create a process pool whose workers share the converter settings.
+            The state of each tile is sent with its task.
+            Input: None
+            Output: multiprocessing pool
+        """
+        state = {k: getattr(self, k) for k in
+                 ('laneWidth', 'roadTypes', 'turnAngles', 'curvePoints')}
+        return multiprocessing.Pool(self.workers, initializer=_initTileWorker,
+                                    initargs=(state,))
+
+    def tileMap(self, func, tasks):
+        """ Run tile tasks in a process pool.
+            Input: worker function, list of tasks
+            Output: list of results in task order
+        """
+        pool = self.tilePool()
+        try:
+            return pool.map(func, tasks)
+        finally:
+            pool.close()
+            pool.join()
+
+    def getChains(self):
+        """ Split the graph traversal of createWaysDict in chains of edges
+            from a start node or intersection up to the next intersection.
+            Ways never span chains, so chains can be processed separately.
+            Input: graph
+            Output: list of chains (lists of edges) in traversal order
+        """
+        chains, prevN = [], None
+        for fromN, toN in nx.edge_dfs(self.G, self.getStartNodes()):
+            if fromN != prevN or self.isIntersection(fromN):
+                chains.append([])
+            chains[-1].append((fromN, toN))
+            prevN = toN
+        return chains
+
+    def tiledWaysDict(self):
+        """ Create the ways dictionary in a process pool. Chains are split in
+            tiles by their first node and each tile receives only the edges
+            of its chains. Ways are merged in the order of a serial
+            traversal.
+            Input: graph
+            Output: dictionary used for creating VISSIM links
+        """
+        chains = self.getChains()
+        tiles = OrderedDict()
+        for i, tile in enumerate(self.getTiles([c[0][0] for c in chains])):
+            tiles.setdefault(tile, []).append(i)
+        tasks = []
+        for tile in sorted(tiles):
+            H = nx.DiGraph()
+            for i in tiles[tile]:
+                for u, v in chains[i]:
+                    H.add_edge(u, v, self.G.edge[u][v])
+            state = {'G': H,
+                     'intersectionNodes': {n for n in H if
+                                           self.isIntersection(n)},
+                     'shapeNodes': {n: self.shapeNodes[n] for u, v, attr in
+                                    H.edges(data=True) for n in
+                                    attr.get('shape', ())}}
+            tasks.append((state, [chains[i] for i in tiles[tile]]))
+        results = self.tileMap(_tileWays, tasks)
+        byChain = {}
+        for tile, result in zip(sorted(tiles), results):
+            byChain.update(zip(tiles[tile], result))
+        waysDict = OrderedDict()
+        for i in range(len(chains)):
+            waysDict.update(byChain[i])
+        self.stageProgress.update(self.G.number_of_edges())
+        log.info('Created %d ways from %d chains in %d tiles', len(waysDict),
+                 len(chains), len(tiles))
+        return waysDict
+
+    def tileXYState(self, wayIDs):
+        """ Collect the state needed to calculate the XY coordinates of the
+            ways of a tile: their nodes, and as a halo the intersections they
+            end at with the edges and ways of every approach.
+            Input: list of wayIDs
+            Output: dict of converter attributes
+        """
+        nodes, ends = set(), set()
+        for w in wayIDs:
+            wayNodes = self.ways[w]['nodes']
+            nodes.update(wayNodes)
+            ends.update((wayNodes[0], wayNodes[-1]))
+        H = nx.DiGraph()
+        for n in ends:
+            for u, v, attr in (self.G.in_edges(n, data=True) +
+                               self.G.out_edges(n, data=True)):
+                H.add_edge(u, v, attr)
+        ways = {w: self.ways[w] for w in wayIDs}
+        for u, v in H.edges():
+            for fromN, toN in ((u, v), (v, u)):
+                try:
+                    wayID = self.getWayByNode(fromN, toN)
+                except KeyError:
+                    continue
+                ways[wayID] = self.ways[wayID]
+        nodeList = sorted(nodes)
+        return {'G': H, 'ways': ways,
+                'intersections': {n: self.intersections[n] for n in ends if
+                                  n in self.intersections},
+                'nodeIndex': {n: i for i, n in enumerate(nodeList)},
+                'nodeXY': self.nodeXY[[self.nodeIndex[n] for n in nodeList]],
+                'shapeNodes': {n: self.shapeNodes[n] for n in nodes if n in
+                               self.shapeNodes}}
+
+    def tiledWaysToXY(self):
+        """ Calculate XY coordinates of all ways in a process pool. Ways are
+            split in tiles by the node they end at, which is where their
+            turns and pull backs are calculated, and each tile receives only
+            the state of its ways and their halo.
+            Input: ways dictionary
+            Output: ways dictionary updated with point3D and turns
+        """
+        wayIDs = self.ways.keys()
+        tiles = OrderedDict()
+        for wayID, tile in zip(wayIDs, self.getTiles(
+                [self.ways[w]['nodes'][-1] for w in wayIDs])):
+            tiles.setdefault(tile, []).append(wayID)
+        results = self.tileMap(_tileXY, [(self.tileXYState(tiles[t]),
+                                          tiles[t]) for t in sorted(tiles)])
+        for result in results:
+            for wayID, point3D, turns in result:
+                self.ways[wayID]['point3D'] = point3D
+                self.ways[wayID]['turns'] = turns
+        log.info('Calculated XY for %d ways in %d tiles', len(wayIDs),
+                 len(tiles))
 
-    # Create VISSM objects from OSM
     def importLinks(self):
-        """ Create links based on xy dictionary, using attributes and
-            centerlines as a guide.
+        """ Create link records based on xy dictionary, using attributes and
+            centerlines as a guide. Links are written to the model in bulk
+            by exportModel.
             Input: xy dictionary
-            Output: modifies vissim object in place
+            Output: dict of link records keyed by link number
         """
+        links = OrderedDict()
+        self.stageProgress.setTotal(len(self.xy))
         for wayID, attr in self.xy.items():
-            point3D = attr['point3D']
-            lanes = int(attr['laneNumber']) * [self.v.defaultWidth]
-	    tmp = self.wayIDToVissimLinkNumber(wayID)
-	    try:
-            	self.v.Links.createLink(**{'point3D': point3D, 'lane': lanes,
-                                       'no': tmp})
-	    except:
-		print 'Could not create link for %s' %(tmp)
-		continue
-	pass
-    pass
+            self.stageProgress.update()
+            tmp = self.wayIDToVissimLinkNumber(wayID)
+            if tmp in links:
+                log.warning('Could not create link for %s', tmp)
+                continue
+            links[tmp] = self.linkRecord(wayID, attr)
+        return links
+
+    def linkRecord(self, wayID, attr):
+        """ Create the link record of a way.
+            Input: wayID, way dictionary
+            Output: link record
+        """
+        return {'no': self.wayIDToVissimLinkNumber(wayID), 'wayID': wayID,
+                'point3D': attr['point3D'],
+                'lane': int(attr['laneNumber']) * [self.laneWidth]}
 
     def hasTurn(self, turnLanes, turn):
         """ Check if a turning movement exists at an approach.
@@ -798,119 +1135,239 @@ class OSM(Vissim):
         return False
 
     def processTurns(self, fromLink, turnTo, turnLanes, turn):
+        """ Create connector records from an approach link to the links its
+            turning movement leads to.
+            Input: from link number, turn dict, turn lanes, turn
+            Output: list of connector records
+        """
+        connectors = []
+        fromAttr = self.linkRecords[fromLink]
         turns = sum([1 if turn in lane else 0 for lane in turnLanes])
         fromLane = min([i+1 if turn in v else '' for i, v in
                         enumerate(reversed(turnLanes))])
         for wayID in turnTo[turn]:
-	    #RV
-	    tmp = self.wayIDToVissimLinkNumber(wayID)
-	    print 'Processing wayid old %s new %s' %(wayID, tmp)
-	    try:
-            	attr = self.v.Links._getAttributes('no', tmp)
-                toLink = self.v.Links._getAttributes('no', tmp)['no']
-                lanes = len(self.v.Links.getLanes(toLink))
-	    except:
-		print ' Attribute/lanes not found for way %s' %(tmp)
-		continue
-	    pass
+            #RV
+            toLink = self.wayIDToVissimLinkNumber(wayID)
+            log.debug('Processing wayid old %s new %s', wayID, toLink)
+            if toLink == fromLink:
+                # Turns of a way in to its own link, e.g. from the
+                # direction of a two-way way that did not become the link
+                log.debug('Discarding connector from %s to itself', toLink)
+                continue
+            if toLink not in self.linkRecords:
+                log.debug('Attribute/lanes not found for way %s', toLink)
+                continue
+            toAttr = self.linkRecords[toLink]
+            lanes = len(toAttr['lane'])
             if lanes < turns:
                 turns = lanes
             toLane = lanes - turns + 1
-	    try:
-            	self.v.Links.createConnector(fromLink, fromLane, toLink, toLane, turns)
-	    except:
-		print ' creat connector failed ' 
-		continue
-	    pass
+            if len(fromAttr['lane']) < turns:
+                log.debug('creat connector failed')
+                continue
+            connectors.append({'fromLink': fromLink, 'fromLane': fromLane,
+                               'toLink': toLink, 'toLane': toLane,
+                               'lanes': turns,
+                               'fromPos': geo.getLength(fromAttr['point3D'])})
+        return connectors
+
+    def connectorsToXY(self, connectors):
+        """ Calculate the geometry of all connector records in one batch,
+            as bezier curves when curvePoints > 2.
+            Input: list of connector records
+            Output: connector records updated with point3D
+        """
+        if not connectors:
+            return connectors
+        fromPoints, fromDist, toPoints, toDist = [], [], [], []
+        for c in connectors:
+            fromAttr = self.linkRecords[c['fromLink']]
+            toAttr = self.linkRecords[c['toLink']]
+            clockwise, dist = geo.laneOffset(fromAttr['lane'], c['fromLane'],
+                                             c['lanes'])
+            fromDist.append(dist if clockwise else -dist)
+            clockwise, dist = geo.laneOffset(toAttr['lane'], c['toLane'],
+                                             c['lanes'])
+            toDist.append(dist if clockwise else -dist)
+            fromPoints.append(fromAttr['point3D'][-2:])
+            toPoints.append(toAttr['point3D'][:2])
+        curves = geo.connectorGeometryBatch(fromPoints, fromDist, toPoints,
+                                            toDist, self.curvePoints)
+        for c, point3D in zip(connectors, curves):
+            c['point3D'] = point3D
+        return connectors
+
+    def turnConnectors(self, wayID, attr):
+        """ Create connector records, without geometry, for the turning
+            movements of a way.
+            Input: wayID, way dictionary
+            Output: list of connector records
+        """
+        connectors = []
+        if 'turns' not in attr:
+            return connectors
+        if wayID[-1] == 'B':
+            direction = 'backward'
+        else:
+            direction = 'forward'
+        #RV
+        fromLink = self.wayIDToVissimLinkNumber(wayID)
+        log.debug('Processing wayid %s', fromLink)
+        if fromLink not in self.linkRecords:
+            log.debug('Discarding wayID %s', fromLink)
+            return connectors
+        turnTo = attr['turns']
+        turnLanes = self.getTurnLanes(attr, direction=direction)
+        for turn in ['left', 'through', 'right']:
+            if len(turnTo[turn]) > 0 and self.hasTurn(turnLanes, turn):
+                connectors.extend(self.processTurns(fromLink, turnTo,
+                                                    turnLanes, turn))
+        return connectors
 
     def importConnectors(self):
-        """ Create connectors based on xy dictionary.
+        """ Create connector records based on xy dictionary. Connectors are
+            written to the model in bulk by exportModel.
             Input: xy dictionary
-            Output: modifies vissim object in place
+            Output: list of connector records
         """
+        if self.workers > 1:
+            connectors = self.tiledConnectors()
+            self.stageProgress.update(len(self.xy))
+            return connectors
+        connectors = []
+        self.stageProgress.setTotal(len(self.xy))
         for wayID, attr in self.xy.items():
-            if 'turns' in attr:
-                if wayID[-1] == 'B':
-                    direction = 'backward'
-                else:
-                    direction = 'forward'
-	    	#RV
-	    	tmp = self.wayIDToVissimLinkNumber(wayID)
-		print 'Processing wayid %s' %(tmp)
-		try:
-                	fromLink = self.v.Links._getAttributes('no', tmp)['no']
-		except:
-			print 'Discarding wayID %s' %(tmp)
-			continue
-		pass
-                turnTo = attr['turns']
-                turnLanes = self.getTurnLanes(attr, direction=direction)
-                if len(turnTo['left']) > 0 and self.hasTurn(turnLanes, 'left'):
-                    self.processTurns(fromLink, turnTo, turnLanes, 'left')
-                if (len(turnTo['through']) > 0 and
-                        self.hasTurn(turnLanes, 'through')):
-                    self.processTurns(fromLink, turnTo, turnLanes, 'through')
-                if (len(turnTo['right']) > 0 and
-                        self.hasTurn(turnLanes, 'right')):
-                    self.processTurns(fromLink, turnTo, turnLanes, 'right')
+            connectors.extend(self.turnConnectors(wayID, attr))
+            self.stageProgress.update()
+        return self.connectorsToXY(connectors)
 
-        
-    def processBusStops(self):
-	ptStops = []
-    	for n in self.osm.nodes:
-		if (type(self.osm.nodes[n]) is BusStopNode):
-			try:
-			    locName = self.osm.nodes[n].tags['location']
-			except:
-			    locName = ''
-			try:
-			    btNum = int(self.osm.nodes[n].tags['asset_ref'])
-			except:
-			    continue ; # skip bus stop without a bt number
-			print 'NonWayNode found of type %s <%d> is at location %s' %(self.osm.nodes[n].typeTag, btNum, locName)
-			wayList = []
-			lat = self.osm.nodes[n].lat
-			lon = self.osm.nodes[n].lon
-			wayList = self.getWayByName(locName)
-			if (len(wayList) != 0) :
-				nearestLinks = self.getNearestLinks(btNum, wayList, (self.osm.nodes[n].lat, self.osm.nodes[n].lon))
-				if (len(nearestLinks[btNum]) ==0 ):
-				    continue
-				nearestWay = self.selectNearest(nearestLinks[btNum])
-				if (nearestWay == None):
-					print 'No links for bus stop %d ' %(btNum)
-					continue;
-				pass
-				print 'Nearest Way is %s <len %f> at distance %f m from BusStop' %(nearestWay['wayID'], nearestWay['linkLength'],nearestWay['PerpDistance'])
-				#print 'Offset of bus-stop to start of link is %f meters' %(nearestWay['DistanceToOrigin'])
-				pts = self.InitPTStop(btNum,nearestWay)
-            			ptStops.append(pts)
-			else:
-				print 'No ways with name %s ' %(locName)
-			pass
-		pass
-	pass
+    def tiledConnectors(self):
+        """ Create connector records in a process pool. Each tile receives
+            its approach ways and links plus a halo of the links that
+            its turns lead to, so connectors across tile seams are built by
+            the tile they start in. Records are merged in the same order as
+            a serial conversion, giving identical connector numbers.
+            Input: xy dictionary, link records
+            Output: list of connector records
+        """
+        items = self.xy.items()
+        tileOf = self.getTiles([attr['nodes'][-1] for wayID, attr in items])
+        linkTile = {}
+        for (wayID, attr), tile in zip(items, tileOf):
+            linkTile.setdefault(self.wayIDToVissimLinkNumber(wayID), tile)
+        tasks = OrderedDict()
+        for (wayID, attr), tile in zip(items, tileOf):
+            xy, links = tasks.setdefault(tile, (OrderedDict(), {}))
+            xy[wayID] = attr
+            targets = [self.wayIDToVissimLinkNumber(wayID)]
+            for ids in attr.get('turns', {}).values():
+                targets.extend(self.wayIDToVissimLinkNumber(w) for w in ids)
+            for link in targets:
+                if link in self.linkRecords:
+                    links[link] = self.linkRecords[link]
+        results = self.tileMap(_tileConnectors,
+                               [tasks[t] for t in sorted(tasks)])
+        byWay = {}
+        for result in results:
+            byWay.update(result)
+        connectors, seams = [], 0
+        for wayID, attr in items:
+            for c in byWay.get(wayID, []):
+                if linkTile.get(c['toLink']) != linkTile[c['fromLink']]:
+                    seams += 1
+                connectors.append(c)
+        log.info('Created %d connectors in %d tiles, %d across tile seams',
+                 len(connectors), len(tasks), seams)
+        return connectors
 
-	print 'Processed Bus stops -- count = %d' %(len(ptStops))
-        for i in range(len(ptStops)):
-	    print ptStops[i]
-            self.v.PTStop.createptStop(**ptStops[i])
-	pass
+    def busStopIndex(self):
+        """ Build a segment index over the ways that became links with at
+            least one lane. Ways are grouped by name so bus stops are only
+            snapped to ways named after their location; unnamed ways match
+            any bus stop.
+            Input: ways dictionary, link records
+            Output: list of way IDs, dict of name codes, SegmentIndex
+        """
+        wayIDs, names, groups, offsets, points = [], {}, [], [0], []
+        for w, attr in self.ways.items():
+            link = self.linkRecords.get(self.wayIDToVissimLinkNumber(w))
+            if link is None or int(attr['laneNumber']) < 1:
+                continue
+            name = attr['attr'].get('name')
+            wayIDs.append(w)
+            groups.append(-1 if name is None else
+                          names.setdefault(name, len(names)))
+            points.append(attr['point3D'])
+            offsets.append(offsets[-1] + len(attr['point3D']))
+        points = np.concatenate(points) if points else np.zeros((0, 3))
+        return wayIDs, names, spatial.SegmentIndex(points, offsets, groups)
 
-	#RV --2018--Jan--
-    pass
+    def processBusStops(self):
+        """ Snap all bus stops to their nearest way in one batched query.
+            Stops are matched to ways with the same name within
+            BUS_STOP_DISTANCE meters, preferring ways they are on the right
+            hand side of.
+            Input: OSM bus stop nodes, ways dictionary
+            Output: list of PT stop records
+        """
+        stops = []
+        for n in self.osm.nodes:
+            node = self.osm.nodes[n]
+            if type(node) is not BusStopNode:
+                continue
+            locName = node.tags.get('location', '')
+            try:
+                btNum = int(node.tags['asset_ref'])
+            except (KeyError, ValueError):
+                continue  # skip bus stop without a bt number
+            log.debug('NonWayNode found of type %s <%d> is at location %s',
+                      node.typeTag, btNum, locName)
+            stops.append((btNum, locName, node.lat, node.lon))
+        ptStops = []
+        if stops:
+            wayIDs, names, index = self.busStopIndex()
+            btNums, locNames, lat, lng = zip(*stops)
+            x, y = self.ref.toScaledMeters(np.array(lat, dtype=float),
+                                           np.array(lng, dtype=float))
+            points = np.column_stack([x, y])
+            groups = [names.get(name, -2) for name in locNames]
+            nearest = index.query(points, BUS_STOP_DISTANCE, groups)
+            # Prefer a way the stop is on the right hand side of unless it is
+            # more than a lane further away than the nearest way
+            right = index.query(points, BUS_STOP_DISTANCE, groups,
+                                side='right')
+            use = right['distance'] <= nearest['distance'] + self.laneWidth
+            for k, v in right.items():
+                nearest[k][use] = v[use]
+            for i, btNum in enumerate(btNums):
+                way = nearest['polyline'][i]
+                if way < 0:
+                    log.debug('No ways with name %s', locNames[i])
+                    continue
+                wayInfo = {'wayID': wayIDs[way],
+                           'linkLength': index.lengths[way],
+                           'PerpDistance': nearest['distance'][i],
+                           'BusStopPoint': tuple(nearest['point'][i]),
+                           'DistanceToOrigin': nearest['measure'][i]}
+                log.debug('Nearest Way is %s <len %f> at distance %f m from '
+                          'BusStop', wayInfo['wayID'], wayInfo['linkLength'],
+                          wayInfo['PerpDistance'])
+                ptStops.append(self.InitPTStop(btNum, wayInfo))
+        self.stageProgress.update(len(ptStops))
+        log.info('Processed Bus stops -- count = %d', len(ptStops))
+        return ptStops
 
     def InitPTStop(self,btNum, wayInfo):
 
 	ptStopRecord = {}
 	ptStopRecord['no'] = btNum
 	if (wayInfo['linkLength'] < 20):
-    	    print ' Bus stop on v. short way'
+    	    log.debug('Bus stop on v. short way')
 	    ptStopRecord['length'] = wayInfo['linkLength'] 
 	pass
 	offset = wayInfo['DistanceToOrigin']
 	if ((offset + 20) >= wayInfo['linkLength']):
-		print ' Adjusting offset for Bus stop '
+		log.debug('Adjusting offset for Bus stop')
 		offset = offset - 20.0;
 		if (offset < 0.0): #RV No negative offsets
 			offset = 0.0
@@ -922,8 +1379,378 @@ class OSM(Vissim):
 	ptStopRecord['lane'] = tmp + ' ' + str(lanes)
 	return ptStopRecord
 
+    # Incremental updates
+    def updateNodes(self, nodes):
+        """ Project and classify a set of nodes after the graph changed,
+            adding nodes that are new to the graph.
+            Input: list of nodes
+            Output: updated node index, xy points and roles
+        """
+        nodes = [n for n in nodes if n in self.G.node]
+        new = [n for n in nodes if n not in self.nodeIndex]
+        for n in new:
+            self.nodeIndex[n] = len(self.nodeList)
+            self.nodeList.append(n)
+        if new:
+            self.nodeRoles = np.append(self.nodeRoles,
+                                       np.full(len(new), INTERIOR,
+                                               dtype=np.int8))
+            self.nodeXY = np.vstack([self.nodeXY, np.zeros((len(new), 2))])
+        if not nodes:
+            return
+        idx = [self.nodeIndex[n] for n in nodes]
+        latLng = np.array([self.getLatLng(n) for n in nodes], dtype=float)
+        x, y = self.ref.toScaledMeters(latLng[:, 0], latLng[:, 1])
+        self.nodeXY[idx] = np.column_stack([x, y])
+        for n, i in zip(nodes, idx):
+            succ, pred = self.G.successors(n), self.G.predecessors(n)
+            if len(set(succ) | set(pred)) > 2:
+                self.nodeRoles[i] = INTERSECTION
+                self.intersectionNodes.add(n)
+            else:
+                self.nodeRoles[i] = (EXTERIOR if len(succ) == 1 and not pred
+                                     else INTERIOR)
+                self.intersectionNodes.discard(n)
+
+    def chainEdges(self, seeds):
+        """ Expand edges to the chains of edges they belong to, i.e. up to
+            the next intersection or dead end in both directions.
+            Input: list of edges
+            Output: set of chain edges, set of intersection nodes at the ends
+                    of the chains
+        """
+        edges, ends = set(), set()
+        stack = [e for e in seeds if self.G.has_edge(*e)]
+        while stack:
+            edge = stack.pop()
+            if edge in edges:
+                continue
+            edges.add(edge)
+            for n in edge:
+                if self.isIntersection(n):
+                    ends.add(n)
+                else:
+                    stack.extend(self.G.out_edges(n) + self.G.in_edges(n))
+        return edges, ends
+
+    def waysAtNodes(self, nodes, end=True):
+        """ Find the ways that end (or begin) at any of a set of nodes.
+            Input: set of nodes, end or beginning
+            Output: set of wayIDs
+        """
+        wayIDs = set()
+        for n in nodes:
+            if n not in self.G.node:
+                continue
+            for m in self.G.successors(n) + self.G.predecessors(n):
+                for fromN, toN in ((m, n), (n, m)):
+                    try:
+                        wayID = self.getWayByNode(fromN, toN)
+                    except KeyError:
+                        continue
+                    if self.ways[wayID]['nodes'][-1 if end else 0] == n:
+                        wayIDs.add(wayID)
+        return wayIDs
+
+    def applyChanges(self, oscFile, inpxFile, outFile=None):
+        """ Apply an OSM change file to this conversion and patch the
+            converted model. Only the chains of ways touched by the change
+            and the intersections at their ends are recalculated; all other
+            links keep their geometry and numbers.
+            Input: .osc file, converted .inpx file, output file (defaults to
+                   patching inpxFile in place)
+            Output: updated conversion state and written model
+        """
+        if self.shapeNodes or self.clusterRadius:
+            raise ValueError('Changes can not be applied to a contracted or '
+                             'clustered graph')
+        change = read_osc(oscFile, includeBusStops=self.includeBusStops)
+        # Chains touched by the change, before it is applied
+        changedNodes = [n for n in change['nodes'] if n in self.G.node]
+        seeds = []
+        for wayID in set(change['ways']) | change['deleted']['way']:
+            for way in self.osm.split_ways(wayID):
+                seeds.extend(way_edges(way))
+        for n in changedNodes:
+            seeds.extend(self.G.out_edges(n) + self.G.in_edges(n))
+        oldEdges, oldEnds = self.chainEdges(seeds)
+        oldIDs = {self.G.edge[u][v]['id'] for u, v in oldEdges}
+        oldWays, newWays, moved = update_osm(self.G, self.osm, change)
+        oldIDs.update(way.id for way in oldWays)
+        touched = set(moved) | {n for e in oldEdges for n in e}
+        for way in oldWays + newWays:
+            touched.update(way.nds)
+        self.updateNodes(touched)
+        # Chains after the change
+        seeds = [e for e in oldEdges if self.G.has_edge(*e)]
+        for way in newWays:
+            seeds.extend(way_edges(way))
+        for n in moved:
+            seeds.extend(self.G.out_edges(n) + self.G.in_edges(n))
+        newEdges, newEnds = self.chainEdges(seeds)
+        H = self.G.subgraph({n for e in newEdges for n in e})
+        newIDs = {attr['id'] for u, v, attr in H.edges(data=True)}
+        removedIDs = oldIDs | newIDs
+        for wayID in removedIDs:
+            for k in (wayID, wayID + '-F', wayID + '-B'):
+                self.ways.pop(k, None)
+        # Intersections at the ends of the changed chains
+        affected = {n for n in oldEnds | newEnds | touched if
+                    self.isIntersection(n)}
+        for n in oldEnds | newEnds | touched:
+            self.intersections.pop(n, None)
+            self.turnCache.pop(n, None)
+        self.crossStreetCache = {k: v for k, v in
+                                 self.crossStreetCache.items() if k[0] not in
+                                 oldEnds | newEnds | touched}
+        self.intersections.update(self.createIntersectionDict(
+            [n for n in affected if self.G.pred[n]]))
+        changedWays = self.createWaysDict(nx.edge_dfs(H,
+                                                      self.getStartNodes(H)))
+        self.ways.update(changedWays)
+        recalc = (set(changedWays) | self.waysAtNodes(affected) |
+                  self.waysAtNodes(affected, end=False))
+        self.waysToXY([self.ways[k] for k in recalc])
+        # xy keys and links without the -F/-B encoding
+        strip = lambda k: k[:-2] if k[-2:] in ('-F', '-B') else k
+        recalcIDs = {strip(k) for k in recalc}
+        for wayID in removedIDs:
+            self.xy.pop(wayID, None)
+        # Same as createXYDict, the last way in key order wins
+        for wayID in recalcIDs:
+            self.xy[wayID] = self.ways[max(k for k in (wayID, wayID + '-B',
+                                                       wayID + '-F') if k in
+                                           self.ways)]
+        linkNums = {self.wayIDToVissimLinkNumber(w) for w in
+                    removedIDs | recalcIDs}
+        for num in linkNums:
+            self.linkRecords.pop(num, None)
+        links = []
+        for wayID in recalcIDs:
+            record = self.linkRecord(wayID, self.xy[wayID])
+            self.linkRecords[record['no']] = record
+            links.append(record)
+        gone = linkNums - set(self.linkRecords)
+        # Connectors from recalculated links and from ways ending at changed
+        # intersections or feeding a recalculated link
+        fromNodes = affected | {self.xy[w]['nodes'][0] for w in recalcIDs}
+        fromIDs = {strip(k) for k in self.waysAtNodes(fromNodes)} | recalcIDs
+        fromLinks = {self.wayIDToVissimLinkNumber(w) for w in fromIDs} | gone
+        connectors = []
+        for wayID in fromIDs:
+            if wayID in self.xy:
+                connectors.extend(self.turnConnectors(wayID, self.xy[wayID]))
+        self.connectorsToXY(connectors)
+        self.connectorRecords = [c for c in self.connectorRecords if
+                                 c['fromLink'] not in fromLinks and
+                                 c['toLink'] not in gone] + connectors
+        self.ptStopRecords = [p for p in self.ptStopRecords if
+                              p['lane'].split()[0] not in gone]
+        self.patchModel(inpxFile, outFile or inpxFile, linkNums, fromLinks,
+                        gone, links, connectors)
+        log.info('Applied %s: %d links and %d connectors recalculated, %d '
+                 'links removed', oscFile, len(links), len(connectors),
+                 len(gone))
+
+    def patchModel(self, inpxFile, outFile, linkNums, fromLinks, gone, links,
+                   connectors):
+        """ Replace links and connectors of a converted model.
+            Input: .inpx file, output file, numbers of links to replace,
+                   from links of connectors to replace, numbers of removed
+                   links, new link records, new connector records
+            Output: written model
+        """
+        v = Vissim(inpxFile)
+        parent = v.data.xpath('./links')[0]
+        for link in list(parent.iterchildren('link')):
+            fromPt = link.find('fromLinkEndPt')
+            if fromPt is None:
+                if link.get('no') in linkNums:
+                    parent.remove(link)
+                continue
+            fromLink = fromPt.get('lane').split()[0]
+            toLink = link.find('toLinkEndPt').get('lane').split()[0]
+            if fromLink in fromLinks or toLink in gone:
+                parent.remove(link)
+        for stop in v.data.xpath('./ptStops/ptStop'):
+            if stop.get('lane').split()[0] in gone:
+                stop.getparent().remove(stop)
+        v.Links._getParams()
+        v.Links.createLinks(links)
+        v.Links.createConnectors(connectors)
+        v.export(outFile)
+
+
+# Tile worker state, set once per worker process by the pool initializer
+_tileWorker = None
+
+
+def _initTileWorker(state):
+    global _tileWorker
+    _tileWorker = OSM.__new__(OSM)
+    _tileWorker.__dict__.update(state)
+
+
+def _tileWays(task):
+    """ Create the ways of the chains of one tile.
+        Input: (dict of tile state, list of chains)
+        Output: list of ways dictionaries, one per chain
+    """
+    state, chains = task
+    _tileWorker.__dict__.update(state)
+    return [_tileWorker.createWaysDict(chain) for chain in chains]
+
+
+def _tileXY(task):
+    """ Calculate XY coordinates for the ways of one tile.
+        Input: (dict of tile state, list of wayIDs)
+        Output: list of (wayID, point3D, turns) tuples
+    """
+    state, wayIDs = task
+    _tileWorker.__dict__.update(state)
+    _tileWorker.turnCache = {}
+    _tileWorker.crossStreetCache = {}
+    attrs = _tileWorker.waysToXY([_tileWorker.ways[w] for w in wayIDs])
+    return [(w, attr['point3D'], attr['turns']) for w, attr in
+            zip(wayIDs, attrs)]
+
+
+def _tileConnectors(task):
+    """ Create the connector records of one tile.
+        Input: (ordered dict of the tile's xy ways, dict of tile and halo
+               link records)
+        Output: dict of connector records keyed by xy key
+    """
+    xy, links = task
+    _tileWorker.linkRecords = links
+    records = [(w, _tileWorker.turnConnectors(w, attr)) for w, attr in
+               xy.items()]
+    _tileWorker.connectorsToXY([c for w, cs in records for c in cs])
+    return dict(records)
+
+
+def convertMany(osmFiles, outDir, jobs=None, geoJSON=False, **kwargs):
+    """ Convert many OSM files concurrently, one file per worker process.
+        Input: list of .osm files and/or directories containing them, output
+               directory, number of files converted at once (defaults to the
+               number of CPUs), also write GeoJSON, OSM keyword arguments
+               (workers is the number of tile processes per file)
+        Output: list of result dicts (osmFile, outFile, geoJSONFile, seconds,
+                error) in input order
+    """
+    files = []
+    for f in ([osmFiles] if isinstance(osmFiles, basestring) else osmFiles):
+        if os.path.isdir(f):
+            files.extend(sorted(glob.glob(os.path.join(f, '*.osm'))))
+        else:
+            files.append(f)
+    if not os.path.isdir(outDir):
+        os.makedirs(outDir)
+    tasks = [(f, outDir, geoJSON, kwargs) for f in files]
+    jobs = min(jobs or multiprocessing.cpu_count(), len(tasks))
+    if jobs > 1 and kwargs.get('workers', 1) > 1:
+        # Pool processes can't start the tile pool of their file
+        log.info('Converting one file at a time with %d tile workers each',
+                 kwargs['workers'])
+        jobs = 1
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs)
+        try:
+            results = pool.map(_convertOne, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [_convertOne(task) for task in tasks]
+    failed = [r for r in results if r['error']]
+    for r in results:
+        if r['error']:
+            log.error('FAILED %s after %.2f s: %s', r['osmFile'],
+                      r['seconds'], r['error'])
+        else:
+            log.info('Converted %s to %s in %.2f s', r['osmFile'],
+                     r['outFile'], r['seconds'])
+    log.info('Converted %d of %d files, %.2f s total',
+             len(results) - len(failed), len(results),
+             sum(r['seconds'] for r in results))
+    return results
+
+
+def _convertOne(task):
+    """ Convert a single OSM file, catching any error.
+        Input: (osm file, output directory, write GeoJSON, OSM kwargs)
+        Output: result dict
+    """
+    osmFile, outDir, geoJSON, kwargs = task
+    name = os.path.splitext(os.path.basename(osmFile))[0]
+    result = {'osmFile': osmFile,
+              'outFile': os.path.join(outDir, name + '.inpx'),
+              'geoJSONFile': (os.path.join(outDir, name + '.geojson') if
+                              geoJSON else None),
+              'seconds': 0.0, 'error': None}
+    start = time.time()
+    try:
+        o = OSM(osmFile, outFile=result['outFile'], **kwargs)
+        if geoJSON:
+            GeoJSON(o.v).export(result['geoJSONFile'])
+    except Exception:
+        result['error'] = traceback.format_exc().strip().splitlines()[-1]
+    result['seconds'] = time.time() - start
+    return result
+
+
 #my added
 if __name__ == '__main__':
-	o=OSM(osmFile)
-
-#o = OSM(osmFile)
+    if len(sys.argv) == 1:
+        configureLogging()
+        o = OSM(osmFile)
+    else:
+        parser = argparse.ArgumentParser(description='Convert OSM files to '
+                                         'VISSIM networks.')
+        parser.add_argument('inputs', nargs='+',
+                            help='.osm files or directories of .osm files')
+        parser.add_argument('--out-dir', default='.',
+                            help='directory for the .inpx files')
+        parser.add_argument('--jobs', type=int, default=None,
+                            help='number of files converted at once')
+        parser.add_argument('--geojson', action='store_true',
+                            help='also write a .geojson file per network')
+        parser.add_argument('--include-bus-stops', action='store_true')
+        parser.add_argument('--cache-dir', default=None)
+        parser.add_argument('--curve-points', type=int, default=2)
+        parser.add_argument('--workers', type=int, default=1,
+                            help='processes per file for the tiled XY and '
+                            'connector stages')
+        parser.add_argument('--tile-size', type=float, default=None,
+                            help='tile side in meters for --workers')
+        parser.add_argument('--contract', action='store_true',
+                            help='merge degree-2 nodes into shape points')
+        parser.add_argument('--cluster-radius', type=float, default=0,
+                            help='merge intersection nodes within this many '
+                            'meters into one junction')
+        parser.add_argument('--change', default=None,
+                            help='.osc file to apply to a converted model')
+        parser.add_argument('--model', default=None,
+                            help='converted .inpx file patched by --change')
+        parser.add_argument('--log-level', default='INFO',
+                            help='DEBUG, INFO, WARNING or ERROR')
+        parser.add_argument('--no-progress', action='store_true',
+                            help='turn off stage progress metrics')
+        args = parser.parse_args()
+        if args.change and not args.model:
+            parser.error('--change requires --model')
+        configureLogging(args.log_level)
+        settings = {'includeBusStops': args.include_bus_stops,
+                    'cacheDir': args.cache_dir,
+                    'curvePoints': args.curve_points,
+                    'workers': args.workers, 'tileSize': args.tile_size,
+                    'contract': args.contract,
+                    'clusterRadius': args.cluster_radius,
+                    'progress': not args.no_progress}
+        if args.change:
+            o = OSM(args.inputs[0], outFile=None, **settings)
+            o.applyChanges(args.change, args.model)
+            sys.exit(0)
+        results = convertMany(args.inputs, args.out_dir, jobs=args.jobs,
+                              geoJSON=args.geojson, **settings)
+        sys.exit(1 if any(r['error'] for r in results) else 0)
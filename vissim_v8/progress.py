@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+""" Progress
+    Logging and progress metrics for conversions. Modules log to children of
+    the 'vissim_v8' logger, which stays silent until configureLogging is
+    called. A Progress reports the items per second, elapsed time and ETA of
+    a stage; a NullProgress is a drop in replacement that does nothing, so
+    reporting can be turned off entirely.
+"""
+import logging
+import sys
+import time
+
+log = logging.getLogger('vissim_v8')
+log.addHandler(logging.NullHandler())
+
+
+def getLogger(name):
+    """ Get the logger of a module.
+        Input: module name
+        Output: logging.Logger below the 'vissim_v8' logger
+    """
+    return logging.getLogger('vissim_v8.' + name.split('.')[-1])
+
+
+def configureLogging(level=logging.INFO, stream=None):
+    """ Send log messages of the package to a stream.
+        Input: level (number or name such as 'DEBUG'), stream (defaults to
+               stderr)
+        Output: handler added to the 'vissim_v8' logger
+    """
+    if isinstance(level, basestring):
+        level = getattr(logging, level.upper())
+    handler = logging.StreamHandler(stream or sys.stderr)
+    handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s '
+                                           '%(name)s: %(message)s'))
+    log.addHandler(handler)
+    log.setLevel(level)
+    return handler
+
+
+class Progress(object):
+    def __init__(self, stage, total=None, interval=5.0, logger=None):
+        """ Progress of a stage.
+            Input: stage name, expected number of items (for the ETA),
+                   seconds between reports, logger
+        """
+        self.stage = stage
+        self.total = total
+        self.interval = interval
+        self.log = logger or getLogger('progress')
+        self.count = 0
+        self.start = self.last = time.time()
+
+    def setTotal(self, total):
+        """ Set the expected number of items of the stage.
+            Input: number of items
+        """
+        self.total = total
+
+    def update(self, n=1):
+        """ Count processed items, reporting at most once per interval.
+            Input: number of items
+        """
+        self.count += n
+        now = time.time()
+        if now - self.last >= self.interval:
+            self.last = now
+            self.report(now)
+
+    def report(self, now=None):
+        elapsed = (now or time.time()) - self.start
+        rate = self.count / elapsed if elapsed > 0 else 0.0
+        if self.total and rate:
+            self.log.info('%s: %d/%d items, %.0f items/s, %.1f s elapsed, '
+                          'ETA %.1f s', self.stage, self.count, self.total,
+                          rate, elapsed, (self.total - self.count) / rate)
+        else:
+            self.log.info('%s: %d items, %.0f items/s, %.1f s elapsed',
+                          self.stage, self.count, rate, elapsed)
+
+    def close(self):
+        """ Finish the stage.
+            Output: dict of metrics (stage, items, seconds, rate)
+        """
+        seconds = time.time() - self.start
+        metrics = {'stage': self.stage, 'items': self.count,
+                   'seconds': seconds,
+                   'rate': self.count / seconds if seconds > 0 else 0.0}
+        self.log.info('%s done: %d items in %.2f s (%.0f items/s)',
+                      self.stage, self.count, seconds, metrics['rate'])
+        return metrics
+
+
+class NullProgress(object):
+    """ Progress that records and reports nothing.
+    """
+    stage = None
+    total = None
+    count = 0
+
+    def setTotal(self, total):
+        pass
+
+    def update(self, n=1):
+        pass
+
+    def report(self, now=None):
+        pass
+
+    def close(self):
+        return None
+
+
+NULL_PROGRESS = NullProgress()
+
+
+def startProgress(stage, total=None, enabled=True, **kwargs):
+    """ Create the progress reporter of a stage.
+        Input: stage name, expected number of items, enabled, Progress
+               keyword arguments
+        Output: Progress, NULL_PROGRESS when disabled
+    """
+    if not enabled:
+        return NULL_PROGRESS
+    return Progress(stage, total, **kwargs)
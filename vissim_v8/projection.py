@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+""" Projection
+    Conversion between WGS84 lat/lng and VISSIM network coordinates, shared by
+    the OSM importer and the GeoJSON exporter. All transforms take and return
+    float64 arrays so whole ways and links are converted in one call.
+"""
+import numpy as np
+
+EXTENT = 20015085  # height/width in meters of the VISSIM map
+
+
+def latLngToMeters(lat, lng):
+    """ Convert lat/lng to meters from 0,0 point on WGS84 map.
+        Input: WGS84 lat/lng arrays
+        Output: x, y arrays in meters
+    """
+    lat = np.asarray(lat, dtype=np.float64)
+    lng = np.asarray(lng, dtype=np.float64)
+    assert np.all(np.abs(lng) <= 180), '%s exceeds longitudinal domain' % (
+        lng)
+    x = lng * EXTENT / 180.0
+    y = np.log(np.tan((90 + lat) * np.pi / 360.0)) / (np.pi / 180.0)
+    y = y * EXTENT / 180.0
+    return x, y
+
+
+def metersToLatLng(x, y):
+    """ Convert meters from 0,0 point on WGS84 map to lat/lng.
+        Input: x, y arrays in meters
+        Output: WGS84 lat/lng arrays
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    lng = x * 180 / float(EXTENT)
+    y = y * 180 / float(EXTENT)
+    lat = np.arctan(np.exp(y * (np.pi / 180.0))) * (360 / np.pi) - 90
+    return lat, lng
+
+
+def tileSize(zoom):
+    """ Width of a web map tile in map meters.
+        Input: zoom level
+        Output: meters
+    """
+    return 2.0 * EXTENT / 2 ** zoom
+
+
+def metersToTile(x, y, zoom):
+    """ Find the z/x/y web map tiles of map points.
+        Input: x, y arrays in meters, zoom level
+        Output: tile column and row arrays
+    """
+    size = tileSize(zoom)
+    last = 2 ** zoom - 1
+    col = np.floor((np.asarray(x, dtype=np.float64) + EXTENT) / size)
+    row = np.floor((EXTENT - np.asarray(y, dtype=np.float64)) / size)
+    return (np.clip(col, 0, last).astype(np.int64),
+            np.clip(row, 0, last).astype(np.int64))
+
+
+def tileBounds(zoom, col, row):
+    """ Bounds of a web map tile.
+        Input: zoom level, tile column, tile row
+        Output: min x, min y, max x, max y in map meters
+    """
+    size = tileSize(zoom)
+    return (col * size - EXTENT, EXTENT - (row + 1) * size,
+            (col + 1) * size - EXTENT, EXTENT - row * size)
+
+
+class RefPoint(object):
+    """ Reference point of a VISSIM network: the map point (refPointMap) that
+        corresponds to the network point (refPointNet).
+    """
+    def __init__(self, lat, lng, startX=0.0, startY=0.0):
+        self.lat, self.lng = float(lat), float(lng)
+        x, y = latLngToMeters(self.lat, self.lng)
+        self.x, self.y = float(x), float(y)
+        self.startX, self.startY = float(startX), float(startY)
+        # Mercator scaling factor at the reference latitude
+        self.scale = 1 / np.cos(np.radians(self.lat))
+
+    @classmethod
+    def fromMeters(cls, x, y, startX=0.0, startY=0.0):
+        """ Create a reference point from map coordinates in meters.
+            Input: refPointMap x, y, refPointNet x, y
+            Output: RefPoint
+        """
+        lat, lng = metersToLatLng(x, y)
+        ref = cls(lat, lng, startX, startY)
+        # Keep the exact map coordinates instead of the round trip
+        ref.x, ref.y = float(x), float(y)
+        return ref
+
+    def toScaledMeters(self, lat, lng):
+        """ Convert lat/lng to scaled network coordinates.
+            Input: WGS84 lat/lng arrays
+            Output: x, y arrays
+        """
+        x, y = latLngToMeters(lat, lng)
+        scaleX = (x - self.x + self.startX) / self.scale
+        scaleY = (y - self.y + self.startY) / self.scale
+        return scaleX, scaleY
+
+    def scaledToMeters(self, x, y):
+        """ Convert scaled network coordinates to map meters.
+            Input: scaled x, y arrays
+            Output: x, y arrays in meters
+        """
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        mapX = (x * self.scale) + self.x - self.startX
+        mapY = (y * self.scale) + self.y - self.startY
+        return mapX, mapY
+
+    def fromScaledMeters(self, x, y):
+        """ Remove the Mercator scaling factor and reference point.
+            Input: scaled x, y arrays
+            Output: WGS84 lat/lng arrays
+        """
+        return metersToLatLng(*self.scaledToMeters(x, y))
@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+""" Spatial
+    Spatial indexes over network geometry. A SegmentIndex is built once from
+    the flat points of many polylines and answers nearest segment queries for
+    many points in a single batch; clusterPoints groups nearby points. A
+    PackedRTree is a static bounding box index laid out as a flat array, so it
+    can be written to a file and searched after reading it back.
+"""
+import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import cKDTree
+
+
+# Segments are indexed in pieces of at most this length (meters), so the
+# search radius of a query doesn't grow with the longest segment
+PIECE_LENGTH = 50.0
+
+
+class SegmentIndex(object):
+    def __init__(self, points, offsets, groups=None,
+                 pieceLength=PIECE_LENGTH):
+        """ Index the segments of many polylines by the midpoints of pieces
+            of at most pieceLength.
+            Input: flat array of x,y,z points of all polylines, start index of
+                   each polyline followed by the total number of points,
+                   optional group code per polyline (a negative code matches
+                   points of any group), maximum piece length
+        """
+        points = np.asarray(points, dtype=float).reshape(-1, 3)
+        offsets = np.asarray(offsets, dtype=np.int64)
+        counts = np.diff(offsets)
+        owner = np.repeat(np.arange(len(counts)), counts)
+        # A segment starts at every point except the last of each polyline
+        start = np.ones(len(points), dtype=bool)
+        start[offsets[1:][counts > 0] - 1] = False
+        idx = np.flatnonzero(start)
+        self.a = points[idx]
+        self.b = points[idx + 1]
+        self.owner = owner[idx]
+        self.segment = idx - offsets[:-1][self.owner]
+        length = np.sqrt(((self.b - self.a) ** 2).sum(axis=1))
+        # Distance along the polyline to the start of each segment
+        total = np.cumsum(length)
+        self.measure = total - length
+        firstSeg = np.flatnonzero(self.segment == 0)
+        self.measure -= np.repeat(self.measure[firstSeg],
+                                  np.diff(np.append(firstSeg, len(idx))))
+        self.lengths = np.zeros(len(counts))
+        np.add.at(self.lengths, self.owner, length)
+        self.groups = (np.full(len(counts), -1, dtype=np.int64) if groups is
+                       None else np.asarray(groups, dtype=np.int64))
+        # Split segments in equal pieces, any segment within d of a point
+        # has a piece midpoint within d + half the longest piece
+        pieces = np.maximum(np.ceil(length / pieceLength), 1).astype(np.int64)
+        self.pieceSegment = np.repeat(np.arange(len(idx)), pieces)
+        i = np.arange(pieces.sum()) - np.repeat(np.cumsum(pieces) - pieces,
+                                                pieces)
+        frac = (i + 0.5) / pieces[self.pieceSegment]
+        a, b = self.a[self.pieceSegment, :2], self.b[self.pieceSegment, :2]
+        mid = a + frac[:, None] * (b - a)
+        self.reach = (length / pieces).max() / 2.0 if len(length) else 0.0
+        self.tree = cKDTree(mid) if len(mid) else None
+
+    def query(self, points, maxDist, groups=None, side=None):
+        """ Find the nearest segment to each point.
+            Input: array of x,y(,z) points, maximum distance to a segment,
+                   optional group code per point (only polylines of the same
+                   group or a negative group are matched), optional side of
+                   the direction of travel the point must be on ('left' or
+                   'right')
+            Output: dict of arrays, one entry per point: polyline index (-1
+                    when nothing is within maxDist), segment index within the
+                    polyline, distance, nearest point on the segment and
+                    distance along the polyline to that point
+        """
+        pts = np.asarray(points, dtype=float)
+        pts = np.column_stack([pts[:, :2], np.zeros(len(pts))])
+        m = len(pts)
+        result = {'polyline': np.full(m, -1, dtype=np.int64),
+                  'segment': np.full(m, -1, dtype=np.int64),
+                  'distance': np.full(m, np.inf),
+                  'point': np.full((m, 3), np.nan),
+                  'measure': np.full(m, np.nan)}
+        if self.tree is None or m == 0:
+            return result
+        near = self.tree.query_ball_point(pts[:, :2], maxDist + self.reach)
+        counts = np.array([len(v) for v in near], dtype=np.int64)
+        if counts.sum() == 0:
+            return result
+        # Candidate (point, segment) pairs, each segment once even when
+        # several of its pieces are nearby
+        p = np.repeat(np.arange(m), counts)
+        s = self.pieceSegment[np.concatenate([np.asarray(v, dtype=np.int64)
+                                              for v in near])]
+        pairs = np.unique(p * len(self.a) + s)
+        p, s = pairs // len(self.a), pairs % len(self.a)
+        a, b = self.a[s], self.b[s]
+        vec = b[:, :2] - a[:, :2]
+        rel = pts[p, :2] - a[:, :2]
+        sq = (vec ** 2).sum(axis=1)
+        t = np.clip((rel * vec).sum(axis=1) / np.where(sq == 0, 1, sq), 0, 1)
+        foot = a + t[:, None] * (b - a)
+        dist = np.hypot(*(pts[p, :2] - foot[:, :2]).T)
+        keep = dist <= maxDist
+        if groups is not None:
+            groups = np.asarray(groups, dtype=np.int64)
+            owner = self.groups[self.owner[s]]
+            keep &= (owner < 0) | (owner == groups[p])
+        if side is not None:
+            cross = vec[:, 0] * rel[:, 1] - vec[:, 1] * rel[:, 0]
+            keep &= cross < 0 if side == 'right' else cross > 0
+        p, s, t, foot, dist = p[keep], s[keep], t[keep], foot[keep], dist[keep]
+        # Nearest candidate per point: sort by point then distance and keep
+        # the first pair of each point
+        order = np.lexsort((dist, p))
+        p, s, t, foot, dist = p[order], s[order], t[order], foot[order], \
+            dist[order]
+        first = np.ones(len(p), dtype=bool)
+        first[1:] = p[1:] != p[:-1]
+        p, s, t, foot, dist = p[first], s[first], t[first], foot[first], \
+            dist[first]
+        segLength = np.sqrt(((self.b[s] - self.a[s]) ** 2).sum(axis=1))
+        result['polyline'][p] = self.owner[s]
+        result['segment'][p] = self.segment[s]
+        result['distance'][p] = dist
+        result['point'][p] = foot
+        result['measure'][p] = self.measure[s] + t * segLength
+        return result
+
+
+def clusterPoints(points, radius):
+    """ Group points that are chained together by distances within a radius.
+        Input: array of x,y points, radius
+        Output: array of cluster labels, one per point
+    """
+    points = np.asarray(points, dtype=float).reshape(-1, 2)
+    n = len(points)
+    if n == 0:
+        return np.zeros(0, dtype=np.int64)
+    pairs = np.array(list(cKDTree(points).query_pairs(radius)),
+                     dtype=np.int64).reshape(-1, 2)
+    graph = coo_matrix((np.ones(len(pairs)), (pairs[:, 0], pairs[:, 1])),
+                       shape=(n, n))
+    count, labels = connected_components(graph, directed=False)
+    return labels
+
+
+def hilbertValues(x, y, bounds, bits=16):
+    """ Position of points along a Hilbert curve over a grid of 2^bits cells
+        per side covering bounds.
+        Input: x, y arrays, min x, min y, max x, max y, grid bits
+        Output: array of Hilbert distances
+    """
+    n = 1 << bits
+    xmin, ymin, xmax, ymax = bounds
+    w = float(xmax - xmin) or 1.0
+    h = float(ymax - ymin) or 1.0
+    x = np.clip(((np.asarray(x, dtype=float) - xmin) / w * (n - 1)), 0,
+                n - 1).astype(np.int64)
+    y = np.clip(((np.asarray(y, dtype=float) - ymin) / h * (n - 1)), 0,
+                n - 1).astype(np.int64)
+    d = np.zeros(len(x), dtype=np.int64)
+    s = n >> 1
+    while s > 0:
+        rx = (x & s) > 0
+        ry = (y & s) > 0
+        d += s * s * ((3 * rx) ^ ry)
+        # Rotate the quadrant so the curve stays continuous
+        flip = ~ry & rx
+        x = np.where(flip, n - 1 - x, x)
+        y = np.where(flip, n - 1 - y, y)
+        x, y = np.where(ry, x, y), np.where(ry, y, x)
+        s >>= 1
+    return d
+
+
+class PackedRTree(object):
+    # Node record: bounding box and offset. The offset of a leaf is the
+    # value stored with its box, the offset of any other node is the index
+    # of its first child.
+    nodeType = np.dtype([('minX', '<f8'), ('minY', '<f8'), ('maxX', '<f8'),
+                         ('maxY', '<f8'), ('offset', '<u8')])
+
+    def __init__(self, nodes, count, nodeSize=16):
+        """ Wrap the flat node array of a tree, root level first.
+            Input: structured node array, number of leaves, node size
+        """
+        self.nodes = nodes
+        self.count = count
+        self.nodeSize = nodeSize
+        sizes = self.levelSizes(count, nodeSize)
+        # (start, end) of each level in the node array, leaves first
+        ends = len(nodes) - np.cumsum([0] + sizes[:-1])
+        self.levels = [(int(e - n), int(e)) for e, n in zip(ends, sizes)]
+
+    @staticmethod
+    def levelSizes(count, nodeSize):
+        """ Number of nodes on each level of a tree.
+            Input: number of leaves, node size
+            Output: list of level sizes, leaves first
+        """
+        sizes = [count]
+        while sizes[-1] > 1:
+            sizes.append(-(-sizes[-1] // nodeSize))
+        return sizes
+
+    @classmethod
+    def build(cls, bounds, offsets, nodeSize=16):
+        """ Build a tree over boxes already sorted in a spatially coherent
+            order (e.g. by hilbertValues), grouping nodeSize consecutive
+            nodes per parent.
+            Input: array of min x, min y, max x, max y per leaf, leaf values,
+                   node size
+            Output: PackedRTree
+        """
+        bounds = np.asarray(bounds, dtype=float).reshape(-1, 4)
+        sizes = cls.levelSizes(len(bounds), nodeSize)
+        nodes = np.zeros(sum(sizes), dtype=cls.nodeType)
+        tree = cls(nodes, len(bounds), nodeSize)
+        start, end = tree.levels[0]
+        for name, col in zip(('minX', 'minY', 'maxX', 'maxY'), bounds.T):
+            nodes[name][start:end] = col
+        nodes['offset'][start:end] = offsets
+        for (childStart, childEnd), (start, end) in zip(tree.levels[:-1],
+                                                        tree.levels[1:]):
+            first = np.arange(childStart, childEnd, nodeSize)
+            nodes['offset'][start:end] = first
+            for name, reduce in (('minX', np.minimum), ('minY', np.minimum),
+                                 ('maxX', np.maximum), ('maxY', np.maximum)):
+                nodes[name][start:end] = reduce.reduceat(
+                    nodes[name][childStart:childEnd], first - childStart)
+        return tree
+
+    def search(self, bbox):
+        """ Find the leaves whose box intersects a box.
+            Input: min x, min y, max x, max y
+            Output: array of leaf values in tree order
+        """
+        xmin, ymin, xmax, ymax = bbox
+        if not self.count:
+            return np.zeros(0, dtype=np.uint64)
+        start, end = self.levels[-1]
+        idx = np.arange(start, end)
+        for depth in range(len(self.levels) - 1, -1, -1):
+            n = self.nodes[idx]
+            idx = idx[(n['minX'] <= xmax) & (n['maxX'] >= xmin) &
+                      (n['minY'] <= ymax) & (n['maxY'] >= ymin)]
+            if depth == 0:
+                return self.nodes['offset'][idx]
+            # Children of the matching nodes
+            childEnd = self.levels[depth - 1][1]
+            first = self.nodes['offset'][idx].astype(np.int64)
+            count = np.minimum(first + self.nodeSize, childEnd) - first
+            idx = (np.arange(count.sum()) -
+                   np.repeat(np.cumsum(count) - count, count) +
+                   np.repeat(first, count))
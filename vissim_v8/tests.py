@@ -1,5 +1,20 @@
+import json
+import os
+import shutil
+import tempfile
 import unittest
+import StringIO
+import geojson
+import numpy as np
+from lxml import etree
 import vissim_v8 as vissim
+from vissim_v8 import geo_math as geo
+from vissim_v8 import projection as proj
+from vissim_v8.spatial import PackedRTree, SegmentIndex, clusterPoints, \
+    hilbertValues
+from vissim_v8 import progress
+from vissim_v8.vissim_to_geojson import LAYERS, TILE_LAYERS, inpxToGeoJSON, \
+    readBinary
 
 network_path = 'test_networks/Busmall.inpx'
 osm_path = 'test_networks/temescal.osm'
@@ -361,6 +376,581 @@ class staticrouting_unittest(unittest.TestCase):
                          answer)
 
 
+class geo_unittest(unittest.TestCase):
+    def test_compassBearing(self):
+        lat1 = [37.8, 37.8, 37.8, 37.8]
+        lng1 = [-122.27, -122.27, -122.27, -122.27]
+        lat2 = [37.81, 37.8, 37.79, 37.8]
+        lng2 = [-122.27, -122.26, -122.27, -122.28]
+        answer = [0.0, 90.0, 180.0, 270.0]
+        bearings = geo.compassBearing(lat1, lng1, lat2, lng2)
+        np.testing.assert_allclose(bearings, answer, atol=0.1)
+
+    def test_getLength(self):
+        points = [(0.0, 0.0, 0.0), (3.0, 4.0, 0.0), (3.0, 10.0, 0.0)]
+        self.assertAlmostEqual(geo.getLength(points), 11.0)
+
+    def test_offsetParallel(self):
+        points = [(0.0, 0.0, 0.0), (0.0, 10.0, 0.0), (0.0, 20.0, 0.0)]
+        offset = geo.offsetParallel(points, 2.0)
+        self.assertEqual(offset.dtype, np.float64)
+        np.testing.assert_allclose(offset[:, 0], [2.0, 2.0, 2.0])
+
+    def test_offsetParallelBatch(self):
+        points = [(0.0, 0.0, 0.0), (10.0, 0.0, 0.0), (10.0, 10.0, 0.0),
+                  (0.0, 0.0, 0.0), (0.0, 10.0, 0.0)]
+        offset = geo.offsetParallelBatch(points, [0, 3, 5], [1.0, -1.0])
+        answer = [(0.0, -1.0, 0.0), (11.0, -1.0, 0.0), (11.0, 10.0, 0.0),
+                  (-1.0, 0.0, 0.0), (-1.0, 10.0, 0.0)]
+        np.testing.assert_allclose(offset, answer)
+
+    def test_offsetEndpointBatch(self):
+        points = [(0.0, 0.0, 0.0), (10.0, 0.0, 0.0), (0.0, 0.0, 0.0),
+                  (0.0, 1.0, 0.0)]
+        trimmed = geo.offsetEndpointBatch(points, [0, 2, 4], [2.0, 0.0],
+                                          [3.0, 5.0])
+        answer = [(2.0, 0.0, 0.0), (7.0, 0.0, 0.0), (0.0, 0.0, 0.0),
+                  (0.0, 0.01, 0.0)]
+        np.testing.assert_allclose(trimmed, answer)
+
+    def test_laneGeometryBatch(self):
+        points = [(0.0, 0.0, 0.0), (100.0, 0.0, 0.0), (0.0, 0.0, 0.0),
+                  (0.0, 80.0, 0.0)]
+        centers, centerOffsets, edges, edgeOffsets = geo.laneGeometryBatch(
+            points, [0, 2, 4], [[3.5, 3.0], [4.0]])
+        self.assertEqual(centerOffsets.tolist(), [0, 2, 4, 6])
+        self.assertEqual(edgeOffsets.tolist(), [0, 2, 4, 6, 8, 10])
+        np.testing.assert_allclose(centers[::2, :2], [(0.0, -1.5),
+                                                      (0.0, 1.75),
+                                                      (0.0, 0.0)])
+        np.testing.assert_allclose(edges[::2, :2], [(0.0, -3.25), (0.0, 0.25),
+                                                    (0.0, 3.25), (2.0, 0.0),
+                                                    (-2.0, 0.0)])
+
+    def test_interpolateBatch(self):
+        points = [(0.0, 0.0, 0.0), (100.0, 0.0, 0.0), (0.0, 0.0, 0.0),
+                  (0.0, 50.0, 0.0), (0.0, 80.0, 0.0)]
+        located = geo.interpolateBatch(points, [0, 2, 5], [0, 1, 1, 0],
+                                       [50.0, 60.0, -5.0, 500.0])
+        np.testing.assert_allclose(located, [(50.0, 0.0, 0.0),
+                                             (0.0, 60.0, 0.0),
+                                             (0.0, 0.0, 0.0),
+                                             (100.0, 0.0, 0.0)])
+
+    def test_projectBatch(self):
+        points = [(0.0, 0.0, 0.0), (10.0, 0.0, 0.0), (10.0, 10.0, 0.0),
+                  (0.0, 0.0, 0.0), (0.0, 5.0, 0.0)]
+        measures, dist = geo.projectBatch(points, [0, 3, 5], [0, 0, 1],
+                                          [(4.0, 1.0), (12.0, 6.0),
+                                           (1.0, 2.0)])
+        np.testing.assert_allclose(measures, [4.0, 16.0, 2.0])
+        np.testing.assert_allclose(dist, [1.0, 2.0, 1.0])
+        located = geo.interpolateBatch(points, [0, 3, 5], [0, 1], [16.0, 9.0])
+        np.testing.assert_allclose(located, [(10.0, 6.0, 0.0),
+                                             (0.0, 5.0, 0.0)])
+
+    def test_simplifyBatch(self):
+        points = [(0.0, 0.0, 0.0), (1.0, 0.1, 0.0), (2.0, -0.1, 0.0),
+                  (3.0, 5.0, 0.0), (4.0, 6.0, 0.0), (5.0, 7.0, 0.0),
+                  (0.0, 0.0, 0.0), (1.0, 0.0, 0.0), (2.0, 0.0, 0.0)]
+        keep = geo.simplifyBatch(points, [0, 6, 9], 0.5)
+        self.assertEqual(keep.tolist(), [True, False, True, True, False,
+                                         True, True, False, True])
+        keep = geo.simplifyBatch(points, [0, 6, 9], 0.05)
+        self.assertEqual(keep.tolist(), [True, True, True, True, False,
+                                         True, True, False, True])
+
+    def test_remapMeasures(self):
+        points = [(0.0, 0.0, 0.0), (1.0, 1.0, 0.0), (2.0, 0.0, 0.0),
+                  (0.0, 0.0, 0.0), (3.0, 0.0, 0.0)]
+        keep = [True, False, True, True, True]
+        half = np.sqrt(2)
+        measures = geo.remapMeasures(points, [0, 3, 5], keep, [0, 0, 0, 1],
+                                     [0.0, half, 2 * half + 1, 1.5])
+        np.testing.assert_allclose(measures, [0.0, 1.0, 2.0, 1.5])
+
+    def test_clipPolylines(self):
+        points = [(-1.0, 0.5, 0.0), (2.0, 0.5, 0.0), (2.0, 3.0, 0.0),
+                  (0.5, 3.0, 0.0), (0.5, 0.2, 0.0), (5.0, 5.0, 0.0),
+                  (6.0, 6.0, 0.0)]
+        parts, offsets, owner = geo.clipPolylines(points, [0, 5, 7],
+                                                  (0.0, 0.0, 1.0, 1.0))
+        np.testing.assert_allclose(parts[:, :2], [(0.0, 0.5), (1.0, 0.5),
+                                                  (0.5, 1.0), (0.5, 0.2)])
+        self.assertEqual(offsets.tolist(), [0, 2, 4])
+        self.assertEqual(owner.tolist(), [0, 0])
+
+    def test_bezierBatch(self):
+        start = [(0.0, 0.0, 0.0), (0.0, 0.0, 0.0), (0.0, 0.0, 0.0)]
+        startDir = [(1.0, 0.0, 0.0), (0.0, 1.0, 0.0), (1.0, 0.0, 0.0)]
+        end = [(10.0, 10.0, 0.0), (0.0, 10.0, 0.0), (10.0, 1.0, 0.0)]
+        endDir = [(0.0, 1.0, 0.0), (0.0, 1.0, 0.0), (1.0, 0.0, 0.0)]
+        curves = geo.bezierBatch(start, startDir, end, endDir, 3)
+        self.assertEqual(curves.shape, (3, 3, 3))
+        # Right angle turn bends toward the corner
+        np.testing.assert_allclose(curves[0, 1], [7.5, 2.5, 0.0])
+        # Vertical and parallel tangents give straight lines
+        np.testing.assert_allclose(curves[1, 1], [0.0, 5.0, 0.0])
+        np.testing.assert_allclose(curves[2, 1], [5.0, 0.5, 0.0])
+
+
+class spatial_unittest(unittest.TestCase):
+    def setUp(self):
+        # An L shaped polyline and a polyline running back along the x axis
+        points = [(0.0, 0.0, 0.0), (10.0, 0.0, 0.0), (10.0, 10.0, 0.0),
+                  (10.0, -2.0, 0.0), (0.0, -2.0, 0.0)]
+        self.index = SegmentIndex(points, [0, 3, 5], groups=[0, 1])
+
+    def test_query(self):
+        nearest = self.index.query([(4.0, -0.5), (12.0, 6.0), (50.0, 50.0)],
+                                   5.0)
+        np.testing.assert_array_equal(nearest['polyline'], [0, 0, -1])
+        np.testing.assert_array_equal(nearest['segment'], [0, 1, -1])
+        np.testing.assert_allclose(nearest['distance'][:2], [0.5, 2.0])
+        np.testing.assert_allclose(nearest['measure'][:2], [4.0, 16.0])
+
+    def test_queryFilters(self):
+        point = [(4.0, -1.5)]
+        self.assertEqual(self.index.query(point, 5.0)['polyline'][0], 1)
+        self.assertEqual(self.index.query(point, 5.0,
+                                          groups=[0])['polyline'][0], 0)
+        self.assertEqual(self.index.query(point, 5.0, groups=[0],
+                                          side='right')['polyline'][0], 0)
+        self.assertEqual(self.index.query(point, 5.0,
+                                          side='left')['polyline'][0], -1)
+        self.assertEqual(self.index.query(point, 1.0,
+                                          groups=[0])['polyline'][0], -1)
+
+    def test_queryLongSegment(self):
+        # A 10 km segment is indexed in pieces, so the search radius stays
+        # bounded and points along the whole segment are found
+        index = SegmentIndex([(0.0, 0.0, 0.0), (10000.0, 0.0, 0.0),
+                              (0.0, 5.0, 0.0), (1.0, 5.0, 0.0)], [0, 2, 4],
+                             pieceLength=50.0)
+        self.assertLessEqual(index.reach, 25.0)
+        nearest = index.query([(5000.0, 3.0), (9990.0, -1.0), (0.5, 4.0)],
+                              5.0)
+        np.testing.assert_array_equal(nearest['polyline'], [0, 0, 1])
+        np.testing.assert_allclose(nearest['measure'], [5000.0, 9990.0, 0.5])
+
+    def test_clusterPoints(self):
+        points = [(0.0, 0.0), (8.0, 0.0), (16.0, 0.0), (100.0, 0.0)]
+        labels = clusterPoints(points, 10.0)
+        self.assertEqual(labels[0], labels[1])
+        self.assertEqual(labels[1], labels[2])
+        self.assertNotEqual(labels[0], labels[3])
+
+    def test_packedRTree(self):
+        np.random.seed(0)
+        corner = np.random.rand(100, 2) * 100
+        bounds = np.column_stack([corner, corner + 1])
+        order = np.argsort(hilbertValues(corner[:, 0], corner[:, 1],
+                                         (0, 0, 100, 100)))
+        tree = PackedRTree.build(bounds[order], order, nodeSize=4)
+        nodes = np.frombuffer(tree.nodes.tobytes(), PackedRTree.nodeType)
+        found = PackedRTree(nodes, 100, 4).search((20, 20, 40, 60))
+        expected = np.flatnonzero((bounds[:, 0] <= 40) & (bounds[:, 2] >= 20) &
+                                  (bounds[:, 1] <= 60) & (bounds[:, 3] >= 20))
+        self.assertEqual(sorted(found), list(expected))
+
+
+class projection_unittest(unittest.TestCase):
+    def test_roundTrip(self):
+        ref = proj.RefPoint(37.8, -122.27)
+        lat = np.array([37.8, 37.801, 37.79])
+        lng = np.array([-122.27, -122.2695, -122.28])
+        x, y = ref.toScaledMeters(lat, lng)
+        self.assertAlmostEqual(x[0], 0)
+        self.assertAlmostEqual(y[0], 0)
+        lat2, lng2 = ref.fromScaledMeters(x, y)
+        np.testing.assert_allclose(lat2, lat, atol=1e-9)
+        np.testing.assert_allclose(lng2, lng, atol=1e-9)
+
+    def test_tiles(self):
+        x, y = proj.latLngToMeters(37.8, -122.27)
+        col, row = proj.metersToTile(x, y, 12)
+        # Standard web map tile of the point
+        self.assertEqual((int(col), int(row)), (656, 1582))
+        xmin, ymin, xmax, ymax = proj.tileBounds(12, col, row)
+        self.assertTrue(xmin <= x < xmax and ymin < y <= ymax)
+
+
+class progress_unittest(unittest.TestCase):
+    def test_metrics(self):
+        p = progress.startProgress('ways', total=10, interval=0)
+        for i in range(4):
+            p.update()
+        p.update(6)
+        metrics = p.close()
+        self.assertEqual(metrics['stage'], 'ways')
+        self.assertEqual(metrics['items'], 10)
+        self.assertGreaterEqual(metrics['rate'], 0.0)
+
+    def test_disabled(self):
+        p = progress.startProgress('ways', total=10, enabled=False)
+        p.update(10)
+        self.assertIs(p, progress.NULL_PROGRESS)
+        self.assertIsNone(p.close())
+
+
+class geometry_unittest(unittest.TestCase):
+    def setUp(self):
+        v = vissim.Vissim()
+        v.Links.createLinks([{'no': 1, 'point3D': [(0, 0, 0), (50, 0.1, 0),
+                                                   (100, 0, 0), (100, 50, 0)],
+                              'lane': [3.5]}])
+        v.PTStop.createptStops([{'lane': '1 1', 'pos': 140.0}])
+        self.v = v
+
+    def test_simplify(self):
+        self.assertEqual(self.v.Links.simplify(0.01), 0)
+        self.assertEqual(self.v.Links.simplify(0.5, links=[2]), 0)
+        self.assertEqual(self.v.Links.simplify(0.5), 1)
+        geos = self.v.Links.getGeometries(1)
+        self.assertEqual([(float(g['x']), float(g['y'])) for g in geos],
+                         [(0.0, 0.0), (100.0, 0.0), (100.0, 50.0)])
+        stop = self.v.PTStop.getptStop(1)
+        self.assertAlmostEqual(float(stop['pos']), 140.0, places=3)
+
+    def test_linearReferencing(self):
+        links = self.v.Links
+        np.testing.assert_allclose(links.locate(1, [100.0, 120.0])[1],
+                                   (100.0, 20.0, 0.0), atol=1e-3)
+        np.testing.assert_allclose(links.project(1, [(101.0, 30.0)]),
+                                   [130.0], atol=1e-3)
+        points = links.locateMany([1, 1], [0.0, 500.0])
+        np.testing.assert_allclose(points, [(0.0, 0.0, 0.0),
+                                            (100.0, 50.0, 0.0)])
+        np.testing.assert_allclose(links.projectMany([1], points[1:]),
+                                   [links.getLinkLength(1)])
+        # The cached lengths follow geometry changes
+        links.setGeometries([{'no': 1, 'point3D': [(0, 0, 0), (0, 60, 0)]}])
+        self.assertAlmostEqual(links.getLinkLength(1), 60.0)
+        np.testing.assert_allclose(links.locate(1, 30.0), [(0.0, 30.0, 0.0)])
+        self.assertRaises(KeyError, links.locate, 2, [0.0])
+
+
+class geojson_unittest(unittest.TestCase):
+    def setUp(self):
+        v = vissim.Vissim()
+        v.createReference(0.0, 0.0)
+        v.Links.createLinks([{'no': 1, 'point3D': [(0, 0, 0), (100, 0, 0)],
+                              'lane': [3.5, 3.5]},
+                             {'no': 2, 'point3D': [(0, 0, 0), (0, 50, 0),
+                                                   (0, 80, 0)],
+                              'lane': [3.5]}])
+        v.PTStop.createptStops([{'lane': '1 2', 'pos': 50.0}])
+        self.v = v
+        self.geo = vissim.GeoJSON(v)
+
+    def test_export(self):
+        f = StringIO.StringIO()
+        self.geo.export(f)
+        collection = json.loads(f.getvalue())
+        self.assertEqual(collection,
+                         json.loads(geojson.dumps(self.geo.geojson)))
+        self.assertEqual([feat['properties']['lane'] for feat in
+                          collection['features']], ['2', '1'])
+
+    def test_exportNDJSON(self):
+        f = StringIO.StringIO()
+        self.geo.export(f)
+        features = json.loads(f.getvalue())['features']
+        f = StringIO.StringIO()
+        self.geo.export(f, ndjson=True, batchSize=1)
+        lines = f.getvalue().splitlines()
+        self.assertEqual([json.loads(line) for line in lines], features)
+
+    def test_inpxToGeoJSON(self):
+        f = StringIO.StringIO()
+        self.geo.export(f)
+        inpx = StringIO.StringIO()
+        self.v.export(inpx)
+        inpx.seek(0)
+        out = StringIO.StringIO()
+        self.assertEqual(inpxToGeoJSON(inpx, out, batchSize=1), 2)
+        self.assertEqual(json.loads(out.getvalue()), json.loads(f.getvalue()))
+
+    def test_layers(self):
+        f = StringIO.StringIO()
+        self.geo.export(f, layers=LAYERS)
+        features = json.loads(f.getvalue())['features']
+        layers = [feat['properties'].get('layer', 'links') for feat in
+                  features]
+        self.assertEqual(layers, ['links', 'links', 'lanes', 'lanePolygons',
+                                  'lanes', 'lanePolygons', 'lanes',
+                                  'lanePolygons', 'ptStops'])
+        polygon = features[3]['geometry']['coordinates'][0]
+        self.assertEqual(polygon[0], polygon[-1])
+        self.assertEqual(len(polygon), 5)
+        inpx = StringIO.StringIO()
+        self.v.export(inpx)
+        inpx.seek(0)
+        out = StringIO.StringIO()
+        inpxToGeoJSON(inpx, out, layers=LAYERS)
+        self.assertEqual(json.loads(out.getvalue())['features'], features)
+
+    def test_exportTiles(self):
+        outDir = tempfile.mkdtemp()
+        try:
+            tiles = self.geo.exportTiles(outDir, 16, 17, layers=TILE_LAYERS,
+                                         workers=1)
+            self.assertEqual(set(z for z, x, y, n in tiles), set([16, 17]))
+            for z, x, y, n in tiles:
+                filename = os.path.join(outDir, str(z), str(x),
+                                        '%d.geojson' % (y))
+                with open(filename) as f:
+                    self.assertEqual(len(json.load(f)['features']), n)
+        finally:
+            shutil.rmtree(outDir)
+
+    def test_importGeoJSON(self):
+        f = StringIO.StringIO()
+        self.geo.export(f)
+        collection = json.loads(f.getvalue())
+        # Move the end of link 2, drop a lane of link 1 and add a new link
+        lat, lng = collection['features'][1]['geometry']['coordinates'][-1]
+        collection['features'][1]['geometry']['coordinates'][-1] = \
+            [lat + 0.0001, lng]
+        collection['features'][0]['properties']['lane'] = '1'
+        new = [[lat, lng], [lat, lng + 0.0001]]
+        updated, created = vissim.importGeoJSON(
+            self.v, StringIO.StringIO(json.dumps(collection)))
+        self.assertEqual(updated, ['1', '2'])
+        self.assertEqual(created, [])
+        self.assertEqual(len(self.v.Links.getLanes(1)), 1)
+        end = self.v.Links.getGeometries(2)[-1]
+        self.assertAlmostEqual(float(end['x']), 0.0, places=1)
+        self.assertGreater(float(end['y']), 80.0)
+        updated, created = vissim.importGeoJSON(self.v, {'3': new})
+        self.assertEqual(created, ['3'])
+        self.assertEqual(len(self.v.Links.getGeometries(3)), 2)
+
+    def test_exportBinary(self):
+        f = StringIO.StringIO()
+        self.geo.export(f, layers=LAYERS)
+        features = json.loads(f.getvalue())['features']
+        out = StringIO.StringIO()
+        self.assertEqual(self.geo.exportBinary(out, layers=LAYERS),
+                         len(features))
+        out.seek(0)
+        key = lambda feat: json.dumps(feat, sort_keys=True)
+        self.assertEqual(sorted(map(key, readBinary(out))),
+                         sorted(map(key, features)))
+        # Only the links layer feature of link 1 reaches its end
+        lat, lng = features[0]['geometry']['coordinates'][-1]
+        out.seek(0)
+        found = readBinary(out, (lat - 1e-6, lng - 1e-6, lat + 1e-6,
+                                 lng + 1e-6))
+        self.assertIn(features[0], found)
+        self.assertNotIn(features[1], found)
+
+
+def writeGridOSM(filename, n=5):
+    """ Write an n x n grid of two-way rows with a shape node between
+        intersections and alternating one-way and two-way columns.
+    """
+    nid = lambda i, j: 1000 + i * n + j
+    lines = ['<?xml version="1.0" encoding="UTF-8"?>', '<osm version="0.6">']
+    for i in range(n):
+        for j in range(n):
+            lines.append('<node id="%d" lat="%f" lon="%f"/>' %
+                         (nid(i, j), 37.8 + i * 0.001, -122.27 + j * 0.001))
+    for i in range(n):
+        nds = []
+        for j in range(n):
+            nds.append(nid(i, j))
+            if j < n - 1:
+                shape = 9000 + i * n + j
+                lines.append('<node id="%d" lat="%f" lon="%f"/>' %
+                             (shape, 37.8 + i * 0.001 + 0.00005,
+                              -122.27 + j * 0.001 + 0.0005))
+                nds.append(shape)
+        lines.append('<way id="%d">%s<tag k="highway" v="primary"/>'
+                     '<tag k="lanes" v="4"/></way>' %
+                     (1 + i, ''.join('<nd ref="%d"/>' % k for k in nds)))
+    for j in range(n):
+        tags = '<tag k="oneway" v="yes"/><tag k="lanes" v="2"/>' if j % 2 \
+            else ''
+        lines.append('<way id="%d">%s<tag k="highway" v="secondary"/>%s'
+                     '</way>' % (100 + j, ''.join('<nd ref="%d"/>' % nid(i, j)
+                                                  for i in range(n)), tags))
+    lines.append('</osm>')
+    with open(filename, 'w') as f:
+        f.write('\n'.join(lines))
+
+
+class conversion_unittest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.osmFile = os.path.join(self.dir, 'grid.osm')
+        writeGridOSM(self.osmFile)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def convert(self, name, **kwargs):
+        outFile = os.path.join(self.dir, name + '.inpx')
+        vissim.OSM(self.osmFile, outFile=outFile, progress=False, **kwargs)
+        with open(outFile) as f:
+            return f.read()
+
+    def test_checkpoints(self):
+        cacheDir = os.path.join(self.dir, 'cache')
+        self.convert('first', cacheDir=cacheDir)
+        # Ways are loaded from the checkpoint, XY and later stages rerun
+        resumed = self.convert('resumed', cacheDir=cacheDir, laneWidth=3.0)
+        self.assertEqual(resumed, self.convert('cold', laneWidth=3.0))
+        self.assertEqual(self.convert('loaded', cacheDir=cacheDir,
+                                      laneWidth=3.0), resumed)
+
+    def test_tiled(self):
+        self.assertEqual(self.convert('tiled', workers=2, tileSize=150.0),
+                         self.convert('serial'))
+        # A tile only receives its ways and the approaches of the
+        # intersections they end at
+        o = vissim.OSM(self.osmFile, outFile=None, progress=False)
+        state = o.tileXYState(['1-0-F'])
+        self.assertEqual(sorted(state['ways']),
+                         ['1-0-B', '1-0-F', '1-1-B', '1-1-F', '100-0-B',
+                          '100-0-F', '101-0'])
+        self.assertEqual(state['intersections'].keys(), ['1001'])
+        self.assertEqual(sorted(state['G']), ['1000', '1001', '1005', '1006',
+                                              '9000', '9001'])
+        self.assertEqual(sorted(state['nodeIndex']), ['1000', '1001',
+                                                      '9000'])
+
+    def modelLinks(self, inpxFile):
+        """ Links by number and connectors by their from and to lanes, as
+            serialized XML without the connector number.
+        """
+        links, connectors = {}, {}
+        for link in etree.parse(inpxFile).getroot().xpath('./links/link'):
+            link.tail = None
+            fromPt = link.find('fromLinkEndPt')
+            if fromPt is None:
+                links[link.get('no')] = etree.tostring(link)
+            else:
+                key = (fromPt.get('lane'),
+                       link.find('toLinkEndPt').get('lane'))
+                del link.attrib['no']
+                connectors[key] = etree.tostring(link)
+        return links, connectors
+
+    def test_applyChanges(self):
+        with open(self.osmFile) as f:
+            lines = f.read().split('\n')
+        for i, line in enumerate(lines):
+            if line.startswith('<way id="2">'):
+                way = line.replace('v="4"', 'v="2"')
+                lines[i] = way
+        edited = os.path.join(self.dir, 'edited.osm')
+        with open(edited, 'w') as f:
+            f.write('\n'.join(lines))
+        oscFile = os.path.join(self.dir, 'change.osc')
+        with open(oscFile, 'w') as f:
+            f.write('<osmChange version="0.6"><modify>%s</modify>'
+                    '</osmChange>' % way)
+        inpxFile = os.path.join(self.dir, 'model.inpx')
+        patched = os.path.join(self.dir, 'patched.inpx')
+        vissim.OSM(self.osmFile, outFile=inpxFile, progress=False)
+        o = vissim.OSM(self.osmFile, outFile=None, progress=False)
+        links = dict(o.linkRecords)
+        o.applyChanges(oscFile, inpxFile, patched)
+        # Only the links of the changed way and the intersections along it
+        # are recalculated
+        recalculated = [k for k in links if o.linkRecords[k] is not links[k]]
+        self.assertLess(len(recalculated), len(links) / 2)
+        cold = os.path.join(self.dir, 'cold.inpx')
+        vissim.OSM(edited, outFile=cold, progress=False)
+        self.assertEqual(self.modelLinks(patched), self.modelLinks(cold))
+        self.assertNotEqual(self.modelLinks(patched),
+                            self.modelLinks(inpxFile))
+
+    def test_selfLoops(self):
+        for n in (5, 6):
+            writeGridOSM(self.osmFile, n)
+            self.convert('grid')
+            links, connectors = self.modelLinks(
+                os.path.join(self.dir, 'grid.inpx'))
+            self.assertTrue(connectors)
+            self.assertEqual([(f, t) for f, t in connectors if
+                              f.split()[0] == t.split()[0]], [])
+
+    def test_startNodes(self):
+        o = vissim.OSM(self.osmFile, outFile=None, progress=False)
+        G = o.G
+        self.assertEqual(o.getStartNodes(),
+                         sorted(n for n in G if not G.pred[n] or
+                                o.isIntersection(n)))
+        # Ways are walked from intersection to intersection
+        self.assertEqual(o.ways['1-0-F']['nodes'], ['1000', '9000', '1001'])
+        # A loop without entries or intersections starts at its first node
+        G.add_path(['c', 'b', 'a', 'c'], id='0', highway='primary')
+        self.assertEqual(o.getStartNodes()[-1:], ['a'])
+        self.assertEqual(o.getStartNodes(G.subgraph(['a', 'b', 'c'])),
+                         ['a'])
+
+    def test_contract(self):
+        # Way 10 runs through shape nodes 2 and 3 to the junction with way 20
+        with open(self.osmFile, 'w') as f:
+            f.write('\n'.join(
+                ['<?xml version="1.0" encoding="UTF-8"?>',
+                 '<osm version="0.6">'] +
+                ['<node id="%d" lat="%f" lon="%f"/>' % n for n in
+                 [(1, 37.8, -122.27), (2, 37.8003, -122.269),
+                  (3, 37.8002, -122.268), (4, 37.8, -122.267),
+                  (5, 37.799, -122.267), (6, 37.801, -122.267)]] +
+                ['<way id="10"><nd ref="1"/><nd ref="2"/><nd ref="3"/>'
+                 '<nd ref="4"/><tag k="highway" v="primary"/>'
+                 '<tag k="lanes" v="4"/></way>',
+                 '<way id="20"><nd ref="5"/><nd ref="4"/><nd ref="6"/>'
+                 '<tag k="highway" v="secondary"/>'
+                 '<tag k="lanes" v="2"/></way>', '</osm>']))
+        outFile = os.path.join(self.dir, 'contracted.inpx')
+        o = vissim.OSM(self.osmFile, outFile=outFile, contract=True,
+                       progress=False)
+        self.assertEqual(sorted(o.G.nodes()), ['1', '4', '5', '6'])
+        link = [r for r in o.linkRecords.values() if r['wayID'] == '10-0']
+        self.assertEqual(len(link), 1)
+        self.assertEqual(len(link[0]['point3D']), 4)
+        self.assertEqual(link[0]['lane'], [3.6, 3.6])
+        with open(outFile) as f:
+            self.assertEqual(f.read(), self.convert('plain'))
+
+    def test_cluster(self):
+        # Way 20 crosses one-way ways 10 and 30 at nodes 4 and 7, 2m apart
+        with open(self.osmFile, 'w') as f:
+            f.write('\n'.join(
+                ['<?xml version="1.0" encoding="UTF-8"?>',
+                 '<osm version="0.6">'] +
+                ['<node id="%d" lat="%f" lon="%f"/>' % n for n in
+                 [(1, 37.8, -122.27), (2, 37.8, -122.268),
+                  (3, 37.80002, -122.268), (4, 37.8, -122.269),
+                  (5, 37.799, -122.269), (6, 37.801, -122.269),
+                  (7, 37.80002, -122.269)]] +
+                ['<way id="10"><nd ref="1"/><nd ref="4"/><nd ref="2"/>'
+                 '<tag k="highway" v="primary"/>'
+                 '<tag k="oneway" v="yes"/></way>',
+                 '<way id="30"><nd ref="1"/><nd ref="7"/><nd ref="3"/>'
+                 '<tag k="highway" v="primary"/>'
+                 '<tag k="oneway" v="yes"/></way>',
+                 '<way id="20"><nd ref="5"/><nd ref="4"/><nd ref="7"/>'
+                 '<nd ref="6"/><tag k="highway" v="secondary"/></way>',
+                 '</osm>']))
+        o = vissim.OSM(self.osmFile, outFile=None, progress=False)
+        o.G.node['4']['role'] = 'signal'
+        o.clusterRadius = 5
+        self.assertEqual(o.clusterIntersections(), 1)
+        self.assertEqual(o.G.node['4']['role'], 'signal')
+        self.assertAlmostEqual(o.G.node['4']['lat'], 37.80001, 6)
+        # Ways 10 and 30 both leave node 1 for the junction, only 10 is kept
+        self.assertEqual(sorted(o.G.edges()), [('1', '4'), ('4', '2'),
+                                               ('4', '3'), ('4', '6'),
+                                               ('5', '4')])
+        self.assertEqual(o.G.edge['1']['4']['id'], '10-0')
+
+
 class osm_unittest(unittest.TestCase):
     def setUp(self):
         self.osm = vissim.OSM(osm_path)
@@ -372,6 +962,21 @@ if __name__ == '__main__':
     inputs = unittest.TestLoader().loadTestsFromTestCase(input_unittest)
     routing = (unittest.TestLoader().loadTestsFromTestCase
                (staticrouting_unittest))
+    geos = unittest.TestLoader().loadTestsFromTestCase(geo_unittest)
+    projs = unittest.TestLoader().loadTestsFromTestCase(projection_unittest)
+    spatials = unittest.TestLoader().loadTestsFromTestCase(spatial_unittest)
+    progs = unittest.TestLoader().loadTestsFromTestCase(progress_unittest)
+    geometry = unittest.TestLoader().loadTestsFromTestCase(geometry_unittest)
+    geojsons = unittest.TestLoader().loadTestsFromTestCase(geojson_unittest)
+    conversion = (unittest.TestLoader().loadTestsFromTestCase
+                  (conversion_unittest))
     unittest.TextTestRunner(verbosity=v).run(links)
     unittest.TextTestRunner(verbosity=v).run(inputs)
     unittest.TextTestRunner(verbosity=v).run(routing)
+    unittest.TextTestRunner(verbosity=v).run(geos)
+    unittest.TextTestRunner(verbosity=v).run(projs)
+    unittest.TextTestRunner(verbosity=v).run(spatials)
+    unittest.TextTestRunner(verbosity=v).run(progs)
+    unittest.TextTestRunner(verbosity=v).run(geometry)
+    unittest.TextTestRunner(verbosity=v).run(geojsons)
+    unittest.TextTestRunner(verbosity=v).run(conversion)
\ No newline at end of file
@@ -8,9 +8,24 @@
 """
 from lxml import etree
 from copy import deepcopy
-from scipy.spatial.distance import cdist
 from os import path
+import numpy as np
 import geo_math as geo
+from progress import getLogger
+
+log = getLogger(__name__)
+
+# Fixed precision used when writing coordinates and positions to XML
+NUM_FORMAT = '%.3f'
+
+
+def _formatNum(value):
+    """ Format floats with a fixed precision for XML serialization; other
+        values are converted with str.
+    """
+    if isinstance(value, (float, np.floating)):
+        return NUM_FORMAT % value
+    return str(value)
 
 
 class Vissim(object):
@@ -105,7 +120,7 @@ class Vissim(object):
         if len(data) == 0:
             raise KeyError('Key does not exist')
         if len(data) > 1:
-            print 'KeyError(Number of elements > 1)'
+            log.warning('KeyError(Number of elements > 1)')
             #else: 
 	attribs = data[0].attrib
 	if duplicate:
@@ -146,7 +161,7 @@ class Vissim(object):
         setValue = str(setValue)
         if len(data) > 1:
             #raise KeyError('Number of elements > 1')
-            print 'KeyError(Number of elements > 1)'
+            log.warning('KeyError(Number of elements > 1)')
         if setAttr == 'connectLink' and 'lane' in data[0].attrib.keys():
             attr = self._getAttributes(attr, value, children=children)
             connectLane = attr['connectLane']
@@ -172,7 +187,7 @@ class Vissim(object):
         data = self.data.xpath(path)
         if len(data) > 1:
             #raise KeyError('Number of elements > 1')
-            print 'KeyError(Number of elements > 1)'
+            log.warning('KeyError(Number of elements > 1)')
         elif len(data) == 0:
             raise KeyError('%s path generates zero elements' % (path))
         if elemAttr is None:
@@ -251,11 +266,33 @@ class PTStop(Vissim):
         num = self._getNewNum('ptStop')
         defaults = {'anmid': '99', 'lane': '99999 1', 'length': '10.9', 'name': '', 'no': num, 'pos': ''}
         data = self.data
-        a = {k: str(kwargs.get(k, v)) for k, v in defaults.items()}
+        a = {k: _formatNum(kwargs.get(k, v)) for k, v in defaults.items()}
         etree.SubElement(data.xpath('./ptStops')[0], 'ptStop', attrib=a)
         self._getParams() #Note that there is no ptStop attribute in params list.
         return self.getptStop(a['no'])
 
+    def createptStops(self, ptStops):
+        """ Create many public transport stops in a single pass.
+            Input: list of ptStop attribute dicts
+            Output: Added <ptStop> elements to <ptStops> element, list of
+                    ptStop numbers
+        """
+        parent = self.data.xpath('./ptStops')[0]
+        nextNum = int(self._getNewNum('ptStop'))
+        nums = []
+        for kwargs in ptStops:
+            if 'no' not in kwargs:
+                kwargs = dict(kwargs, no=nextNum)
+                nextNum += 1
+            defaults = {'anmid': '99', 'lane': '99999 1', 'length': '10.9',
+                        'name': '', 'no': kwargs['no'], 'pos': ''}
+            a = {k: _formatNum(kwargs.get(k, v)) for k, v in
+                 defaults.items()}
+            etree.SubElement(parent, 'ptStop', attrib=a)
+            nums.append(a['no'])
+        self._getParams()
+        return nums
+
     #Added by Cherry
     def getptStop(self, ptStopNum):
         """ Get attributes of ptStp.
@@ -285,6 +322,9 @@ class Links(Vissim):
                       'showVeh': bool, 'surch1': float, 'surch2': float,
                       'thickness': float, 'vehRecAct': bool, 'geometry': list,
                       'lanes': list}
+        # Points and cumulative lengths of links by link number, dropped
+        # when the geometry of a link changes
+        self._measureCache = {}
 
     def __iter__(self):
         return self._listAttributes('no')
@@ -346,6 +386,7 @@ class Links(Vissim):
         """
         self._removeElements('[@no="' + str(linkNum) +
                             '"]/geometry/points3D/point3D')
+        self._measureCache.pop(str(linkNum), None)
 
     def addGeometry(self, linkNum, points):
         """ Add points to link's point set.
@@ -356,7 +397,8 @@ class Links(Vissim):
         children = '/geometry/points3D'
         if isinstance(points, list):
             for x, y, z in points:
-                a = {'x': x, 'y': y, 'zOffset': z}
+                a = {'x': _formatNum(x), 'y': _formatNum(y),
+                     'zOffset': _formatNum(z)}
                 self._setChild('no', linkNum, 'point3D', a, children)
             return self.getGeometries(linkNum)
         else:
@@ -372,6 +414,7 @@ class Links(Vissim):
         if len(geos) > index:
             geos[index].replace({'x': point[0], 'y': point[1],
                                  'zOffset': point[2]})
+            self._measureCache.pop(str(linkNum), None)
         else:
             raise IndexError('Index value does not exist in geos list')
 
@@ -387,7 +430,7 @@ class Links(Vissim):
             Input: link number
             Output: List of lane widths beginning with lane 1 (in meters)
         """
-	print 'Getting lanes for link %s' %(linkNum)
+	log.debug('Getting lanes for link %s', linkNum)
         return self._getChildren('no', linkNum, '/lanes/lane')
 
     def addLane(self, linkNum, lanes):
@@ -422,9 +465,148 @@ class Links(Vissim):
             Input: link number
             Output: link length in meters
         """
-        geos = [(i['x'], i['y'], i['zOffset']) for i in
-                self.getGeometries(linkNum)]
-        return sum(cdist(geos[:-1], geos[1:]).diagonal())
+        points, offsets, cum = self._linkMeasures([linkNum])
+        return cum[-1]
+
+    def _linkMeasures(self, linkNums):
+        """ Points and cumulative lengths of links, read from the XML tree
+            once and cached until the geometry of the link changes.
+            Input: list of link numbers
+            Output: flat array of x,y,z points, start index of each link
+                    followed by the total number of points, length up to
+                    each point (running on across links, see
+                    geo.cumulativeLengths)
+        """
+        nums = [str(n) for n in linkNums]
+        missing = set(nums).difference(self._measureCache)
+        if missing:
+            if len(missing) == 1:
+                elems = self.data.xpath('./links/link[@no="%s"]' %
+                                        (list(missing)[0]))
+            else:
+                elems = [e for e in self.data.xpath('./links/link') if
+                         e.get('no') in missing]
+            for elem in elems:
+                points = np.array([(float(p.get('x')), float(p.get('y')),
+                                    float(p.get('zOffset', 0))) for p in
+                                   elem.iterfind('geometry/points3D/point3D')],
+                                  dtype=float).reshape(-1, 3)
+                self._measureCache[elem.get('no')] = (
+                    points, geo.cumulativeLengths(points, [0, len(points)]))
+            for num in missing:
+                if num not in self._measureCache:
+                    raise KeyError('Link %s does not exist' % (num))
+        cached = [self._measureCache[num] for num in nums]
+        counts = [len(points) for points, cum in cached]
+        lengths = [cum[-1] if len(cum) else 0.0 for points, cum in cached]
+        base = np.repeat(np.cumsum([0.0] + lengths[:-1]), counts)
+        return (np.concatenate([points for points, cum in cached]),
+                np.cumsum([0] + counts),
+                np.concatenate([cum for points, cum in cached]) + base)
+
+    def locate(self, linkNum, positions):
+        """ Coordinates at positions along a link.
+            Input: link number, position or list of positions in meters from
+                   the start of the link (clamped to its length)
+            Output: array of x,y,z points
+        """
+        positions = np.atleast_1d(np.asarray(positions, dtype=float))
+        return self.locateMany([linkNum] * len(positions), positions)
+
+    def project(self, linkNum, points):
+        """ Positions along a link of the nearest points to x,y points.
+            Input: link number, list of x,y(,z) points
+            Output: array of positions in meters from the start of the link
+        """
+        points = np.atleast_2d(np.asarray(points, dtype=float))
+        return self.projectMany([linkNum] * len(points), points)
+
+    def locateMany(self, linkNums, positions):
+        """ Coordinates at positions along many links at once.
+            Input: link number of each position, positions in meters from
+                   the start of their link
+            Output: array of x,y,z points
+        """
+        nums, idx = np.unique([str(n) for n in linkNums],
+                              return_inverse=True)
+        points, offsets, cum = self._linkMeasures(nums)
+        return geo.interpolateBatch(points, offsets, idx, positions, cum)
+
+    def projectMany(self, linkNums, points):
+        """ Positions along many links of the nearest points to x,y points.
+            Input: link number of each point, list of x,y(,z) points
+            Output: array of positions in meters from the start of their link
+        """
+        nums, idx = np.unique([str(n) for n in linkNums],
+                              return_inverse=True)
+        linkPoints, offsets, cum = self._linkMeasures(nums)
+        return geo.projectBatch(linkPoints, offsets, idx, points, cum)[0]
+
+    def _linkDefaults(self, num):
+        """ Default attributes of a new link.
+        """
+        return {'assumSpeedOncom': '60.00000', 'costPerKm': '0.00000',
+                'direction': 'ALL',
+                'displayType': self._getDefaultNum('displayType'),
+                'emergStopDist': '5.00000', 'gradient': '0.00000',
+                'hasOvtLn': 'false', 'isPedArea': 'false', 'level': '1',
+                'linkBehavType': self._getDefaultNum('linkBehaviorType'),
+                'linkEvalAct': 'false',
+                'linkEvalSegLen': '10.00000', 'lnChgDist': '200.00000',
+                'lnChgEvalAct': 'true', 'lookAheadDistOvt': '250.00000',
+                'mesoFollowUpGap': '0.00000', 'mesoSpeed': '50.00000',
+                'mesoSpeedModel': 'VEHICLEBASED', 'name': '',
+                'ovtOnlyPT': 'false', 'ovtSpeedFact': '1.300000',
+                'showClsfValues': 'true', 'showLinkBar': 'true',
+                'showVeh': 'true', 'surch1': '0.00000',
+                'surch2': '0.00000', 'thickness': '0.00000',
+                'vehRecAct': 'true', 'no': num}
+
+    def _connectorDefaults(self, num):
+        """ Default attributes of a new connector.
+        """
+        return {'assumSpeedOncom': '60.00000', 'costPerKm': '0.00000',
+                'direction': 'ALL',
+                'displayType': self._getDefaultNum('displayType'),
+                'emergStopDist': '5.00000', 'gradient': '0.00000',
+                'hasOvtLn': 'false', 'isPedArea': 'false',
+                'linkBehavType': self._getDefaultNum('linkBehaviorType'),
+                'linkEvalAct': 'false',
+                'linkEvalSegLen': '10.00000', 'lnChgDist': '200.00000',
+                'lnChgDistIsPerLn': 'false',
+                'lnChgEvalAct': 'true', 'lookAheadDistOvt': '250.00000',
+                'mesoFollowUpGap': '0.00000', 'mesoSpeed': '50.00000',
+                'mesoSpeedModel': 'VEHICLEBASED', 'name': '',
+                'ovtOnlyPT': 'false', 'ovtSpeedFact': '1.300000',
+                'showClsfValues': 'true', 'showLinkBar': 'true',
+                'showVeh': 'true', 'surch1': '0.00000',
+                'surch2': '0.00000', 'thickness': '0.00000',
+                'vehRecAct': 'true', 'no': num}
+
+    def _linkElement(self, parent, attrib, points, lanes):
+        """ Build a <link> element with its geometry and lanes without any
+            XPath lookups.
+            Input: <links> element, attributes, list of x,y,z tuples, list of
+                   lane attribute dicts
+            Output: <link> element
+        """
+        link = etree.SubElement(parent, 'link', attrib=attrib)
+        self._pointElements(etree.SubElement(etree.SubElement(
+            link, 'geometry'), 'points3D'), points)
+        lanesElem = etree.SubElement(link, 'lanes')
+        for lane in lanes:
+            etree.SubElement(lanesElem, 'lane',
+                             attrib={k: str(v) for k, v in lane.items()})
+        return link
+
+    def _pointElements(self, points3D, points):
+        """ Add <point3D> elements to a <points3D> element.
+            Input: <points3D> element, list of x,y,z tuples
+        """
+        for x, y, z in points:
+            etree.SubElement(points3D, 'point3D',
+                             attrib={'x': _formatNum(x), 'y': _formatNum(y),
+                                     'zOffset': _formatNum(z)})
 
     def createLink(self, **kwargs):
         """ Create a new link in the model.
@@ -434,22 +616,7 @@ class Links(Vissim):
         #RV get a new num if this is really a new link
 	num = self._getNewNum('link')
 	#print 'link number max + 1 %s' %(num)
-        defaults = {'assumSpeedOncom': '60.00000', 'costPerKm': '0.00000',
-                    'direction': 'ALL',
-                    'displayType': self._getDefaultNum('displayType'),
-                    'emergStopDist': '5.00000', 'gradient': '0.00000',
-                    'hasOvtLn': 'false', 'isPedArea': 'false', 'level': '1',
-                    'linkBehavType': self._getDefaultNum('linkBehaviorType'),
-                    'linkEvalAct': 'false',
-                    'linkEvalSegLen': '10.00000', 'lnChgDist': '200.00000',
-                    'lnChgEvalAct': 'true', 'lookAheadDistOvt': '250.00000',
-                    'mesoFollowUpGap': '0.00000', 'mesoSpeed': '50.00000',
-                    'mesoSpeedModel': 'VEHICLEBASED', 'name': '',
-                    'ovtOnlyPT': 'false', 'ovtSpeedFact': '1.300000',
-                    'showClsfValues': 'true', 'showLinkBar': 'true',
-                    'showVeh': 'true', 'surch1': '0.00000',
-                    'surch2': '0.00000', 'thickness': '0.00000',
-                    'vehRecAct': 'true', 'no': num}
+        defaults = self._linkDefaults(num)
         data = self.data
         a = {k: str(kwargs.get(k, v)) for k, v in defaults.items()}
         etree.SubElement(data.xpath('./links')[0], 'link', attrib=a)
@@ -463,72 +630,161 @@ class Links(Vissim):
         	self._setChild('no', a['no'], 'lanes', None)
         	self.addLane(a['no'], kwargs.get('lane', ['3.500000']))
 	else:
-		print "lane count is not a positive number" 
+		log.warning('lane count is not a positive number')
         self._getParams()
         return self.getLink(a['no'])
 
+    def createLinks(self, links):
+        """ Create many links in a single pass over the XML tree.
+            Input: list of link attribute dicts, each with point3D and lane
+                   (list of lane widths) entries
+            Output: Added <link> elements to <links> element, list of link
+                    numbers
+        """
+        parent = self.data.xpath('./links')[0]
+        nextNum = int(self._getNewNum('link'))
+        nums = []
+        for kwargs in links:
+            if 'no' not in kwargs:
+                kwargs = dict(kwargs, no=nextNum)
+                nextNum += 1
+            defaults = self._linkDefaults(kwargs['no'])
+            a = {k: str(kwargs.get(k, v)) for k, v in defaults.items()}
+            lanes = [{'width': width} for width in
+                     kwargs.get('lane', ['3.500000'])]
+            self._linkElement(parent, a, kwargs.get('point3D',
+                              [('0', '0', '0'), ('1', '1', '0')]), lanes)
+            nums.append(a['no'])
+        self._getParams()
+        return nums
+
+    def setGeometries(self, links):
+        """ Rewrite the geometry and lane count of many links in a single
+            pass over the XML tree; links that do not exist (or have no
+            number) are created with createLinks.
+            Input: list of dicts with point3D (list of x,y,z tuples) and
+                   optional no and lanes (number of lanes) entries. Kept
+                   lanes keep their attributes, added lanes copy the width of
+                   the last lane.
+            Output: list of updated link numbers, list of created link
+                    numbers
+        """
+        elems = dict((e.get('no'), e) for e in
+                     self.data.xpath('./links/link'))
+        updated, new = [], []
+        for link in links:
+            elem = elems.get(str(link.get('no')))
+            if elem is None:
+                lanes = ['3.500000'] * int(link.get('lanes', 1))
+                new.append(dict(link, lane=lanes))
+                continue
+            points3D = elem.find('geometry/points3D')
+            del points3D[:]
+            self._pointElements(points3D, link['point3D'])
+            self._measureCache.pop(elem.get('no'), None)
+            if link.get('lanes'):
+                lanesElem = elem.find('lanes')
+                count = int(link['lanes'])
+                width = (lanesElem[-1].get('width') if len(lanesElem) else
+                         '3.500000')
+                del lanesElem[count:]
+                for i in range(len(lanesElem), count):
+                    etree.SubElement(lanesElem, 'lane',
+                                     attrib={'width': width})
+            updated.append(elem.get('no'))
+        created = self.createLinks(new) if new else []
+        return updated, created
+
+    def _positionRefs(self):
+        """ Find the attributes that hold a position along a link.
+            Output: list of (element, position attribute, link number)
+        """
+        refs = []
+        for elem in self.data.xpath('//*[@pos and (@lane or @link)]'):
+            link = elem.get('link') or elem.get('lane').split()[0]
+            refs.append((elem, 'pos', link))
+        for elem in self.data.xpath('//*[@destPos and @destLink]'):
+            refs.append((elem, 'destPos', elem.get('destLink')))
+        return refs
+
+    def simplify(self, tolerance, links=None):
+        """ Remove shape points with Douglas-Peucker simplification of all
+            links at once. End points are kept, and positions along the
+            simplified links (connector ends, PT stops, signal heads,
+            routing decisions, ...) are moved to the same place on the new
+            geometry.
+            Input: tolerance in meters, link numbers (defaults to all links
+                   and connectors)
+            Output: number of points removed
+        """
+        elems = self.data.xpath('./links/link')
+        if links is not None:
+            wanted = set(str(l) for l in links)
+            elems = [e for e in elems if e.get('no') in wanted]
+        pointElems = [e.findall('geometry/points3D/point3D') for e in elems]
+        offsets = np.cumsum([0] + [len(p) for p in pointElems])
+        flat = [p for points in pointElems for p in points]
+        points = np.array([(float(p.get('x')), float(p.get('y')),
+                            float(p.get('zOffset', 0))) for p in flat],
+                          dtype=float).reshape(-1, 3)
+        keep = geo.simplifyBatch(points, offsets, tolerance)
+        index = dict((e.get('no'), i) for i, e in enumerate(elems))
+        refs = [r for r in self._positionRefs() if r[2] in index]
+        if refs:
+            measures = geo.remapMeasures(
+                points, offsets, keep, [index[link] for e, a, link in refs],
+                [float(e.get(attr)) for e, attr, link in refs])
+            for (elem, attr, link), pos in zip(refs, measures):
+                elem.set(attr, _formatNum(pos))
+        for point, kept in zip(flat, keep):
+            if not kept:
+                point.getparent().remove(point)
+        for elem in elems:
+            self._measureCache.pop(elem.get('no'), None)
+        removed = int((~keep).sum())
+        log.info('Simplified %d links: removed %d of %d points',
+                 len(elems), removed, len(flat))
+        return removed
+
     def connectorLocation(self, linkNum, lane, lanes):
         """ Calculate the start and end points of a connector
             Input: link number, lane number, total number of lanes
                    being connected
             Output: clockwise direction and offset
         """
-        width = [float(v['width']) for v in self.getLanes(linkNum)]
-        centerline = sum(width) / 2.0
-        laneIdx = len(self.getLanes(linkNum)) - lane
-        # beginning from the left, sum all lanes not being connected
-        left = sum(width[:laneIdx+1-lanes])
-        # median width of the lanes being connected
-        midpoint = sum(width[laneIdx+1-lanes:laneIdx+1]) / 2.0
-        if left + midpoint < centerline:
-            return False, centerline - left - midpoint
-        elif left + midpoint > centerline:
-            return True, left + midpoint - centerline
-        else:
-            return True, 0
+        width = [v['width'] for v in self.getLanes(linkNum)]
+        return geo.laneOffset(width, lane, lanes)
 
     def createConnector(self, fromLink, fromLane, toLink, toLane, lanes,
                         **kwargs):
-        """ Create a new connector in the model.
+        """ Create a new connector in the model. Pass curvePoints > 2 to
+            draw the connector as a bezier curve instead of a straight line.
             Input: from link, from lane, to link, to lane, attributes
             Output: Added <link> element to <links> element.
         """
         num = self._getNewNum('link')
-        defaults = {'assumSpeedOncom': '60.00000', 'costPerKm': '0.00000',
-                    'direction': 'ALL',
-                    'displayType': self._getDefaultNum('displayType'),
-                    'emergStopDist': '5.00000', 'gradient': '0.00000',
-                    'hasOvtLn': 'false', 'isPedArea': 'false',
-                    'linkBehavType': self._getDefaultNum('linkBehaviorType'),
-                    'linkEvalAct': 'false',
-                    'linkEvalSegLen': '10.00000', 'lnChgDist': '200.00000',
-                    'lnChgDistIsPerLn': 'false',
-                    'lnChgEvalAct': 'true', 'lookAheadDistOvt': '250.00000',
-                    'mesoFollowUpGap': '0.00000', 'mesoSpeed': '50.00000',
-                    'mesoSpeedModel': 'VEHICLEBASED', 'name': '',
-                    'ovtOnlyPT': 'false', 'ovtSpeedFact': '1.300000',
-                    'showClsfValues': 'true', 'showLinkBar': 'true',
-                    'showVeh': 'true', 'surch1': '0.00000',
-                    'surch2': '0.00000', 'thickness': '0.00000',
-                    'vehRecAct': 'true', 'no': num}
+        defaults = self._connectorDefaults(num)
         data = self.data
         a = {k: str(kwargs.get(k, v)) for k, v in defaults.items()}
         etree.SubElement(data.xpath('./links')[0], 'link', attrib=a)
         fromAttr = {'lane': str(fromLink) + ' ' + str(fromLane),
-                    'pos': kwargs.get('fromPos', self.getLinkLength(fromLink))}
+                    'pos': _formatNum(kwargs.get('fromPos',
+                                                 self.getLinkLength(fromLink)))}
         self._setChild('no', a['no'], 'fromLinkEndPt', fromAttr)
         self._setChild('no', a['no'], 'geometry', None)
         self._setChild('no', a['no'], 'points3D', None, '/geometry')
         fromGeo = self.getGeometries(fromLink)[-2:]
         fromPoint = [(v['x'], v['y'], v['zOffset']) for v in fromGeo]
-        clockwise, fromDist = self.connectorLocation(fromLink, fromLane, lanes)
-        fromPoint = geo.offsetParallel(fromPoint, fromDist,
-                                       clockwise=clockwise)
         toGeo = self.getGeometries(toLink)[:2]
         toPoint = [(v['x'], v['y'], v['zOffset']) for v in toGeo]
-        clockwise, toDist = self.connectorLocation(toLink, toLane, lanes)
-        toPoint = geo.offsetParallel(toPoint, toDist, clockwise=clockwise)
-        point3D = kwargs.get('point3D', [fromPoint[-1], toPoint[0]])
+        fromWidths = [v['width'] for v in self.getLanes(fromLink)]
+        toWidths = [v['width'] for v in self.getLanes(toLink)]
+        if 'point3D' in kwargs:
+            point3D = kwargs['point3D']
+        else:
+            point3D = geo.connectorGeometry(fromPoint, fromWidths, fromLane,
+                                             toPoint, toWidths, toLane, lanes,
+                                             n=kwargs.get('curvePoints', 2))
         self.addGeometry(a['no'], point3D)
         self._setChild('no', a['no'], 'lanes', None)
         # Check number of lanes doesn't exceed the number of from/to lanes
@@ -544,6 +800,76 @@ class Links(Vissim):
         self._getParams()
         return self.getConnector(a['no'])
 
+    def createConnectors(self, connectors, curvePoints=2):
+        """ Create many connectors in a single pass over the XML tree. Link
+            geometry and lanes are looked up once for all connectors, and the
+            geometry of connectors without point3D is calculated in a single
+            batch, as bezier curves when curvePoints > 2.
+            Input: list of connector attribute dicts, each with fromLink,
+                   fromLane, toLink, toLane and lanes entries, number of
+                   points per connector
+            Output: Added <link> elements to <links> element, list of
+                    connector numbers. Raises ValueError, before anything is
+                    added, if a connector has more lanes than its from or to
+                    link.
+        """
+        parent = self.data.xpath('./links')[0]
+        nextNum = int(self._getNewNum('link'))
+        links = {}
+        for link in parent.iterchildren('link'):
+            points = [(p.get('x'), p.get('y'), p.get('zOffset')) for p in
+                      link.iterfind('./geometry/points3D/point3D')]
+            widths = [l.get('width') for l in link.iterfind('./lanes/lane')]
+            links[link.get('no')] = (points, widths)
+        records = []
+        fromPoints, fromDist, toPoints, toDist = [], [], [], []
+        for kwargs in connectors:
+            fromLink, toLink = str(kwargs['fromLink']), str(kwargs['toLink'])
+            lanes = kwargs['lanes']
+            fromGeo, fromWidths = links[fromLink]
+            toGeo, toWidths = links[toLink]
+            if len(fromWidths) < lanes or len(toWidths) < lanes:
+                raise ValueError('Number of lanes exceeds number of from/to '
+                                 'lanes')
+            if 'no' not in kwargs:
+                kwargs = dict(kwargs, no=nextNum)
+                nextNum += 1
+            if kwargs.get('fromPos') is None:
+                kwargs = dict(kwargs, fromPos=geo.getLength(fromGeo))
+            if kwargs.get('point3D') is None:
+                clockwise, dist = geo.laneOffset(fromWidths,
+                                                 kwargs['fromLane'], lanes)
+                fromDist.append(dist if clockwise else -dist)
+                clockwise, dist = geo.laneOffset(toWidths, kwargs['toLane'],
+                                                 lanes)
+                toDist.append(dist if clockwise else -dist)
+                fromPoints.append(fromGeo[-2:])
+                toPoints.append(toGeo[:2])
+            records.append(kwargs)
+        if fromPoints:
+            curves = iter(geo.connectorGeometryBatch(fromPoints, fromDist,
+                                                     toPoints, toDist,
+                                                     curvePoints))
+        nums = []
+        for kwargs in records:
+            fromLink, toLink = str(kwargs['fromLink']), str(kwargs['toLink'])
+            defaults = self._connectorDefaults(kwargs['no'])
+            a = {k: str(kwargs.get(k, v)) for k, v in defaults.items()}
+            point3D = kwargs.get('point3D')
+            if point3D is None:
+                point3D = next(curves)
+            link = self._linkElement(parent, a, point3D,
+                                     [{}] * kwargs['lanes'])
+            fromAttr = {'lane': fromLink + ' ' + str(kwargs['fromLane']),
+                        'pos': _formatNum(kwargs['fromPos'])}
+            link.insert(0, etree.Element('fromLinkEndPt', attrib=fromAttr))
+            toAttr = {'lane': toLink + ' ' + str(kwargs['toLane']),
+                      'pos': _formatNum(kwargs.get('toPos', '0.0000'))}
+            etree.SubElement(link, 'toLinkEndPt', attrib=toAttr)
+            nums.append(a['no'])
+        self._getParams()
+        return nums
+
     def removeLink(self, linkNum):
         """ Remove an existing link or connector from the model.
             Input: link number
@@ -552,6 +878,7 @@ class Links(Vissim):
         parent = './links'
         child = self.path + '[@no="' + str(linkNum) + '"]'
         self._removeChild(parent, child)
+        self._measureCache.pop(str(linkNum), None)
         self._getParams()
 
 
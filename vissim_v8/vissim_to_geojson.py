@@ -1,14 +1,79 @@
-import math
+from lxml import etree
+import argparse
+import geo_math as geo
 import geojson
+import itertools
+import json
+import multiprocessing
+import numpy as np
+import os
+import projection as proj
+import spatial
+import struct
 
+# Number of links whose coordinates are converted in one transform when
+# streaming features
+FEATURE_BATCH = 1000
+# Decimal places of exported coordinates, as written by geojson.dumps
+PRECISION = 6
+# Feature layers that can be exported. Link centerlines (including
+# connectors) keep their original properties, features of the other layers
+# have a 'layer' property.
+LAYERS = ('links', 'lanes', 'lanePolygons', 'connectors', 'ptStops')
+# Width (meters) of lanes without a width attribute
+LANE_WIDTH = 3.5
+# Web map tiles: lines are simplified to one pixel of a tile this many pixels
+# wide and clipped this fraction of a tile beyond its edges
+TILE_PIXELS = 256
+TILE_BUFFER = 1 / 16.0
+# Layers that can be tiled
+TILE_LAYERS = ('links', 'lanes', 'connectors', 'ptStops')
+# Binary export, laid out like FlatGeobuf (header, packed Hilbert R-tree,
+# features) but not compatible with it: a JSON header, the tree nodes as
+# float64 min x, min y, max x, max y and uint64 offset, then per feature a
+# uint32 size, uint8 coordinate depth, uint32 part count, uint32 points per
+# part, float64 coordinate pairs and the rest of the feature as JSON.
+# Coordinates keep the [lat, lng] order of the GeoJSON export.
+BINARY_MAGIC = 'VISGEOB\x01'
+NODE_SIZE = 16
 
-class GeoJSON():
+
+class GeoJSON(object):
     def __init__(self, v):
         self.data = v.data
-        self.refX, self.refY = self.getMapReference()
-        self.startX, self.startY = self.getStartReference()
-        self.refLat, self.refLng = self.getRefLat()
-        self.geojson = self.createGeoJSON()
+        refX, refY = self.getMapReference()
+        startX, startY = self.getStartReference()
+        self.setReference(refX, refY, startX, startY)
+
+    @classmethod
+    def fromReference(cls, refX, refY, startX, startY):
+        """ Create a converter from the reference points of a model, without
+            a loaded model. Features are converted from link records passed
+            to iterFeatures.
+            Input: map x, y and network start x, y reference coordinates
+            Output: GeoJSON object
+        """
+        self = cls.__new__(cls)
+        self.data = None
+        self.setReference(refX, refY, startX, startY)
+        return self
+
+    def setReference(self, refX, refY, startX, startY):
+        self.refX, self.refY = refX, refY
+        self.startX, self.startY = startX, startY
+        self.ref = proj.RefPoint.fromMeters(self.refX, self.refY, self.startX,
+                                            self.startY)
+        self.refLat, self.refLng = self.ref.lat, self.ref.lng
+        self._geojson = None
+
+    @property
+    def geojson(self):
+        """ FeatureCollection of all links, built on first use. export
+            streams features instead of building it.
+        """
+        if self._geojson is None:
+            self._geojson = self.createGeoJSON()
+        return self._geojson
 
     def getMapReference(self):
         """ Retrieve reference map coordinates from Vissim parameters
@@ -33,11 +98,8 @@ class GeoJSON():
             Input: x, y
             Output: WGS84 lat/lng
         """
-        extent = 20015085  # height/width in meters of the VISSIM map
-        lng = x * 180 / float(extent)
-        y = y * 180 / float(extent)
-        lat = math.atan(math.exp(y*(math.pi/180.0))) * (360 / math.pi) - 90
-        return lat, lng
+        lat, lng = proj.metersToLatLng(x, y)
+        return float(lat), float(lng)
 
     def getRefLat(self):
         refLat, refLng = self.metersToLatLng(self.refX, self.refY)
@@ -48,40 +110,858 @@ class GeoJSON():
             Input: scaled xy
             Output: latlng node
         """
-        scaleX, scaleY = xy
-        scaleX, scaleY = float(scaleX), float(scaleY)
-        scale = 1 / math.cos(math.radians(self.refLat))
-        x = (scaleX * scale) + self.refX - self.startX
-        y = (scaleY * scale) + self.refY - self.startY
-        lat, lng = self.metersToLatLng(x, y)
-        return lat, lng
+        lat, lng = self.ref.fromScaledMeters(float(xy[0]), float(xy[1]))
+        return float(lat), float(lng)
+
+    def scaledMetersToNodes(self, x, y):
+        """ Remove Mercator scaling factor and reference point for all points
+            of a link in one transform.
+            Input: scaled x, y arrays
+            Output: list of latlng nodes
+        """
+        lat, lng = self.ref.fromScaledMeters(x, y)
+        return zip(lat.tolist(), lng.tolist())
+
+    def linkRecords(self):
+        """ Walk the links and connectors of the model.
+            Input: Vissim object
+            Output: generator of link records (see linkRecord)
+        """
+        for link in self.data.iterfind('./links/link'):
+            yield linkRecord(link)
+
+    def ptStopRecords(self):
+        """ Get the attributes of all PT stops of the model.
+            Input: Vissim object
+            Output: list of ptStop attribute dicts
+        """
+        return [dict(stop.attrib) for stop in
+                self.data.iterfind('./ptStops/ptStop')]
+
+    def iterFeatures(self, links=None, batchSize=FEATURE_BATCH,
+                     layers=('links',)):
+        """ Convert links to GeoJSON features, calculating the geometry of
+            batchSize links at a time.
+            Input: iterable of link records, defaults to the links of the
+                   model, batch size, link based layers to create
+            Output: generator of feature dicts, per batch ordered by layer
+        """
+        if links is None:
+            links = self.linkRecords()
+        batch = []
+        for link in links:
+            batch.append(link)
+            if len(batch) >= batchSize:
+                for feature in self._batchFeatures(batch, layers):
+                    yield feature
+                batch = []
+        for feature in self._batchFeatures(batch, layers):
+            yield feature
+
+    def toLatLng(self, points):
+        """ Convert scaled meter points to rounded lat/lng pairs in one
+            transform.
+            Input: array of x,y(,z) points
+            Output: list of [lat, lng] lists
+        """
+        points = np.asarray(points, dtype=np.float64).reshape(len(points), -1)
+        lat, lng = self.ref.fromScaledMeters(points[:, 0], points[:, 1])
+        return np.column_stack([np.round(lat, PRECISION),
+                                np.round(lng, PRECISION)]).tolist()
+
+    def _batchFeatures(self, batch, layers=('links',)):
+        if not batch:
+            return []
+        points, offsets = recordPoints(batch)
+        arrays = [points]
+        lanes = [i for i, link in enumerate(batch) if not link['fromLane']]
+        if 'lanes' in layers or 'lanePolygons' in layers:
+            idx, laneOffsets = geo.repeatPolylines(offsets, lanes)
+            centers, centerOffsets, edges, edgeOffsets = \
+                geo.laneGeometryBatch(points[idx], laneOffsets,
+                                      [laneWidths(batch[i]) for i in lanes])
+            arrays += [centers, edges]
+        # One coordinate transform for all layers of the batch
+        coords = self.toLatLng(np.concatenate(arrays))
+        features = []
+        if 'links' in layers:
+            for i, link in enumerate(batch):
+                features.append({'type': 'Feature', 'id': link['no'],
+                                 'geometry': {'type': 'MultiLineString',
+                                              'coordinates': coords[
+                                                  offsets[i]:offsets[i+1]]},
+                                 'properties': {'lane': str(len(
+                                     link['lanes'])), 'id': link['no']}})
+        if 'lanes' in layers or 'lanePolygons' in layers:
+            centers = coords[len(points):len(points) + len(centers)]
+            edges = coords[len(points) + len(centers):]
+            c = e = 0
+            for i in lanes:
+                link = batch[i]
+                for lane, width in enumerate(laneWidths(link), 1):
+                    props = {'link': link['no'], 'lane': lane, 'width': width}
+                    if 'lanes' in layers:
+                        features.append(_feature(
+                            'lanes', 'LineString', centers[
+                                centerOffsets[c]:centerOffsets[c+1]], props))
+                    if 'lanePolygons' in layers:
+                        right = edges[edgeOffsets[e]:edgeOffsets[e+1]]
+                        left = edges[edgeOffsets[e+1]:edgeOffsets[e+2]]
+                        features.append(_feature(
+                            'lanePolygons', 'Polygon',
+                            [right + left[::-1] + right[:1]], props))
+                    c += 1
+                    e += 1
+                e += 1
+        if 'connectors' in layers:
+            for i, link in enumerate(batch):
+                if link['fromLane']:
+                    features.append(_feature(
+                        'connectors', 'LineString',
+                        coords[offsets[i]:offsets[i+1]],
+                        {'id': link['no'], 'fromLane': link['fromLane'],
+                         'fromPos': link['fromPos'],
+                         'toLane': link['toLane'], 'toPos': link['toPos'],
+                         'lanes': len(link['lanes'])}))
+        return features
+
+    def ptStopFeatures(self, stops, links):
+        """ Position PT stops on the centerline of their lane.
+            Input: list of ptStop attribute dicts, dict of link records keyed
+                   by link number (at least the links of the stops)
+            Output: list of Point feature dicts
+        """
+        stops, located = ptStopPoints(stops, links)
+        if not stops:
+            return []
+        coords = self.toLatLng(located)
+        return [_feature('ptStops', 'Point', coords[i], ptStopProperties(s))
+                for i, s in enumerate(stops)]
 
     def createGeoJSON(self):
         """ Get list of link geometries and properties to be converted.
             Input: Vissim object
-            Output: list of links
+            Output: FeatureCollection of links
         """
         features = []
-        for link in self.data.xpath('./links/link'):
-            geos = []
-            linkNum = link.attrib['no']
-            for geo in link.xpath('./geometry/points3D/point3D'):
-                x, y = geo.attrib['x'], geo.attrib['y']
-                latLng = self.scaledMetersToNode((x, y))
-                geos.append(latLng)
-            linkNum = link.attrib['no']
-            laneNum = str(len(link.xpath('./lanes/lane')))
-            multiLine = geojson.MultiLineString(coordinates=geos)
-            features.append(geojson.Feature(id=linkNum, geometry=multiLine,
-                                            properties={'lane': laneNum,
-                                                        'id': linkNum}))
+        for f in self.iterFeatures():
+            multiLine = geojson.MultiLineString(
+                coordinates=f['geometry']['coordinates'])
+            features.append(geojson.Feature(id=f['id'], geometry=multiLine,
+                                            properties=f['properties']))
         return geojson.FeatureCollection(features)
 
-    def export(self, filename):
-        """ Export GeoJSON object to file
-            Input: filename
+    def export(self, filename, ndjson=False, batchSize=FEATURE_BATCH,
+               layers=('links',)):
+        """ Stream GeoJSON features to a file, so memory use does not grow
+            with the size of the network.
+            Input: filename or open file, write newline delimited GeoJSON
+                   (one feature per line) instead of a FeatureCollection,
+                   batch size, layers to export (see LAYERS)
             Output: written file
         """
-        f = open(filename, 'w')
-        f.writelines(geojson.dumps(self.geojson))
-        f.close()
+        writeFeatures(filename, self.layerFeatures(batchSize, layers), ndjson)
+
+    def exportBinary(self, filename, batchSize=FEATURE_BATCH,
+                     layers=('links',), nodeSize=NODE_SIZE):
+        """ Write features to the indexed binary format (see BINARY_MAGIC),
+            which readBinary can query by bounding box.
+            Input: filename or open file, batch size, layers to export (see
+                   LAYERS), R-tree node size
+            Output: number of features written
+        """
+        return writeBinary(filename, self.layerFeatures(batchSize, layers),
+                           nodeSize)
+
+    def layerFeatures(self, batchSize=FEATURE_BATCH, layers=('links',)):
+        """ Features of the model for a set of layers.
+            Input: batch size, layers (see LAYERS)
+            Output: iterable of feature dicts
+        """
+        features = self.iterFeatures(batchSize=batchSize, layers=layers)
+        if 'ptStops' in layers:
+            stops = self.ptStopRecords()
+            linkNums = set(s.get('lane', '').split()[0] for s in stops)
+            links = {r['no']: r for r in self.linkRecords() if r['no'] in
+                     linkNums}
+            features = itertools.chain(features,
+                                       self.ptStopFeatures(stops, links))
+        return features
+
+    def linkGeometries(self, source):
+        """ Convert features back to link geometries, with one inverse
+            transform for all coordinates.
+            Input: FeatureCollection dict or list of feature dicts (features
+                   of the links and connectors layers are used), or dict of
+                   [lat, lng(, z)] coordinate arrays keyed by link number
+            Output: list of dicts with no (unless the feature has no id),
+                    point3D and lanes (when the feature has a lane count)
+                    entries, as taken by Links.setGeometries
+        """
+        if isinstance(source, dict) and 'type' not in source:
+            items = [({'no': str(no)}, coords) for no, coords in
+                     source.items()]
+        else:
+            if isinstance(source, dict):
+                source = source['features']
+            items = []
+            for feature in source:
+                props = feature.get('properties') or {}
+                if props.get('layer', 'links') not in ('links',
+                                                       'connectors'):
+                    continue
+                record = {}
+                no = props.get('id', feature.get('id'))
+                if no is not None:
+                    record['no'] = str(no)
+                lanes = props.get('lanes', props.get('lane'))
+                if lanes is not None:
+                    record['lanes'] = int(lanes)
+                coords = feature['geometry']['coordinates']
+                if coords and isinstance(coords[0][0], list):
+                    # A MultiLineString of several lines
+                    coords = [p for line in coords for p in line]
+                items.append((record, coords))
+        arrays = []
+        for record, coords in items:
+            coords = np.asarray(coords, dtype=np.float64)
+            if coords.ndim != 2 or len(coords) < 2:
+                raise ValueError('Link %s needs at least two points' %
+                                 (record.get('no')))
+            if coords.shape[1] == 2:
+                coords = np.column_stack([coords, np.zeros(len(coords))])
+            arrays.append(coords[:, :3])
+        if not arrays:
+            return []
+        offsets = np.cumsum([0] + [len(a) for a in arrays])
+        points = np.concatenate(arrays)
+        x, y = self.ref.toScaledMeters(points[:, 0], points[:, 1])
+        points = np.column_stack([x, y, points[:, 2]]).tolist()
+        links = []
+        for i, (record, coords) in enumerate(items):
+            record['point3D'] = points[offsets[i]:offsets[i+1]]
+            links.append(record)
+        return links
+
+    def tileGeometry(self, links, stops=(), layers=('links',)):
+        """ Collect the polylines and points of the tiled layers in map
+            meters.
+            Input: list of link records, list of ptStop attribute dicts,
+                   layers (see TILE_LAYERS)
+            Output: flat x,y points of all polylines, start index of each
+                    polyline followed by the total number of points, list of
+                    (id, properties) per polyline, x,y points of the PT stops,
+                    list of (id, properties) per stop
+        """
+        unknown = set(layers) - set(TILE_LAYERS)
+        if unknown:
+            raise ValueError('Layers %s can not be tiled' % (
+                ', '.join(sorted(unknown))))
+        points, offsets = recordPoints(links)
+        polylines, features = [], []
+        if 'links' in layers:
+            polylines.append((points, offsets))
+            features.extend((link['no'], {'lane': str(len(link['lanes'])),
+                                          'id': link['no']})
+                            for link in links)
+        if 'lanes' in layers:
+            lanes = [i for i, link in enumerate(links) if not link['fromLane']]
+            idx, laneOffsets = geo.repeatPolylines(offsets, lanes)
+            centers, centerOffsets, edges, edgeOffsets = \
+                geo.laneGeometryBatch(points[idx], laneOffsets,
+                                      [laneWidths(links[i]) for i in lanes])
+            polylines.append((centers, centerOffsets))
+            for i in lanes:
+                features.extend(
+                    (None, {'layer': 'lanes', 'link': links[i]['no'],
+                            'lane': lane, 'width': width})
+                    for lane, width in enumerate(laneWidths(links[i]), 1))
+        if 'connectors' in layers:
+            conns = [i for i, link in enumerate(links) if link['fromLane']]
+            idx, connOffsets = geo.repeatPolylines(offsets, conns)
+            polylines.append((points[idx], connOffsets))
+            features.extend(
+                (None, {'layer': 'connectors', 'id': links[i]['no'],
+                        'fromLane': links[i]['fromLane'],
+                        'fromPos': links[i]['fromPos'],
+                        'toLane': links[i]['toLane'],
+                        'toPos': links[i]['toPos'],
+                        'lanes': len(links[i]['lanes'])}) for i in conns)
+        flat, flatOffsets = [np.zeros((0, 3))], [0]
+        for pts, offs in polylines:
+            flat.append(pts)
+            flatOffsets.extend((offs[1:] + flatOffsets[-1]).tolist())
+        flat = np.concatenate(flat)
+        x, y = self.ref.scaledToMeters(flat[:, 0], flat[:, 1])
+        stopFeatures, stopXY = [], np.zeros((0, 2))
+        if 'ptStops' in layers:
+            byNum = {link['no']: link for link in links}
+            stops, located = ptStopPoints(stops, byNum)
+            stopXY = np.column_stack(self.ref.scaledToMeters(located[:, 0],
+                                                             located[:, 1]))
+            stopFeatures = [(None, dict(ptStopProperties(s), layer='ptStops'))
+                            for s in stops]
+        return (np.column_stack([x, y]),
+                np.array(flatOffsets, dtype=np.int64), features, stopXY,
+                stopFeatures)
+
+    def exportTiles(self, outDir, minZoom=10, maxZoom=16, layers=('links',),
+                    links=None, stops=None, workers=None):
+        """ Write a z/x/y pyramid of GeoJSON tiles for web maps. Lines are
+            simplified per zoom level with Douglas-Peucker and clipped to
+            each tile; tiles are written in a process pool and only tiles
+            with features are written. Coordinates are lat/lng pairs like
+            the other exports.
+            Input: output directory, zoom levels, layers (see TILE_LAYERS),
+                   link records (defaults to the links of the model), ptStop
+                   attribute dicts (defaults to the PT stops of the model),
+                   number of worker processes (defaults to the number of
+                   CPUs)
+            Output: outDir/z/x/y.geojson files, list of (z, x, y, feature
+                    count) of the tiles written
+        """
+        if links is None:
+            links = list(self.linkRecords())
+        if stops is None:
+            stops = (self.ptStopRecords() if 'ptStops' in layers and
+                     self.data is not None else [])
+        points, offsets, features, stopXY, stopFeatures = \
+            self.tileGeometry(links, stops, layers)
+        counts = np.diff(offsets)
+        owner = np.repeat(np.arange(len(counts)), counts)
+        zooms, tasks = {}, []
+        for zoom in range(minZoom, maxZoom + 1):
+            size = proj.tileSize(zoom)
+            keep = geo.simplifyBatch(points, offsets, size / TILE_PIXELS)
+            kept = np.bincount(owner[keep], minlength=len(counts))
+            zoomOffsets = np.concatenate([[0], np.cumsum(kept)]).astype(
+                np.int64)
+            zooms[zoom] = (points[keep], zoomOffsets)
+            tiles = {}
+            for key, items in (('lines', _lineTiles(points[keep], zoomOffsets,
+                                                    zoom, size * TILE_BUFFER)),
+                               ('stops', _pointTiles(stopXY, zoom))):
+                for tile, idx in items:
+                    tiles.setdefault(tile, {})[key] = idx
+            for (col, row) in sorted(tiles):
+                t = tiles[(col, row)]
+                tasks.append((zoom, col, row,
+                              t.get('lines', np.zeros(0, dtype=np.int64)),
+                              t.get('stops', np.zeros(0, dtype=np.int64))))
+        state = {'outDir': outDir, 'zooms': zooms, 'features': features,
+                 'stopXY': stopXY, 'stopFeatures': stopFeatures}
+        workers = workers or multiprocessing.cpu_count()
+        if workers > 1 and len(tasks) > 1:
+            pool = multiprocessing.Pool(workers, initializer=_initTileWorker,
+                                        initargs=(state,))
+            try:
+                results = pool.map(_writeTile, tasks,
+                                   chunksize=max(1, len(tasks) //
+                                                 (4 * workers)))
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            _initTileWorker(state)
+            results = [_writeTile(task) for task in tasks]
+        return [r for r in results if r is not None]
+
+
+def _lineTiles(points, offsets, zoom, buffer):
+    """ Find the tiles the bounding box of each polyline overlaps.
+        Input: flat x,y points, polyline offsets, zoom level, buffer (map
+               meters)
+        Output: list of ((column, row), array of polyline indices)
+    """
+    counts = np.diff(offsets)
+    lines = np.flatnonzero(counts > 0)
+    if not len(lines):
+        return []
+    # Empty polylines have no points, so each reduction runs over exactly
+    # the points of one polyline
+    starts = offsets[:-1][lines]
+    lo = np.minimum.reduceat(points, starts)
+    hi = np.maximum.reduceat(points, starts)
+    c0, r0 = proj.metersToTile(lo[:, 0] - buffer, hi[:, 1] + buffer, zoom)
+    c1, r1 = proj.metersToTile(hi[:, 0] + buffer, lo[:, 1] - buffer, zoom)
+    nx, ny = c1 - c0 + 1, r1 - r0 + 1
+    n = nx * ny
+    line = np.repeat(np.arange(len(lines)), n)
+    k = np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n)
+    col = c0[line] + k % nx[line]
+    row = r0[line] + k // nx[line]
+    return _groupTiles(col, row, lines[line])
+
+
+def _pointTiles(points, zoom):
+    if not len(points):
+        return []
+    col, row = proj.metersToTile(points[:, 0], points[:, 1], zoom)
+    return _groupTiles(col, row, np.arange(len(points)))
+
+
+def _groupTiles(col, row, items):
+    order = np.lexsort((items, row, col))
+    col, row, items = col[order], row[order], items[order]
+    new = np.ones(len(col), dtype=bool)
+    new[1:] = (col[1:] != col[:-1]) | (row[1:] != row[:-1])
+    bounds = np.append(np.flatnonzero(new), len(col))
+    return [((int(col[a]), int(row[a])), items[a:b]) for a, b in
+            zip(bounds[:-1], bounds[1:])]
+
+
+# Tile worker state, set once per worker process by the pool initializer
+_tileWorker = None
+
+
+def _initTileWorker(state):
+    global _tileWorker
+    _tileWorker = state
+
+
+def _writeTile(task):
+    """ Clip the features of one tile and write them.
+        Input: (zoom, column, row, polyline indices, PT stop indices)
+        Output: (zoom, column, row, feature count), None for an empty tile
+    """
+    zoom, col, row, lines, stops = task
+    state = _tileWorker
+    points, offsets = state['zooms'][zoom]
+    buffer = proj.tileSize(zoom) * TILE_BUFFER
+    xmin, ymin, xmax, ymax = proj.tileBounds(zoom, col, row)
+    idx, lineOffsets = geo.repeatPolylines(offsets, lines)
+    parts, partOffsets, owner = geo.clipPolylines(
+        points[idx], lineOffsets, (xmin - buffer, ymin - buffer,
+                                   xmax + buffer, ymax + buffer))
+    stopXY = state['stopXY'][stops]
+    if not len(owner) and not len(stops):
+        return None
+    lat, lng = proj.metersToLatLng(np.append(parts[:, 0], stopXY[:, 0]),
+                                   np.append(parts[:, 1], stopXY[:, 1]))
+    coords = np.column_stack([np.round(lat, PRECISION),
+                              np.round(lng, PRECISION)]).tolist()
+    features = []
+    byLine = {}
+    for i, line in enumerate(lines[owner].tolist()):
+        byLine.setdefault(line, []).append(
+            coords[partOffsets[i]:partOffsets[i+1]])
+    for line in sorted(byLine):
+        fid, props = state['features'][line]
+        lineParts = byLine[line]
+        geometry = ({'type': 'LineString', 'coordinates': lineParts[0]} if
+                    len(lineParts) == 1 else
+                    {'type': 'MultiLineString', 'coordinates': lineParts})
+        feature = {'type': 'Feature', 'geometry': geometry,
+                   'properties': props}
+        if fid is not None:
+            feature['id'] = fid
+        features.append(feature)
+    for i, stop in enumerate(stops.tolist()):
+        fid, props = state['stopFeatures'][stop]
+        features.append({'type': 'Feature', 'properties': props,
+                         'geometry': {'type': 'Point',
+                                      'coordinates': coords[len(parts) + i]}})
+    tileDir = os.path.join(state['outDir'], str(zoom), str(col))
+    try:
+        os.makedirs(tileDir)
+    except OSError:
+        if not os.path.isdir(tileDir):
+            raise
+    writeFeatures(os.path.join(tileDir, '%d.geojson' % (row)), features)
+    return zoom, col, row, len(features)
+
+
+def linkRecord(link):
+    """ Read the geometry of a link or connector element.
+        Input: <link> element
+        Output: dict of link number, lane widths (None when not set), x and
+                y lists, and the lane and position of the from and to link
+                ends of connectors (None for links)
+    """
+    points = link.findall('./geometry/points3D/point3D')
+    fromPt = link.find('fromLinkEndPt')
+    toPt = link.find('toLinkEndPt')
+    return {'no': link.get('no'),
+            'lanes': [lane.get('width') for lane in
+                      link.findall('./lanes/lane')],
+            'x': [p.get('x') for p in points],
+            'y': [p.get('y') for p in points],
+            'fromLane': None if fromPt is None else fromPt.get('lane'),
+            'fromPos': None if fromPt is None else fromPt.get('pos'),
+            'toLane': None if toPt is None else toPt.get('lane'),
+            'toPos': None if toPt is None else toPt.get('pos')}
+
+
+def laneWidths(link):
+    """ Lane widths of a link record.
+        Input: link record
+        Output: list of floats, LANE_WIDTH for lanes without a width
+    """
+    return [LANE_WIDTH if w is None else float(w) for w in link['lanes']]
+
+
+def recordPoints(links):
+    """ Flatten the points of link records.
+        Input: list of link records
+        Output: flat array of x,y,z points, start index of each link followed
+                by the total number of points
+    """
+    counts = [len(link['x']) for link in links]
+    offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+    points = np.zeros((offsets[-1], 3))
+    points[:, 0] = [v for link in links for v in link['x']]
+    points[:, 1] = [v for link in links for v in link['y']]
+    return points, offsets
+
+
+def ptStopPoints(stops, links):
+    """ Locate PT stops at their position along the centerline of their
+        lane, in one batch.
+        Input: list of ptStop attribute dicts, dict of link records keyed by
+               link number
+        Output: list of the stops whose link was found, array of their x,y,z
+                network coordinates
+    """
+    stops = [s for s in stops if s.get('lane', '').split()[0] in links]
+    if not stops:
+        return [], np.zeros((0, 3))
+    linkNums = sorted(set(s['lane'].split()[0] for s in stops))
+    records = [links[n] for n in linkNums]
+    points, offsets = recordPoints(records)
+    centers, centerOffsets, edges, edgeOffsets = geo.laneGeometryBatch(
+        points, offsets, [laneWidths(r) for r in records])
+    # Index of the first lane centerline of each link
+    first = dict(zip(linkNums, np.cumsum(
+        [0] + [len(r['lanes']) for r in records[:-1]]).tolist()))
+    polylines, measures = [], []
+    for s in stops:
+        linkNum, lane = s['lane'].split()
+        lanes = len(links[linkNum]['lanes'])
+        polylines.append(first[linkNum] + min(max(int(lane), 1), lanes) - 1)
+        measures.append(float(s.get('pos') or 0))
+    return stops, geo.interpolateBatch(centers, centerOffsets, polylines,
+                                       measures)
+
+
+def ptStopProperties(stop):
+    return {'id': stop['no'], 'name': stop.get('name', ''),
+            'lane': stop['lane'], 'pos': stop.get('pos'),
+            'length': stop.get('length')}
+
+
+def _feature(layer, geometryType, coordinates, properties):
+    return {'type': 'Feature',
+            'geometry': {'type': geometryType, 'coordinates': coordinates},
+            'properties': dict(properties, layer=layer)}
+
+
+def writeFeatures(filename, features, ndjson=False):
+    """ Write features one at a time.
+        Input: filename or open file, iterable of feature dicts, write
+               newline delimited GeoJSON instead of a FeatureCollection
+        Output: number of features written
+    """
+    f = open(filename, 'w') if isinstance(filename, basestring) else filename
+    count = 0
+    try:
+        if not ndjson:
+            f.write('{"type": "FeatureCollection", "features": [')
+        for feature in features:
+            if ndjson:
+                f.write(json.dumps(feature) + '\n')
+            else:
+                f.write((', ' if count else '') + json.dumps(feature))
+            count += 1
+        if not ndjson:
+            f.write(']}')
+    finally:
+        if f is not filename:
+            f.close()
+    return count
+
+
+def _encodeFeature(feature):
+    coords = feature['geometry']['coordinates']
+    # Nesting of the coordinates: a pair, a list of pairs (including the
+    # flat MultiLineString of the links layer) or a list of lists of pairs
+    if not isinstance(coords[0], list):
+        depth, parts = 1, [[coords]]
+    elif not isinstance(coords[0][0], list):
+        depth, parts = 2, [coords]
+    else:
+        depth, parts = 3, coords
+    points = np.array([p for part in parts for p in part], dtype='<f8')
+    rest = dict(feature, geometry={'type': feature['geometry']['type']})
+    data = (struct.pack('<BI%dI' % (len(parts)), depth, len(parts),
+                        *[len(part) for part in parts]) +
+            points.tobytes() + json.dumps(rest))
+    return struct.pack('<I', len(data)) + data, points
+
+
+def _decodeFeature(data):
+    depth, count = struct.unpack_from('<BI', data)
+    sizes = struct.unpack_from('<%dI' % (count), data, 5)
+    start = 5 + 4 * count
+    end = start + 16 * sum(sizes)
+    points = np.frombuffer(data[start:end], dtype='<f8').reshape(-1, 2)
+    feature = json.loads(data[end:])
+    points = points.tolist()
+    if depth == 1:
+        coords = points[0]
+    elif depth == 2:
+        coords = points
+    else:
+        bounds = np.cumsum((0,) + sizes)
+        coords = [points[a:b] for a, b in zip(bounds[:-1], bounds[1:])]
+    feature['geometry']['coordinates'] = coords
+    return feature
+
+
+def writeBinary(filename, features, nodeSize=NODE_SIZE):
+    """ Write features to the indexed binary format (see BINARY_MAGIC).
+        Features are sorted along a Hilbert curve of their bounding box
+        centers and kept in memory until the index is written.
+        Input: filename or open file, iterable of feature dicts, R-tree node
+               size
+        Output: number of features written
+    """
+    records, points = [], []
+    for feature in features:
+        data, pts = _encodeFeature(feature)
+        records.append(data)
+        points.append(pts)
+    bounds = np.zeros((0, 4))
+    if records:
+        # Bounding boxes of all features in one reduction
+        starts = np.cumsum([0] + [len(p) for p in points[:-1]])
+        points = np.concatenate(points)
+        bounds = np.column_stack([np.minimum.reduceat(points, starts),
+                                  np.maximum.reduceat(points, starts)])
+    extent = (np.concatenate([bounds[:, :2].min(axis=0),
+                              bounds[:, 2:].max(axis=0)]).tolist()
+              if len(bounds) else [0.0, 0.0, 0.0, 0.0])
+    order = np.argsort(spatial.hilbertValues(
+        (bounds[:, 0] + bounds[:, 2]) / 2, (bounds[:, 1] + bounds[:, 3]) / 2,
+        extent), kind='mergesort')
+    sizes = np.array([len(records[i]) for i in order], dtype=np.uint64)
+    tree = spatial.PackedRTree.build(bounds[order],
+                                     np.cumsum(sizes) - sizes, nodeSize)
+    header = json.dumps({'featureCount': len(records), 'nodeSize': nodeSize,
+                         'bounds': extent, 'coordinates': 'lat,lng'})
+    f = open(filename, 'wb') if isinstance(filename, basestring) else filename
+    try:
+        f.write(BINARY_MAGIC + struct.pack('<I', len(header)) + header)
+        f.write(tree.nodes.tobytes())
+        for i in order:
+            f.write(records[i])
+    finally:
+        if f is not filename:
+            f.close()
+    return len(records)
+
+
+def readBinary(filename, bbox=None):
+    """ Read features of a file written by writeBinary. With a bounding box
+        only the header, the index and the features whose bounding box
+        intersects it are read.
+        Input: filename or open file, optional min lat, min lng, max lat,
+               max lng
+        Output: list of feature dicts in file order
+    """
+    f = open(filename, 'rb') if isinstance(filename, basestring) else filename
+    try:
+        if f.read(len(BINARY_MAGIC)) != BINARY_MAGIC:
+            raise ValueError('%s is not a binary feature file' % (filename))
+        size, = struct.unpack('<I', f.read(4))
+        header = json.loads(f.read(size))
+        count, nodeSize = header['featureCount'], header['nodeSize']
+        nodeCount = sum(spatial.PackedRTree.levelSizes(count, nodeSize))
+        dtype = spatial.PackedRTree.nodeType
+        if bbox is None:
+            f.seek(nodeCount * dtype.itemsize, os.SEEK_CUR)
+            data = f.read()
+            features, pos = [], 0
+            while pos < len(data):
+                size, = struct.unpack_from('<I', data, pos)
+                features.append(_decodeFeature(data[pos+4:pos+4+size]))
+                pos += 4 + size
+            return features
+        nodes = np.frombuffer(f.read(nodeCount * dtype.itemsize), dtype)
+        start = f.tell()
+        features = []
+        for offset in np.sort(spatial.PackedRTree(nodes, count,
+                                                  nodeSize).search(bbox)):
+            f.seek(start + int(offset))
+            size, = struct.unpack('<I', f.read(4))
+            features.append(_decodeFeature(f.read(size)))
+        return features
+    finally:
+        if f is not filename:
+            f.close()
+
+
+def readInpx(inpxFile, ptStops=False):
+    """ Read the link geometries and reference points of an .inpx file with
+        iterparse. Elements are cleared once read and parsing stops after the
+        links and netPara (and ptStops) are read, so the model tree is never
+        built.
+        Input: .inpx filename or stream, also read PT stops
+        Output: generator of ('link', link record), ('netPara', (map x,
+                map y, start x, start y)) and ('ptStop', attribute dict)
+                tuples in file order
+    """
+    tags = ('link', 'links', 'netPara')
+    sections = set(['links', 'netPara'])
+    if ptStops:
+        tags += ('ptStop', 'ptStops')
+        sections.add('ptStops')
+    seen = set()
+    for event, elem in etree.iterparse(inpxFile, events=('end',), tag=tags):
+        if elem.tag == 'link':
+            yield 'link', linkRecord(elem)
+        elif elem.tag == 'ptStop':
+            yield 'ptStop', dict(elem.attrib)
+        elif elem.tag == 'netPara':
+            refMap = elem.find('refPointMap')
+            refNet = elem.find('refPointNet')
+            yield 'netPara', (float(refMap.get('x')), float(refMap.get('y')),
+                              float(refNet.get('x')), float(refNet.get('y')))
+        seen.add(elem.tag)
+        # Free the element and everything parsed before it and its parent
+        elem.clear()
+        for node in (elem, elem.getparent()):
+            while (node is not None and node.getparent() is not None and
+                   node.getprevious() is not None):
+                del node.getparent()[0]
+        if sections <= seen:
+            break
+
+
+def inpxFeatures(inpxFile, batchSize=FEATURE_BATCH, layers=('links',)):
+    """ Convert the links of an .inpx file to GeoJSON features without
+        loading the model. Links read before the reference points are
+        converted once these are found.
+        Input: .inpx filename or stream, batch size, layers to create (see
+               LAYERS)
+        Output: generator of feature dicts
+    """
+    converter, batch, links, stops = None, [], {}, []
+    for kind, value in readInpx(inpxFile, 'ptStops' in layers):
+        if kind == 'netPara':
+            converter = GeoJSON.fromReference(*value)
+        elif kind == 'ptStop':
+            stops.append(value)
+            continue
+        else:
+            batch.append(value)
+            if 'ptStops' in layers:
+                links[value['no']] = value
+        if converter is not None and (kind == 'netPara' or
+                                      len(batch) >= batchSize):
+            for feature in converter.iterFeatures(batch, batchSize, layers):
+                yield feature
+            batch = []
+    if converter is None:
+        raise ValueError('No netPara reference points in %s' % (inpxFile))
+    for feature in converter.iterFeatures(batch, batchSize, layers):
+        yield feature
+    if 'ptStops' in layers:
+        for feature in converter.ptStopFeatures(stops, links):
+            yield feature
+
+
+def inpxToGeoJSON(inpxFile, filename, ndjson=False, batchSize=FEATURE_BATCH,
+                  layers=('links',)):
+    """ Export the links of an .inpx file to GeoJSON without loading the
+        model.
+        Input: .inpx filename or stream, output filename or open file, write
+               newline delimited GeoJSON, batch size, layers to export (see
+               LAYERS)
+        Output: number of features written
+    """
+    return writeFeatures(filename, inpxFeatures(inpxFile, batchSize, layers),
+                         ndjson)
+
+
+def importGeoJSON(v, source):
+    """ Write edited geometry back into a model in bulk: links matched by
+        number get their geometry and lane count rewritten, other features
+        become new links.
+        Input: Vissim object, GeoJSON or newline delimited GeoJSON filename
+               or open file, or anything taken by GeoJSON.linkGeometries
+        Output: list of updated link numbers, list of created link numbers
+    """
+    if isinstance(source, basestring) or hasattr(source, 'read'):
+        f = open(source) if isinstance(source, basestring) else source
+        try:
+            text = f.read()
+        finally:
+            if f is not source:
+                f.close()
+        try:
+            source = json.loads(text)
+        except ValueError:
+            source = [json.loads(line) for line in text.splitlines() if
+                      line.strip()]
+    return v.Links.setGeometries(GeoJSON(v).linkGeometries(source))
+
+
+def inpxToBinary(inpxFile, filename, batchSize=FEATURE_BATCH,
+                 layers=('links',), nodeSize=NODE_SIZE):
+    """ Export the links of an .inpx file to the indexed binary format
+        without loading the model.
+        Input: .inpx filename or stream, output filename or open file, batch
+               size, layers to export (see LAYERS), R-tree node size
+        Output: number of features written
+    """
+    return writeBinary(filename, inpxFeatures(inpxFile, batchSize, layers),
+                       nodeSize)
+
+
+def inpxToTiles(inpxFile, outDir, minZoom=10, maxZoom=16, layers=('links',),
+                workers=None):
+    """ Write a tile pyramid of the links of an .inpx file without loading
+        the model.
+        Input: .inpx filename or stream, output directory, zoom levels,
+               layers (see TILE_LAYERS), number of worker processes
+        Output: list of (z, x, y, feature count) of the tiles written
+    """
+    ref, links, stops = None, [], []
+    for kind, value in readInpx(inpxFile, 'ptStops' in layers):
+        if kind == 'netPara':
+            ref = value
+        elif kind == 'ptStop':
+            stops.append(value)
+        else:
+            links.append(value)
+    if ref is None:
+        raise ValueError('No netPara reference points in %s' % (inpxFile))
+    return GeoJSON.fromReference(*ref).exportTiles(
+        outDir, minZoom, maxZoom, layers, links, stops, workers)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export the links of a '
+                                     'VISSIM network to GeoJSON.')
+    parser.add_argument('inpx', help='.inpx file')
+    parser.add_argument('out', help='.geojson file, or directory of tiles')
+    parser.add_argument('--ndjson', action='store_true',
+                        help='write one feature per line')
+    parser.add_argument('--layers', default='links',
+                        help='comma separated layers: ' + ', '.join(LAYERS))
+    parser.add_argument('--binary', action='store_true',
+                        help='write the indexed binary format')
+    parser.add_argument('--tiles', default=None, metavar='MINZOOM-MAXZOOM',
+                        help='write a z/x/y tile pyramid, e.g. 10-16')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of tile worker processes')
+    args = parser.parse_args()
+    layers = tuple(args.layers.split(','))
+    if args.tiles:
+        minZoom, maxZoom = [int(z) for z in args.tiles.split('-')]
+        inpxToTiles(args.inpx, args.out, minZoom, maxZoom, layers,
+                    args.workers)
+    elif args.binary:
+        inpxToBinary(args.inpx, args.out, layers=layers)
+    else:
+        inpxToGeoJSON(args.inpx, args.out, args.ndjson, layers=layers)